@@ -15,12 +15,11 @@ Features:
 import os
 import sys
 import numpy as np
-import pandas as pd
-from collections import defaultdict, deque
 from typing import Dict, List, Tuple, Optional, Any
 import gymnasium as gym
 from gymnasium import spaces
-import warnings
+
+from numba_compat import njit
 
 # SUMO imports
 if 'SUMO_HOME' in os.environ:
@@ -29,8 +28,94 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("Please declare environment variable 'SUMO_HOME'")
 
-import traci
-import sumolib
+# libsumo runs SUMO in-process with the same API but no socket round-trip per
+# call; opt in with SUMO's LIBSUMO_AS_TRACI convention for headless training
+USE_LIBSUMO = bool(os.environ.get('LIBSUMO_AS_TRACI'))
+if USE_LIBSUMO:
+    try:
+        import libsumo as traci
+    except ImportError:
+        USE_LIBSUMO = False
+if not USE_LIBSUMO:
+    import traci
+import traci.constants as tc
+
+# Dynamic per-lane variables read through one subscription per lane instead
+# of one RPC per getter; lane length is static and cached at init
+LANE_VARS = [
+    tc.LAST_STEP_VEHICLE_NUMBER,
+    tc.LAST_STEP_VEHICLE_HALTING_NUMBER,
+    tc.VAR_WAITING_TIME,
+    tc.LAST_STEP_MEAN_SPEED,
+]
+
+# Per-TLS signal state and phase, read from the same per-step subscription results
+TLS_VARS = [tc.TL_RED_YELLOW_GREEN_STATE, tc.TL_CURRENT_PHASE]
+
+# Simulation-wide variables read from the per-step subscription results
+SIM_VARS = [tc.VAR_MIN_EXPECTED_VEHICLES]
+
+# Column order of per-lane metric arrays, which is also the observation layout
+LANE_METRICS = ('vehicle_count', 'queue_length', 'waiting_time', 'mean_speed',
+                'occupancy', 'density', 'flow_rate')
+# Observation normalization for each LANE_METRICS column
+LANE_NORM = np.array([30, 20, 180, 50, 1, 50, 300], dtype=np.float32)
+
+@njit(cache=True)
+def score_phases(green_masks, phase_ids, link_signal, link_lane, metrics, last_green, sim_step):
+    """
+    Demand plus fairness score of each phase in phase_ids: sum over links whose
+    signal is green and whose incoming lane has a metrics row (link_lane >= 0).
+    """
+    scores = np.zeros(phase_ids.shape[0])
+    for p in range(phase_ids.shape[0]):
+        green_mask = green_masks[phase_ids[p]]
+        score = 0.0
+        for k in range(link_signal.shape[0]):
+            lane = link_lane[k]
+            if lane < 0 or not green_mask[link_signal[k]]:
+                continue
+            # Demand-based scoring
+            demand_score = metrics[lane, 1] * 2 + metrics[lane, 2] * 0.01 + metrics[lane, 0] * 0.5
+            # Fairness bonus, up to 5 points
+            fairness_bonus = min((sim_step - last_green[lane]) / 60, 5.0)
+            score += demand_score + fairness_bonus
+        scores[p] = score
+    return scores
+
+@njit(cache=True)
+def compute_reward(metrics, time_since_last_switch):
+    """State-based reward of one TLS from its (n_lanes, 7) lane metrics array"""
+    n_lanes = metrics.shape[0]
+    if n_lanes == 0:
+        return 0.0
+    # Aggregate metrics: per-lane means, summed in a single pass over the rows
+    total_queue = 0.0
+    total_waiting = 0.0
+    avg_speed = 0.0
+    total_throughput = 0.0
+    for i in range(n_lanes):
+        total_queue += metrics[i, 1]
+        total_waiting += metrics[i, 2]
+        avg_speed += metrics[i, 3]
+        total_throughput += metrics[i, 6]
+    total_queue /= n_lanes
+    total_waiting /= n_lanes
+    avg_speed /= n_lanes
+    total_throughput /= n_lanes
+    
+    # Normalized reward components
+    waiting_penalty = -min(total_waiting / 180, 1.0) * 3    # Normalize by 3 minutes
+    queue_penalty = -min(total_queue / 20, 1.0) * 2         # Normalize by 20 vehicles
+    throughput_bonus = min(total_throughput / 300, 1.0) * 2 # Normalize by 300 flow
+    speed_bonus = min(avg_speed / 30, 1.0) * 1              # Normalize by 30 km/h
+    
+    # Switch penalty (discourage rapid switching)
+    switch_penalty = -0.1 if time_since_last_switch < 10 else 0.0
+    
+    return (waiting_penalty + queue_penalty +
+            throughput_bonus + speed_bonus + switch_penalty)
+
 
 # Safe print for Windows consoles that can't encode emojis
 def _safe_print(msg):
@@ -64,33 +149,86 @@ class TargetedTrafficLightManager:
         self.phase_switches = 0
         
         # Fairness tracking
-        self.lane_last_green = defaultdict(lambda: -max_red_time)
         self.emergency_switches = 0
         self.emergency_cooldown = 20  # 20 second cooldown
         self.last_emergency_switch = -90
         
+        # Static topology: controlled links and the incoming lanes per signal index
+        self.controlled_links = self._get_controlled_links()
+        self.signal_lanes = [[link[0] for link in link_list] for link_list in self.controlled_links]
+        
         # Get controlled lanes and phases
         self.controlled_lanes = self._get_controlled_lanes()
         self.green_phases = self._identify_green_phases()
+        self._build_phase_arrays()
+        
+        # Fairness tracking: last green time per controlled lane (same order)
+        self.lane_last_green = np.full(len(self.controlled_lanes), -max_red_time, dtype=np.int32)
+        
+        # Lane subscriptions; results are handed in by the env once per step
+        self.lane_lengths = np.ones(len(self.controlled_lanes))
+        self.lane_results = {}
+        self._subscribe_lanes()
+        
+        # Signal state subscription; setPhase empties the results until the next step
+        self.tls_results = {}
+        self._subscribe_tls()
+        
+        # Lane metrics of the last simulation step they were computed for
+        self._metrics_cache = None
+        self._metrics_cache_step = -1
+        # Green-lane mask of the last simulation step it was read for; the env
+        # resets the step on phase switches since setPhase changes it at once
+        self._green_mask_cache = None
+        self._green_mask_step = -1
         
         _safe_print(f"TLS {tls_id}: {len(self.controlled_lanes)} lanes, {len(self.green_phases)} green phases")
         
+    def _get_controlled_links(self) -> List:
+        """Fetch controlled links once; the topology doesn't change during a run"""
+        try:
+            return traci.trafficlight.getControlledLinks(self.tls_id)
+        except Exception as e:
+            print(f"Warning: Could not get links for {self.tls_id}: {e}")
+            return []
+    
     def _get_controlled_lanes(self) -> List[str]:
         """Get lanes controlled by this traffic light"""
+        lanes = set()
+        
+        for signal_lanes in self.signal_lanes:
+            for lane in signal_lanes:
+                if lane:  # incoming lane
+                    lanes.add(lane)
+        
+        return list(lanes)[:12]  # Limit to 12 lanes max for efficiency
+    
+    def _subscribe_lanes(self):
+        """Subscribe to per-lane metrics and cache static lane lengths"""
+        for i, lane in enumerate(self.controlled_lanes):
+            try:
+                traci.lane.subscribe(lane, LANE_VARS)
+                self.lane_lengths[i] = max(traci.lane.getLength(lane), 1)
+            except Exception as e:
+                print(f"Warning: Could not subscribe to lane {lane}: {e}")
+    
+    def _subscribe_tls(self):
+        """Subscribe to the signal state, keeping variables another user of the connection subscribed"""
         try:
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            lanes = set()
-            
-            for link_list in controlled_links:
-                for link in link_list:
-                    if link[0]:  # incoming lane
-                        lanes.add(link[0])
-            
-            return list(lanes)[:12]  # Limit to 12 lanes max for efficiency
-            
+            subscribed = traci.trafficlight.getSubscriptionResults(self.tls_id) or {}
+            traci.trafficlight.subscribe(self.tls_id, sorted(set(subscribed) | set(TLS_VARS)))
         except Exception as e:
-            print(f"Warning: Could not get lanes for {self.tls_id}: {e}")
-            return []
+            print(f"Warning: Could not subscribe to TLS {self.tls_id}: {e}")
+    
+    def _lane_values(self, lane: str) -> Tuple[float, float, float, float]:
+        """(vehicle count, halting count, waiting time, mean speed) for a lane"""
+        res = self.lane_results.get(lane)
+        if res:
+            return (res[tc.LAST_STEP_VEHICLE_NUMBER], res[tc.LAST_STEP_VEHICLE_HALTING_NUMBER],
+                    res[tc.VAR_WAITING_TIME], res[tc.LAST_STEP_MEAN_SPEED])
+        # No subscription results yet (first observation after reset)
+        return (traci.lane.getLastStepVehicleNumber(lane), traci.lane.getLastStepHaltingNumber(lane),
+                traci.lane.getWaitingTime(lane), traci.lane.getLastStepMeanSpeed(lane))
     
     def _identify_green_phases(self) -> List[int]:
         """Identify green phases"""
@@ -98,7 +236,37 @@ class TargetedTrafficLightManager:
         for i, phase in enumerate(self.phases):
             if 'G' in phase.state or 'g' in phase.state:
                 green_phases.append(i)
-        return green_phases if green_phases else list(range(min(len(self.phases), 6)))
+        if not green_phases:
+            green_phases = list(range(min(len(self.phases), 6)))
+        return green_phases
+    
+    def _build_phase_arrays(self):
+        """
+        Integer/boolean views of the static phase and link layout. Lanes are addressed
+        by their index in controlled_lanes; lane ids are only needed for TraCI calls.
+        """
+        self.green_phase_ids = np.array(self.green_phases, dtype=np.int32)
+        lane_idx = {lane: i for i, lane in enumerate(self.controlled_lanes)}
+        link_signal = []
+        link_lane = []
+        for signal, signal_lanes in enumerate(self.signal_lanes):
+            for lane in signal_lanes:
+                link_signal.append(signal)
+                link_lane.append(lane_idx.get(lane, -1))
+        self.link_signal = np.array(link_signal, dtype=np.int32)
+        self.link_lane = np.array(link_lane, dtype=np.int32)
+        
+        n_signals = len(self.signal_lanes)
+        self.green_masks = np.zeros((len(self.phases), n_signals), dtype=np.bool_)
+        for phase_idx, phase in enumerate(self.phases):
+            for signal, state_char in enumerate(phase.state[:n_signals]):
+                self.green_masks[phase_idx, signal] = state_char in ('G', 'g')
+        
+        # First green phase (in green_phases order) serving each lane, -1 if none
+        self.lane_first_green = np.full(len(self.controlled_lanes), -1, dtype=np.int32)
+        for phase_idx in reversed(self.green_phases):
+            served = self.link_lane[self.green_masks[phase_idx][self.link_signal] & (self.link_lane >= 0)]
+            self.lane_first_green[served] = phase_idx
     
     def can_switch_phase(self, current_time: int) -> bool:
         """Check if phase can be switched"""
@@ -110,93 +278,87 @@ class TargetedTrafficLightManager:
         if current_time - self.last_emergency_switch < self.emergency_cooldown:
             return False, None
         
-        current_green_lanes = self._get_current_green_lanes()
-        max_starvation = 0
-        starved_lane = None
-        
-        for lane in self.controlled_lanes:
-            if lane not in current_green_lanes:
-                starvation_time = current_time - self.lane_last_green[lane]
-                if starvation_time > self.max_red_time * 0.8 and starvation_time > max_starvation:
-                    max_starvation = starvation_time
-                    starved_lane = lane
-        
-        if starved_lane:
-            best_phase = self._find_best_phase_for_lane(starved_lane)
-            if best_phase is not None and best_phase != self.current_phase:
+        if self.controlled_lanes:
+            # Longest-starved lane that is not green now (first one on ties)
+            starvation = current_time - self.lane_last_green
+            starvation[self._green_lane_mask(current_time)] = 0
+            idx = int(starvation.argmax())
+            best_phase = int(self.lane_first_green[idx])
+            if (starvation[idx] > self.max_red_time * 0.8
+                    and best_phase >= 0 and best_phase != self.current_phase):
                 self.last_emergency_switch = current_time
                 self.emergency_switches += 1
                 return True, best_phase
         
         return False, None
     
-    def _get_current_green_lanes(self) -> List[str]:
-        """Get currently green lanes"""
-        try:
-            current_state = traci.trafficlight.getRedYellowGreenState(self.tls_id)
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            
-            green_lanes = []
-            for i, (state_char, link_list) in enumerate(zip(current_state, controlled_links)):
-                if state_char in ['G', 'g']:
-                    for link in link_list:
-                        if link[0] not in green_lanes:
-                            green_lanes.append(link[0])
-            return green_lanes
-        except:
-            return []
-    
-    def _find_best_phase_for_lane(self, lane: str) -> Optional[int]:
-        """Find best green phase for a lane"""
-        try:
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            
-            for phase_idx in self.green_phases:
-                phase_state = self.phases[phase_idx].state
-                for i, (state_char, link_list) in enumerate(zip(phase_state, controlled_links)):
-                    if state_char in ['G', 'g']:
-                        for link in link_list:
-                            if link[0] == lane:
-                                return phase_idx
-            return None
-        except:
-            return None
-    
-    def get_lane_metrics(self) -> Dict[str, Dict[str, float]]:
-        """Get lane metrics with capping for stability"""
-        metrics = {}
-        
-        for lane in self.controlled_lanes:
+    def get_lane_metrics_array(self, step: Optional[int] = None) -> np.ndarray:
+        """
+        Lane metrics as an (n_lanes, 7) array in LANE_METRICS column order, capped for stability.
+        With a simulation step, the result is computed once per step and shared by all callers
+        (treat it as read-only).
+        """
+        if step is not None and step == self._metrics_cache_step:
+            return self._metrics_cache
+        n_lanes = len(self.controlled_lanes)
+        raw = np.zeros((n_lanes, 4))
+        lengths = self.lane_lengths
+        for i, lane in enumerate(self.controlled_lanes):
             try:
-                vehicle_count = min(traci.lane.getLastStepVehicleNumber(lane), 30)
-                queue_length = min(traci.lane.getLastStepHaltingNumber(lane), 20)
-                waiting_time = min(traci.lane.getWaitingTime(lane), 180)  # Cap at 3 minutes
-                mean_speed = traci.lane.getLastStepMeanSpeed(lane)
-                lane_length = max(traci.lane.getLength(lane), 1)
-                
-                metrics[lane] = {
-                    'vehicle_count': vehicle_count,
-                    'queue_length': queue_length,
-                    'waiting_time': waiting_time,
-                    'mean_speed': mean_speed,
-                    'occupancy': min(vehicle_count * 5.0 / lane_length, 1.0),
-                    'density': min(vehicle_count / (lane_length / 1000), 50),
-                    'flow_rate': min(vehicle_count * mean_speed, 300) if mean_speed > 0 else 0
-                }
+                raw[i] = self._lane_values(lane)
             except:
-                metrics[lane] = {
-                    'vehicle_count': 0, 'queue_length': 0, 'waiting_time': 0,
-                    'mean_speed': 0, 'occupancy': 0, 'density': 0, 'flow_rate': 0
-                }
-        
+                raw[i] = 0
+        
+        vehicle_count = np.minimum(raw[:, 0], 30)
+        mean_speed = raw[:, 3]
+        metrics = np.empty((n_lanes, 7))
+        metrics[:, 0] = vehicle_count
+        metrics[:, 1] = np.minimum(raw[:, 1], 20)
+        metrics[:, 2] = np.minimum(raw[:, 2], 180)  # Cap at 3 minutes
+        metrics[:, 3] = mean_speed
+        metrics[:, 4] = np.minimum(vehicle_count * 5.0 / lengths, 1.0)
+        metrics[:, 5] = np.minimum(vehicle_count / (lengths / 1000), 50)
+        metrics[:, 6] = np.where(mean_speed > 0, np.minimum(vehicle_count * mean_speed, 300), 0)
+        if step is not None:
+            self._metrics_cache = metrics
+            self._metrics_cache_step = step
         return metrics
     
+    def get_lane_metrics(self, step: Optional[int] = None) -> Dict[str, Dict[str, float]]:
+        """Get lane metrics with capping for stability"""
+        return {
+            lane: dict(zip(LANE_METRICS, row))
+            for lane, row in zip(self.controlled_lanes, self.get_lane_metrics_array(step).tolist())
+        }
+    
+    def _green_lane_mask(self, step: Optional[int] = None) -> np.ndarray:
+        """
+        Boolean mask over controlled_lanes of the lanes that are green now. With a
+        simulation step, the signal state is read once per step.
+        """
+        if step is not None and step == self._green_mask_step:
+            return self._green_mask_cache
+        mask = np.zeros(len(self.controlled_lanes), dtype=np.bool_)
+        current_state = self.tls_results.get(tc.TL_RED_YELLOW_GREEN_STATE)
+        if current_state is None:
+            # No results yet this step (first observation, or a phase switch since)
+            try:
+                current_state = traci.trafficlight.getRedYellowGreenState(self.tls_id)
+            except traci.TraCIException:
+                return mask
+        green_signals = np.zeros(len(self.signal_lanes), dtype=np.bool_)
+        for signal, state_char in enumerate(current_state[:len(green_signals)]):
+            green_signals[signal] = state_char in ('G', 'g')
+        green_links = green_signals[self.link_signal] & (self.link_lane >= 0)
+        mask[self.link_lane[green_links]] = True
+        if step is not None:
+            self._green_mask_cache = mask
+            self._green_mask_step = step
+        return mask
+    
     def update_fairness_metrics(self, current_time: int):
         """Update fairness tracking"""
-        current_green_lanes = self._get_current_green_lanes()
-        for lane in self.controlled_lanes:
-            if lane in current_green_lanes:
-                self.lane_last_green[lane] = current_time
+        self.lane_last_green[self._green_lane_mask(current_time)] = current_time
 
 
 class AddisTargetedEnvironment(gym.Env):
@@ -232,9 +394,13 @@ class AddisTargetedEnvironment(gym.Env):
         
         # Environment state
         self.simulation_step = 0
+        self._sumo_time_origin = None
+        self._sumo_step_length = 1.0
+        self._sim_results = {}
         self.traffic_lights = {}
         self.episode_reward = 0
         self.emergency_switches_total = 0
+        self._last_emergency_check = 0
         
         # Fixed action and observation spaces for the 7 specific TLS
         n_tls = len(self.target_tls_ids)
@@ -244,12 +410,17 @@ class AddisTargetedEnvironment(gym.Env):
         self.observation_space = spaces.Box(
             low=0.0, high=1.0, shape=(607,), dtype=np.float32
         )
+        self._obs = np.zeros(607, dtype=np.float32)  # Reused by _get_observation
+        # Per-TLS lane metrics (up to 12 lanes x 7 metrics), normalized in place
+        self._metrics_tensor = np.zeros((n_tls, 12, len(LANE_METRICS)), dtype=np.float32)
         
         _safe_print(f"Targeting {n_tls} specific traffic lights: {', '.join(self.target_tls_ids)}")
         
     def _start_sumo(self):
         """Start SUMO simulation"""
-        sumo_cmd = ["sumo-gui" if self.use_gui else "sumo"]
+        if self.use_gui and USE_LIBSUMO:
+            _safe_print("libsumo cannot run the SUMO GUI; simulating headless")
+        sumo_cmd = ["sumo-gui" if self.use_gui and not USE_LIBSUMO else "sumo"]
         sumo_cmd.extend(["-c", self.sumocfg_file])
         sumo_cmd.extend([
             "--waiting-time-memory", "10000",
@@ -326,10 +497,20 @@ class AddisTargetedEnvironment(gym.Env):
         _safe_print(f"Reset: after warmup steps, expected vehicles={expected}")
         
         found_tls = self._detect_and_initialize_target_tls()
+        self._refresh_simulation_results()
+        
+        # SUMO time at env step 0 and the configured step length, so step()
+        # can advance delta_time simulation steps with a single request
+        try:
+            self._sumo_time_origin = traci.simulation.getTime()
+            self._sumo_step_length = traci.simulation.getDeltaT()
+        except traci.TraCIException:
+            self._sumo_time_origin = None
         
         self.simulation_step = 0
         self.episode_reward = 0
         self.emergency_switches_total = 0
+        self._last_emergency_check = 0
         
         # Initialize TLS states
         for tls in self.traffic_lights.values():
@@ -348,7 +529,7 @@ class AddisTargetedEnvironment(gym.Env):
         """Execute environment step"""
         # Debug: print pre-step expected
         try:
-            _safe_print(f"STEP: begin sim_step={self.simulation_step} expected={traci.simulation.getMinExpectedNumber()}")
+            _safe_print(f"STEP: begin sim_step={self.simulation_step} expected={self._min_expected_vehicles()}")
         except:
             _safe_print(f"STEP: begin sim_step={self.simulation_step} expected=?")
         # Normalize actions
@@ -367,10 +548,16 @@ class AddisTargetedEnvironment(gym.Env):
                     reward = self._execute_action(tls, action)
                     rewards.append(reward)
         
-        # Advance simulation
-        for _ in range(self.delta_time):
-            traci.simulationStep()
-            self.simulation_step += 1
+        # Advance simulation: SUMO runs the delta_time steps natively up to the
+        # target time instead of one round-trip per step
+        if self._sumo_time_origin is not None:
+            self.simulation_step += self.delta_time
+            traci.simulationStep(self._sumo_time_origin + self.simulation_step * self._sumo_step_length)
+        else:
+            for _ in range(self.delta_time):
+                traci.simulationStep()
+                self.simulation_step += 1
+        self._refresh_subscriptions()
         
         # Update metrics
         self._update_all_metrics()
@@ -386,7 +573,7 @@ class AddisTargetedEnvironment(gym.Env):
         min_warmup = 60  # seconds
         remaining = 0
         try:
-            remaining = traci.simulation.getMinExpectedNumber()
+            remaining = self._min_expected_vehicles()
         except:
             remaining = 0
         time_done = self.simulation_step >= self.num_seconds
@@ -400,9 +587,45 @@ class AddisTargetedEnvironment(gym.Env):
         
         return observation, total_reward, done, False, info
     
+    def _refresh_subscriptions(self):
+        """Fetch all lane and TLS subscription results once and share them with every TLS"""
+        try:
+            lane_results = traci.lane.getAllSubscriptionResults()
+            tls_results = traci.trafficlight.getAllSubscriptionResults()
+        except Exception:
+            lane_results, tls_results = {}, {}
+        for tls in self.traffic_lights.values():
+            tls.lane_results = lane_results
+            tls.tls_results = tls_results.get(tls.tls_id) or {}
+            tls._metrics_cache_step = -1
+        self._refresh_simulation_results()
+    
+    def _refresh_simulation_results(self):
+        """Read the simulation-wide subscription, subscribing SIM_VARS if they are missing"""
+        try:
+            results = traci.simulation.getAllSubscriptionResults().get('') or {}
+            if any(var not in results for var in SIM_VARS):
+                # Subscribing replaces the variable list, so keep what another user of
+                # this connection (the bridge in RL mode) has subscribed
+                traci.simulation.subscribe(sorted(set(results) | set(SIM_VARS)))
+                results = traci.simulation.getAllSubscriptionResults().get('') or {}
+        except Exception:
+            results = {}
+        self._sim_results = results
+    
+    def _min_expected_vehicles(self) -> int:
+        """Vehicles running or still to depart, from the subscription when available"""
+        value = self._sim_results.get(tc.VAR_MIN_EXPECTED_VEHICLES)
+        if value is None:
+            value = traci.simulation.getMinExpectedNumber()
+        return value
+    
     def _execute_action(self, tls: TargetedTrafficLightManager, action: int) -> float:
         """Execute action for a traffic light"""
         reward = 0
+        # Lane state only changes when SUMO steps, so one snapshot serves both
+        # phase selection and the reward
+        lane_metrics = tls.get_lane_metrics_array(self.simulation_step)
         
         # Check emergency switch first
         needs_emergency, emergency_phase = tls.needs_emergency_switch(self.simulation_step)
@@ -413,13 +636,13 @@ class AddisTargetedEnvironment(gym.Env):
                 reward += 2  # Small emergency bonus
         elif action == 1 and tls.can_switch_phase(self.simulation_step):
             # RL-controlled switch
-            next_phase = self._get_next_optimal_phase(tls)
+            next_phase = self._get_next_optimal_phase(tls, lane_metrics)
             if next_phase != tls.current_phase:
                 self._switch_to_phase(tls, next_phase)
                 reward += 0.5  # Small action bonus
         
         # Calculate state-based reward
-        reward += self._calculate_reward(tls)
+        reward += self._calculate_reward(tls, lane_metrics)
         
         return reward
     
@@ -434,100 +657,65 @@ class AddisTargetedEnvironment(gym.Env):
             tls.phase_start_time = self.simulation_step
             tls.time_since_last_switch = 0
             tls.phase_switches += 1
+            tls._green_mask_step = -1
+            tls.tls_results = {}
         except Exception as e:
             print(f"Error switching {tls.tls_id}: {e}")
     
-    def _get_next_optimal_phase(self, tls: TargetedTrafficLightManager) -> int:
+    def _get_next_optimal_phase(self, tls: TargetedTrafficLightManager,
+                                lane_metrics: Optional[np.ndarray] = None) -> int:
         """Get optimal next phase"""
-        lane_metrics = tls.get_lane_metrics()
-        
-        best_phase = (tls.current_phase + 1) % len(tls.green_phases) if tls.green_phases else tls.current_phase
-        best_score = -float('inf')
-        
-        for phase_idx in tls.green_phases:
-            if phase_idx == tls.current_phase:
-                continue
-            
-            score = self._evaluate_phase_score(tls, phase_idx, lane_metrics)
-            if score > best_score:
-                best_score = score
-                best_phase = phase_idx
+        if lane_metrics is None:
+            lane_metrics = tls.get_lane_metrics_array(self.simulation_step)
         
-        return best_phase
-    
-    def _evaluate_phase_score(self, tls: TargetedTrafficLightManager, phase_idx: int, 
-                             lane_metrics: Dict) -> float:
-        """Evaluate phase desirability"""
-        score = 0
+        default_phase = (tls.current_phase + 1) % len(tls.green_phases) if tls.green_phases else tls.current_phase
         
+        # Score every green phase in one call, then pick the best other than the current one
         try:
-            phase_state = tls.phases[phase_idx].state
-            controlled_links = traci.trafficlight.getControlledLinks(tls.tls_id)
-            
-            for i, (state_char, link_list) in enumerate(zip(phase_state, controlled_links)):
-                if state_char in ['G', 'g']:
-                    for link in link_list:
-                        lane = link[0]
-                        if lane in lane_metrics:
-                            metrics = lane_metrics[lane]
-                            # Demand-based scoring
-                            demand_score = (
-                                metrics['queue_length'] * 2 +
-                                metrics['waiting_time'] * 0.01 +
-                                metrics['vehicle_count'] * 0.5
-                            )
-                            
-                            # Fairness bonus
-                            time_since_green = self.simulation_step - tls.lane_last_green[lane]
-                            fairness_bonus = min(time_since_green / 60, 5)  # Up to 5 points
-                            
-                            score += demand_score + fairness_bonus
+            scores = score_phases(tls.green_masks, tls.green_phase_ids, tls.link_signal, tls.link_lane,
+                                  lane_metrics, tls.lane_last_green, float(self.simulation_step))
         except:
-            pass
-        
-        return score
+            scores = np.zeros(len(tls.green_phase_ids))
+        scores[tls.green_phase_ids == tls.current_phase] = -np.inf
+        if not len(scores) or scores.max() == -np.inf:
+            return default_phase
+        return tls.green_phases[int(scores.argmax())]
     
-    def _calculate_reward(self, tls: TargetedTrafficLightManager) -> float:
+    def _calculate_reward(self, tls: TargetedTrafficLightManager,
+                          lane_metrics: Optional[np.ndarray] = None) -> float:
         """Calculate reward for current state"""
-        lane_metrics = tls.get_lane_metrics()
-        
-        if not lane_metrics:
-            return 0
-        
-        # Aggregate metrics
-        total_waiting = sum(m['waiting_time'] for m in lane_metrics.values()) / len(lane_metrics)
-        total_queue = sum(m['queue_length'] for m in lane_metrics.values()) / len(lane_metrics)
-        total_throughput = sum(m['flow_rate'] for m in lane_metrics.values()) / len(lane_metrics)
-        avg_speed = np.mean([m['mean_speed'] for m in lane_metrics.values()])
-        
-        # Normalized reward components
-        waiting_penalty = -min(total_waiting / 180, 1) * 3    # Normalize by 3 minutes
-        queue_penalty = -min(total_queue / 20, 1) * 2         # Normalize by 20 vehicles
-        throughput_bonus = min(total_throughput / 300, 1) * 2 # Normalize by 300 flow
-        speed_bonus = min(avg_speed / 30, 1) * 1              # Normalize by 30 km/h
-        
-        # Switch penalty (discourage rapid switching)
-        switch_penalty = -0.1 if tls.time_since_last_switch < 10 else 0
-        
-        total_reward = (waiting_penalty + queue_penalty + 
-                       throughput_bonus + speed_bonus + switch_penalty)
-        
-        return total_reward
+        if lane_metrics is None:
+            lane_metrics = tls.get_lane_metrics_array(self.simulation_step)
+        return compute_reward(lane_metrics, tls.time_since_last_switch)
     
     def _update_all_metrics(self):
         """Update metrics for all TLS"""
         for tls in self.traffic_lights.values():
             # Sync current phase with SUMO's internal state (useful in default control mode)
-            try:
-                tls.current_phase = traci.trafficlight.getPhase(tls.tls_id)
-            except:
-                pass
+            phase = tls.tls_results.get(tc.TL_CURRENT_PHASE)
+            if phase is not None:
+                tls.current_phase = phase
+            else:
+                try:
+                    tls.current_phase = traci.trafficlight.getPhase(tls.tls_id)
+                except:
+                    pass
             
             tls.update_fairness_metrics(self.simulation_step)
             tls.time_since_last_switch += self.delta_time
     
     def _handle_emergency_switches(self):
         """Handle emergency switches"""
+        # Emergency switches are rate-limited by the cooldown and min green time
+        # anyway, so scan for starved lanes at most once per that interval
+        if not self.traffic_lights:
+            return
+        check_interval = min(min(tls.emergency_cooldown, tls.min_green_time)
+                             for tls in self.traffic_lights.values())
+        if self.simulation_step - self._last_emergency_check < check_interval:
+            return
+        self._last_emergency_check = self.simulation_step
+        
         for tls in self.traffic_lights.values():
             needs_emergency, emergency_phase = tls.needs_emergency_switch(self.simulation_step)
             if needs_emergency and emergency_phase is not None:
@@ -536,58 +724,51 @@ class AddisTargetedEnvironment(gym.Env):
     
     def _get_observation(self) -> np.ndarray:
         """Get observation with fixed dimensions"""
-        obs = np.zeros(607, dtype=np.float32)
-        obs_idx = 0
-        
-        # Process each targeted TLS (even if not initialized)
-        for tls_id in self.target_tls_ids:
-            if tls_id in self.traffic_lights:
-                tls = self.traffic_lights[tls_id]
+        obs = self._obs
+        obs.fill(0.0)
+        n_tls = len(self.target_tls_ids)
+        # Per-TLS blocks of 2 state features + 12*7 lane metrics, as a view into obs
+        tls_blocks = obs[:86 * n_tls].reshape(n_tls, 86)
+        
+        # Process each targeted TLS (even if not initialized); missing ones and, with
+        # none initialized, every TLS block stay zero
+        if self.traffic_lights:
+            metrics = self._metrics_tensor
+            metrics.fill(0.0)
+            for i, tls_id in enumerate(self.target_tls_ids):
+                tls = self.traffic_lights.get(tls_id)
+                if tls is None:
+                    continue
                 
                 # TLS state (2 features)
-                obs[obs_idx] = tls.current_phase / max(len(tls.phases), 1)
-                obs[obs_idx + 1] = min(tls.time_since_last_switch / 100, 1.0)
-                obs_idx += 2
-                
-                # Lane metrics (12 lanes * 7 metrics = 84 features)
-                lane_metrics = tls.get_lane_metrics()
-                lanes = list(lane_metrics.keys())[:12]
+                tls_blocks[i, 0] = tls.current_phase / max(len(tls.phases), 1)
+                tls_blocks[i, 1] = min(tls.time_since_last_switch / 100, 1.0)
                 
-                for i in range(12):
-                    if i < len(lanes):
-                        lane = lanes[i]
-                        m = lane_metrics[lane]
-                        obs[obs_idx:obs_idx+7] = [
-                            m['vehicle_count'] / 30,    # Normalized
-                            m['queue_length'] / 20,     # Normalized
-                            m['waiting_time'] / 180,    # Normalized
-                            m['mean_speed'] / 50,       # Normalized
-                            m['occupancy'],             # Already [0,1]
-                            m['density'] / 50,          # Normalized
-                            m['flow_rate'] / 300        # Normalized
-                        ]
-                    obs_idx += 7
-            else:
-                # Fill with zeros for missing TLS
-                obs_idx += 86  # 2 + 12*7
+                lane_metrics = tls.get_lane_metrics_array(self.simulation_step)[:12]
+                metrics[i, :len(lane_metrics)] = lane_metrics
+            
+            # Lane metrics (12 lanes * 7 metrics = 84 features per TLS), normalized
+            # in one broadcast over all TLS
+            np.divide(metrics, LANE_NORM, out=metrics)
+            tls_blocks[:, 2:] = metrics.reshape(n_tls, 84)
+        obs_idx = 86 * n_tls
         
         # Global metrics (5 features)
         try:
-            total_vehicles = min(traci.simulation.getMinExpectedNumber() / 1000, 1)
+            total_vehicles = min(self._min_expected_vehicles() / 1000, 1)
             progress = min(self.simulation_step / self.num_seconds, 1)
             emergency_rate = min(self.emergency_switches_total / 50, 1)
             
-            obs[obs_idx:obs_idx+5] = [
-                total_vehicles,
-                progress,
-                emergency_rate,
-                len(self.traffic_lights) / len(self.target_tls_ids),  # Initialization success rate
-                0  # Reserved
-            ]
+            obs[obs_idx] = total_vehicles
+            obs[obs_idx + 1] = progress
+            obs[obs_idx + 2] = emergency_rate
+            obs[obs_idx + 3] = len(self.traffic_lights) / len(self.target_tls_ids)  # Initialization success rate
+            # obs[obs_idx + 4] reserved, stays 0
         except:
-            obs[obs_idx:obs_idx+5] = [0, 0, 0, 0, 0]
+            obs[obs_idx:obs_idx+5] = 0
         
-        return obs
+        # Callers may keep observations across steps, so hand out a copy of the buffer
+        return obs.copy()
     
     def _get_info(self) -> dict:
         """Get environment info"""
@@ -601,13 +782,13 @@ class AddisTargetedEnvironment(gym.Env):
         }
         
         try:
-            info['total_vehicles'] = traci.simulation.getMinExpectedNumber()
+            info['total_vehicles'] = self._min_expected_vehicles()
             
             if self.traffic_lights:
                 total_waiting = 0
                 total_throughput = 0
                 for tls in self.traffic_lights.values():
-                    lane_metrics = tls.get_lane_metrics()
+                    lane_metrics = tls.get_lane_metrics(self.simulation_step)
                     total_waiting += sum(m['waiting_time'] for m in lane_metrics.values())
                     total_throughput += sum(m['flow_rate'] for m in lane_metrics.values())
                 
@@ -712,3 +893,25 @@ class SumoDefaultController:
             'avg_waiting_per_step': total_waiting / max(step_count, 1),
             'avg_throughput_per_step': total_throughput / max(step_count, 1)
         }
+
+def _run_baseline_episode(job) -> Dict[str, float]:
+    """Worker for run_episodes_parallel: one env, one controller, one episode"""
+    controller_cls, env_kwargs, controller_kwargs = job
+    env = AddisTargetedEnvironment(**env_kwargs)
+    try:
+        return controller_cls(env, **controller_kwargs).run_episode()
+    finally:
+        env.close()
+
+def run_episodes_parallel(controller_cls, env_kwargs: Dict[str, Any], n_episodes: int,
+                          n_workers: Optional[int] = None,
+                          controller_kwargs: Optional[Dict[str, Any]] = None) -> List[Dict[str, float]]:
+    """Run baseline episodes concurrently, one SUMO process per worker.
+    Each worker builds its own environment from env_kwargs; traci.start picks a
+    free port per process. Results are returned in episode order."""
+    from concurrent.futures import ProcessPoolExecutor
+    
+    jobs = [(controller_cls, env_kwargs, controller_kwargs or {})] * n_episodes
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, n_episodes))
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_run_baseline_episode, jobs))
@@ -21,10 +21,14 @@ import sys
 import numpy as np
 import pandas as pd
 from collections import defaultdict, deque
-from typing import Dict, List, Tuple, Optional, Any
+from functools import partial
+from typing import Dict, List, Set, Tuple, Optional, Any
 import gymnasium as gym
 from gymnasium import spaces
 import warnings
+import logging
+
+from numba_compat import njit
 
 # SUMO imports
 if 'SUMO_HOME' in os.environ:
@@ -33,9 +37,84 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("Please declare environment variable 'SUMO_HOME'")
 
-import traci
+# libsumo embeds SUMO in this process (same API, no socket round-trips) but has
+# no GUI; set LIBSUMO_AS_TRACI to use it for headless runs
+USE_LIBSUMO = bool(os.environ.get('LIBSUMO_AS_TRACI'))
+if USE_LIBSUMO:
+    try:
+        import libsumo as traci
+    except ImportError:
+        USE_LIBSUMO = False
+if not USE_LIBSUMO:
+    import traci
+import traci.constants as tc
 import sumolib
 
+logger = logging.getLogger(__name__)
+
+# Lane variables subscribed once per controlled lane, so each step's values
+# arrive with the simulationStep response rather than as separate getter calls
+LANE_VARS = [
+    tc.LAST_STEP_VEHICLE_NUMBER,
+    tc.LAST_STEP_VEHICLE_HALTING_NUMBER,
+    tc.LAST_STEP_MEAN_SPEED,
+    tc.VAR_WAITING_TIME,
+]
+
+# Per-lane metrics (columns of TrafficLightManager.metrics, get_lane_metrics keys)
+# and the scale each one is divided by before clipping to 1 in the observation
+LANE_METRICS = ('vehicle_count', 'queue_length', 'waiting_time', 'mean_speed',
+                'occupancy', 'density', 'flow_rate')
+LANE_OBS_SCALE = np.array([20, 10, 300, 15, 1, 100, 50], dtype=np.float64)
+
+@njit(cache=True)
+def phase_score(signal_green, link_signal, link_lane, metrics, last_green, sim_step, max_red_time):
+    """
+    Demand plus fairness score of one phase: sum over links whose signal is green
+    in signal_green and whose incoming lane has a metrics row (link_lane >= 0).
+    """
+    score = 0.0
+    for k in range(link_signal.shape[0]):
+        lane = link_lane[k]
+        if lane < 0 or not signal_green[link_signal[k]]:
+            continue
+        # Score based on demand and fairness
+        demand_score = metrics[lane, 1] * 2 + metrics[lane, 2] * 0.1 + metrics[lane, 0]
+        # Fairness bonus for lanes that haven't been green recently
+        fairness_bonus = min((sim_step - last_green[lane]) / max_red_time * 10, 20)
+        score += demand_score + fairness_bonus
+    return score
+
+@njit(cache=True)
+def phase_scores(phase_signal_green, phase_ids, link_signal, link_lane, metrics, last_green, sim_step, max_red_time):
+    """phase_score of every phase in phase_ids, in one compiled call"""
+    scores = np.empty(phase_ids.shape[0])
+    for p in range(phase_ids.shape[0]):
+        scores[p] = phase_score(phase_signal_green[phase_ids[p]], link_signal, link_lane,
+                                metrics, last_green, sim_step, max_red_time)
+    return scores
+
+@njit(cache=True)
+def first_starved_lane(last_green, current_time, green_mask, threshold, lane_best_phase):
+    """First non-green lane red for longer than threshold that some green phase serves; -1 if none"""
+    for i in range(last_green.shape[0]):
+        if not green_mask[i] and current_time - last_green[i] > threshold and lane_best_phase[i] >= 0:
+            return i
+    return -1
+
+def derive_lane_metrics(raw, has_length, occupancy_length, density_km, out):
+    """Fill out (n_lanes, 7) with the LANE_METRICS derived from raw (n_lanes, len(LANE_VARS)) lane values"""
+    vehicle_count, queue_length, mean_speed, waiting_time = raw.T
+    
+    # Calculate occupancy and density
+    occupancy = np.where(has_length, vehicle_count * 5.0 / occupancy_length, 0)  # Assume 5m per vehicle
+    density = np.where(has_length, vehicle_count / density_km, 0)  # vehicles per km
+    flow_rate = np.where(mean_speed > 0, vehicle_count * mean_speed, 0)
+    
+    out[:] = np.column_stack((
+        vehicle_count, queue_length, waiting_time, mean_speed, occupancy, density, flow_rate,
+    ))
+
 class TrafficLightManager:
     """Manages individual traffic lights with fairness constraints"""
     
@@ -53,29 +132,70 @@ class TrafficLightManager:
         self.phase_start_time = 0
         self.last_action_time = 0
         
-        # Fairness tracking
-        self.lane_last_green = defaultdict(lambda: -max_red_time)
-        self.lane_total_waiting_time = defaultdict(float)
-        self.lane_max_waiting_time = defaultdict(float)
-        
         # Performance metrics
         self.total_throughput = 0
         self.total_waiting_time = 0
         self.phase_switches = 0
         
+        # Static link topology: controlled links and the incoming lane of each link per signal index
+        self.controlled_links = self._get_controlled_links()
+        self.signal_lanes = [[link[0] for link in link_list] for link_list in self.controlled_links]
+        
         # Get controlled lanes
         self.controlled_lanes = self._get_controlled_lanes()
         self.green_phases = self._identify_green_phases()
-        
+        self.lane_best_phase = self._build_lane_best_phase()
+        
+        # Fairness tracking - parallel arrays indexed like controlled_lanes
+        self.lane_index = {lane: i for i, lane in enumerate(self.controlled_lanes)}
+        n_lanes = len(self.controlled_lanes)
+        self.lane_best_phase_ids = np.array([self.lane_best_phase.get(lane, -1) for lane in self.controlled_lanes],
+                                            dtype=np.int64)
+        
+        # Every controlled link flattened: its signal index and its incoming lane's row (-1 if not controlled)
+        links = [(signal, self.lane_index.get(lane, -1))
+                 for signal, signal_lanes in enumerate(self.signal_lanes) for lane in signal_lanes]
+        self.link_signal = np.array([signal for signal, _ in links], dtype=np.int64)
+        self.link_lane = np.array([lane_idx for _, lane_idx in links], dtype=np.int64)
+        
+        # Phase programs are static: green signal indices of every phase, computed once
+        self.phase_signal_green = np.zeros((len(self.phases), len(self.controlled_links)), dtype=bool)
+        for phase_idx, phase in enumerate(self.phases):
+            self.phase_signal_green[phase_idx] = self.signal_green(phase.state)
+        self.green_phase_ids = np.array(self.green_phases, dtype=np.int64)
+        
+        self.lane_last_green = np.full(n_lanes, -max_red_time, dtype=np.int32)
+        self.lane_total_waiting_time = np.zeros(n_lanes, dtype=np.float64)
+        self.lane_max_waiting_time = np.zeros(n_lanes, dtype=np.float64)
+        
+        # Subscription results for the current step, handed in by the environment;
+        # tls_state is None until the next step after a phase was set
+        self.lane_lengths = {}
+        self.lane_results = {}
+        self.tls_state = None
+        self._subscribe()
+        
+        # This step's raw LANE_VARS values and derived LANE_METRICS, one row per controlled lane;
+        # filled once per step by refresh_metrics() and shared by every consumer
+        self.lane_raw = np.zeros((n_lanes, len(LANE_VARS)))
+        self.metrics = np.zeros((n_lanes, len(LANE_METRICS)))
+        
+    def _get_controlled_links(self) -> List:
+        """Fetch the controlled links once; they don't change during a simulation"""
+        try:
+            return traci.trafficlight.getControlledLinks(self.tls_id)
+        except Exception as e:
+            print(f"Warning: Could not get controlled links for {self.tls_id}: {e}")
+            return []
+    
     def _get_controlled_lanes(self) -> List[str]:
         """Get all lanes controlled by this traffic light"""
         try:
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
             lanes = []
-            for link_list in controlled_links:
-                for link in link_list:
-                    if link[0] and link[0] not in lanes:  # incoming lane
-                        lanes.append(link[0])
+            for signal_lanes in self.signal_lanes:
+                for lane in signal_lanes:
+                    if lane and lane not in lanes:  # incoming lane
+                        lanes.append(lane)
             
             # If no lanes found through links, try alternative approach
             if not lanes:
@@ -97,6 +217,40 @@ class TrafficLightManager:
             print(f"Warning: Could not get controlled lanes for {self.tls_id}: {e}")
             return []
     
+    def _subscribe(self):
+        """Subscribe to this light's signal state and its lanes' metrics; cache lane lengths"""
+        try:
+            traci.trafficlight.subscribe(self.tls_id, [tc.TL_RED_YELLOW_GREEN_STATE])
+        except Exception as e:
+            print(f"Warning: Could not subscribe to traffic light {self.tls_id}: {e}")
+        for lane in self.controlled_lanes:
+            try:
+                traci.lane.subscribe(lane, LANE_VARS)
+                self.lane_lengths[lane] = traci.lane.getLength(lane)
+            except Exception as e:
+                print(f"Warning: Could not subscribe to lane {lane}: {e}")
+        self.lane_length_array = np.array([self.lane_lengths.get(lane, 0.0) for lane in self.controlled_lanes])
+        # Lane lengths are static, so the occupancy and density divisors are derived once here;
+        # lanes without a length report zero occupancy and density
+        self.lane_has_length = self.lane_length_array > 0
+        self.lane_occupancy_length = np.where(self.lane_has_length, self.lane_length_array, 1.0)
+        self.lane_density_km = self.lane_occupancy_length / 1000
+        # Lanes that failed here are never read on the step path; their metric rows stay zero
+        self.lane_valid = np.array([lane in self.lane_lengths for lane in self.controlled_lanes], dtype=bool)
+    
+    def _lane_values(self, lane: str) -> Dict[int, float]:
+        """LANE_VARS values of a lane for the current step"""
+        values = self.lane_results.get(lane)
+        if not values:
+            # No subscription results yet (observation right after reset)
+            values = {
+                tc.LAST_STEP_VEHICLE_NUMBER: traci.lane.getLastStepVehicleNumber(lane),
+                tc.LAST_STEP_VEHICLE_HALTING_NUMBER: traci.lane.getLastStepHaltingNumber(lane),
+                tc.LAST_STEP_MEAN_SPEED: traci.lane.getLastStepMeanSpeed(lane),
+                tc.VAR_WAITING_TIME: traci.lane.getWaitingTime(lane),
+            }
+        return values
+    
     def _identify_green_phases(self) -> List[int]:
         """Identify which phases are green (non-yellow, non-red)"""
         green_phases = []
@@ -113,99 +267,87 @@ class TrafficLightManager:
     
     def needs_emergency_switch(self, current_time: int) -> Tuple[bool, Optional[int]]:
         """Check if any lane needs emergency switch due to starvation"""
-        current_green_lanes = self._get_current_green_lanes()
-        
-        for lane in self.controlled_lanes:
-            if lane not in current_green_lanes:
-                time_since_green = current_time - self.lane_last_green[lane]
-                if time_since_green > self.max_red_time:
-                    # Find best phase for this starved lane
-                    best_phase = self._find_best_phase_for_lane(lane)
-                    if best_phase is not None:
-                        return True, best_phase
+        # First starved lane that a green phase can serve
+        starved = first_starved_lane(self.lane_last_green, current_time, self._current_green_mask(),
+                                     self.max_red_time, self.lane_best_phase_ids)
+        if starved >= 0:
+            return True, int(self.lane_best_phase_ids[starved])
         
         return False, None
     
-    def _get_current_green_lanes(self) -> List[str]:
+    def _current_state(self) -> str:
+        """Current signal state string, from this step's subscription when available"""
+        if self.tls_state is not None:
+            return self.tls_state
+        return traci.trafficlight.getRedYellowGreenState(self.tls_id)
+    
+    def _get_current_green_lanes(self) -> Set[str]:
         """Get lanes that are currently green"""
-        try:
-            current_state = traci.trafficlight.getRedYellowGreenState(self.tls_id)
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            
-            green_lanes = []
-            for i, (state_char, link_list) in enumerate(zip(current_state, controlled_links)):
+        current_state = self._current_state()
+        
+        green_lanes = set()
+        for state_char, signal_lanes in zip(current_state, self.signal_lanes):
+            if state_char in ['G', 'g']:
+                green_lanes.update(signal_lanes)
+        return green_lanes
+    
+    def signal_green(self, state: str) -> np.ndarray:
+        """Boolean per signal index (controlled link list) that is green in a signal state string"""
+        green = np.zeros(len(self.controlled_links), dtype=bool)
+        chars = np.frombuffer(state[:len(green)].encode('ascii'), dtype=np.uint8)
+        green[:len(chars)] = (chars == ord('G')) | (chars == ord('g'))
+        return green
+    
+    def _current_green_mask(self) -> np.ndarray:
+        """Boolean mask over controlled_lanes of the lanes that are currently green"""
+        green_mask = np.zeros(len(self.controlled_lanes), dtype=bool)
+        signal_green = self.signal_green(self._current_state())
+        green_links = (self.link_lane >= 0) & signal_green[self.link_signal]
+        green_mask[self.link_lane[green_links]] = True
+        return green_mask
+    
+    def starvation_times(self, current_time: int) -> np.ndarray:
+        """Time since each controlled lane was last green; 0 for lanes that are green now"""
+        return np.where(self._current_green_mask(), 0, current_time - self.lane_last_green)
+    
+    def _build_lane_best_phase(self) -> Dict[str, int]:
+        """Map each lane to the first green phase that gives it green"""
+        lane_best_phase = {}
+        for phase_idx in self.green_phases:
+            phase_state = self.phases[phase_idx].state
+            for state_char, signal_lanes in zip(phase_state, self.signal_lanes):
                 if state_char in ['G', 'g']:
-                    for link in link_list:
-                        if link[0] not in green_lanes:
-                            green_lanes.append(link[0])
-            return green_lanes
-        except:
-            return []
+                    for lane in signal_lanes:
+                        lane_best_phase.setdefault(lane, phase_idx)
+        return lane_best_phase
     
     def _find_best_phase_for_lane(self, lane: str) -> Optional[int]:
         """Find the best green phase for a specific lane"""
-        try:
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            
-            for phase_idx in self.green_phases:
-                phase_state = self.phases[phase_idx].state
-                for i, (state_char, link_list) in enumerate(zip(phase_state, controlled_links)):
-                    if state_char in ['G', 'g']:
-                        for link in link_list:
-                            if link[0] == lane:
-                                return phase_idx
-            return None
-        except:
-            return None
+        return self.lane_best_phase.get(lane)
+    
+    def refresh_metrics(self):
+        """Read this step's lane values once and derive the per-lane metrics array"""
+        raw = self.lane_raw  # Filled in place: may be a view into the environment's stacked array
+        for i, lane in enumerate(self.controlled_lanes):
+            if self.lane_valid[i]:
+                values = self._lane_values(lane)
+                raw[i] = [values[var] for var in LANE_VARS]
+        derive_lane_metrics(raw, self.lane_has_length, self.lane_occupancy_length, self.lane_density_km,
+                            self.metrics)
     
     def get_lane_metrics(self) -> Dict[str, Dict[str, float]]:
         """Get comprehensive metrics for each controlled lane"""
-        metrics = {}
-        
-        for lane in self.controlled_lanes:
-            try:
-                # Basic traffic metrics
-                vehicle_count = traci.lane.getLastStepVehicleNumber(lane)
-                queue_length = traci.lane.getLastStepHaltingNumber(lane)
-                mean_speed = traci.lane.getLastStepMeanSpeed(lane)
-                waiting_time = traci.lane.getWaitingTime(lane)
-                
-                # Calculate occupancy and density
-                lane_length = traci.lane.getLength(lane)
-                occupancy = vehicle_count * 5.0 / lane_length if lane_length > 0 else 0  # Assume 5m per vehicle
-                
-                metrics[lane] = {
-                    'vehicle_count': vehicle_count,
-                    'queue_length': queue_length,
-                    'waiting_time': waiting_time,
-                    'mean_speed': mean_speed,
-                    'occupancy': occupancy,
-                    'density': vehicle_count / (lane_length / 1000) if lane_length > 0 else 0,  # vehicles per km
-                    'flow_rate': vehicle_count * mean_speed if mean_speed > 0 else 0
-                }
-            except:
-                metrics[lane] = {
-                    'vehicle_count': 0, 'queue_length': 0, 'waiting_time': 0,
-                    'mean_speed': 0, 'occupancy': 0, 'density': 0, 'flow_rate': 0
-                }
-        
-        return metrics
+        return {lane: dict(zip(LANE_METRICS, row))
+                for lane, row in zip(self.controlled_lanes, self.metrics.tolist())}
     
     def update_fairness_metrics(self, current_time: int):
         """Update fairness tracking metrics"""
-        current_green_lanes = self._get_current_green_lanes()
+        self.lane_last_green[self._current_green_mask()] = current_time
         
-        for lane in self.controlled_lanes:
-            if lane in current_green_lanes:
-                self.lane_last_green[lane] = current_time
-            
-            # Update waiting time metrics
-            try:
-                waiting_time = traci.lane.getWaitingTime(lane)
-                self.lane_total_waiting_time[lane] += waiting_time
-                self.lane_max_waiting_time[lane] = max(self.lane_max_waiting_time[lane], waiting_time)
-            except:
-                pass
+        # Update waiting time metrics
+        waiting_times = self.lane_raw[:, LANE_VARS.index(tc.VAR_WAITING_TIME)]
+        self.lane_total_waiting_time += waiting_times
+        np.maximum(self.lane_max_waiting_time, waiting_times, out=self.lane_max_waiting_time)
 
 
 class AddisTrafficEnvironment(gym.Env):
@@ -241,8 +383,17 @@ class AddisTrafficEnvironment(gym.Env):
         # Environment state
         self.simulation_step = 0
         self.traffic_lights = {}
-        self.metrics_history = []
-        self.episode_metrics = defaultdict(list)
+        # Light ids and managers in control order, cached by _detect_traffic_lights for the episode
+        self._tls_list: Tuple[str, ...] = ()
+        self._tls_objs: Tuple[TrafficLightManager, ...] = ()
+        # Per-step history is bounded to one episode of agent steps so long runs don't grow it
+        self.history_length = max(1, num_seconds // delta_time)
+        self.metrics_history = deque(maxlen=self.history_length)
+        self.episode_metrics = defaultdict(partial(deque, maxlen=self.history_length))
+        
+        # Lane arrays of all traffic lights stacked; each manager's lane_raw/metrics are views into these
+        self.all_lane_raw = np.zeros((0, len(LANE_VARS)))
+        self.all_lane_metrics = np.zeros((0, len(LANE_METRICS)))
         
         # Performance tracking
         self.baseline_metrics = None
@@ -250,6 +401,9 @@ class AddisTrafficEnvironment(gym.Env):
         self.total_throughput = 0
         self.total_waiting_time = 0
         
+        # Most recent emergency switches as (step, tls_id, phase)
+        self.emergency_log = deque(maxlen=1000)
+        
         # Initialize RL interface with fallback spaces
         # These will be updated properly during first reset
         self.actual_obs_dim = 0  # Will be set during first reset
@@ -268,11 +422,20 @@ class AddisTrafficEnvironment(gym.Env):
             low=0.0, high=1.0, shape=(3700,), dtype=np.float32
         )
         
+        # Observation buffers reused by every _get_observation call: the output vector and the
+        # float64 staging vector of raw features, with the scale of every feature
+        # (laid out per episode by _setup_observation_space)
+        self._obs_buf = np.zeros(3700, dtype=np.float32)
+        self._obs_raw = np.zeros(3700)
+        self._obs_scale = np.ones(3700)
+        
     def _start_sumo(self):
         """Start SUMO simulation"""
         sumo_cmd = []
         
-        if self.use_gui:
+        if self.use_gui and USE_LIBSUMO:
+            print("libsumo cannot run the SUMO GUI; simulating headless")
+        if self.use_gui and not USE_LIBSUMO:
             sumo_cmd = ["sumo-gui"]
         else:
             sumo_cmd = ["sumo"]
@@ -327,6 +490,34 @@ class AddisTrafficEnvironment(gym.Env):
         except Exception as e:
             print(f"Error detecting traffic lights: {e}")
             self.traffic_lights = {}
+        
+        self._tls_list = tuple(self.traffic_lights.keys())
+        self._tls_objs = tuple(self.traffic_lights.values())
+        self._stack_lane_arrays()
+    
+    def _stack_lane_arrays(self):
+        """Back every light's lane arrays with one env-wide array so global reductions need no concatenation"""
+        lights = self._tls_objs
+        lane_counts = [len(tls.controlled_lanes) for tls in lights]
+        self.all_lane_raw = np.zeros((sum(lane_counts), len(LANE_VARS)))
+        self.all_lane_metrics = np.zeros((sum(lane_counts), len(LANE_METRICS)))
+        
+        start = 0
+        for tls, n_lanes in zip(lights, lane_counts):
+            tls.lane_raw = self.all_lane_raw[start:start + n_lanes]
+            tls.metrics = self.all_lane_metrics[start:start + n_lanes]
+            start += n_lanes
+        
+        # Flat lane index over the stacked rows: lane id and (owning light, local index) of each row,
+        # plus the static length divisors in the same order, so metrics are refreshed in one pass
+        self.all_lanes = [lane for tls in lights for lane in tls.controlled_lanes]
+        self.lane_owner = [(tls, i) for tls in lights for i in range(len(tls.controlled_lanes))]
+        self.all_lane_has_length = np.concatenate(
+            [np.zeros(0, dtype=bool)] + [tls.lane_has_length for tls in lights])
+        self.all_lane_occupancy_length = np.concatenate(
+            [np.zeros(0, dtype=np.float64)] + [tls.lane_occupancy_length for tls in lights])
+        self.all_lane_density_km = np.concatenate(
+            [np.zeros(0, dtype=np.float64)] + [tls.lane_density_km for tls in lights])
     
     def _setup_action_space(self):
         """Setup action space for all traffic lights"""
@@ -361,6 +552,25 @@ class AddisTrafficEnvironment(gym.Env):
         
         # Store the actual observation dimension for padding purposes
         self.actual_obs_dim = obs_dim
+        if obs_dim > len(self._obs_buf):
+            # Room for every feature; the observation is truncated to the space when returned
+            self._obs_buf = np.zeros(obs_dim, dtype=np.float32)
+            self._obs_raw = np.zeros(obs_dim)
+            self._obs_scale = np.ones(obs_dim)
+        
+        # Scale of every feature, so the raw vector is normalized in one pass: phase index
+        # by the light's phase count, time since switch, lane metrics and global metrics
+        scale = self._obs_scale
+        scale.fill(1)
+        idx = 0
+        for tls in self.traffic_lights.values():
+            scale[idx] = len(tls.phases) or 1
+            scale[idx + 1] = 100
+            idx += 2
+            n = tls.metrics.size
+            scale[idx:idx + n] = np.tile(LANE_OBS_SCALE, n // len(LANE_OBS_SCALE))
+            idx += n
+        scale[idx:idx + 4] = [1000, 1000, self.num_seconds, 100]
         
         # DON'T update observation_space after initialization to maintain stable-baselines3 compatibility
     
@@ -368,11 +578,8 @@ class AddisTrafficEnvironment(gym.Env):
         """Reset the environment"""
         super().reset(seed=seed)
         
-        try:
-            if traci.isLoaded():
-                traci.close()
-        except:
-            pass
+        if traci.isLoaded():
+            traci.close()
         
         self._start_sumo()
         
@@ -388,13 +595,15 @@ class AddisTrafficEnvironment(gym.Env):
         self.episode_reward = 0
         self.total_throughput = 0
         self.total_waiting_time = 0
-        self.metrics_history = []
+        self.metrics_history = deque(maxlen=self.history_length)
+        self.emergency_log.clear()
         
         # Initialize traffic light states
         for tls in self.traffic_lights.values():
             tls.phase_start_time = 0
             tls.time_since_last_switch = 0
         
+        self._refresh_subscriptions()
         observation = self._get_observation()
         info = self._get_info()
         
@@ -407,13 +616,7 @@ class AddisTrafficEnvironment(gym.Env):
         
         # Execute actions for each traffic light
         rewards = []
-        tls_list = list(self.traffic_lights.keys())
-        
-        for i, (tls_id, action) in enumerate(zip(tls_list, actions)):
-            if tls_id not in self.traffic_lights:
-                continue
-                
-            tls = self.traffic_lights[tls_id]
+        for tls, action in zip(self._tls_objs, actions):
             reward = self._execute_action(tls, action)
             rewards.append(reward)
         
@@ -421,10 +624,10 @@ class AddisTrafficEnvironment(gym.Env):
         for _ in range(self.delta_time):
             traci.simulationStep()
             self.simulation_step += 1
+        self._refresh_subscriptions()
         
-        # Update metrics and check for emergency switches
+        # Update metrics; starvation is handled by the emergency check in _execute_action
         self._update_all_metrics()
-        self._check_emergency_switches()
         
         observation = self._get_observation()
         total_reward = np.mean(rewards) if rewards else 0
@@ -438,6 +641,22 @@ class AddisTrafficEnvironment(gym.Env):
         
         return observation, total_reward, done, False, info
     
+    def _refresh_subscriptions(self):
+        """Hand this step's lane and signal subscription results to every traffic light"""
+        lane_results = traci.lane.getAllSubscriptionResults()
+        tls_results = traci.trafficlight.getAllSubscriptionResults()
+        for tls_id, tls in zip(self._tls_list, self._tls_objs):
+            tls.lane_results = lane_results
+            tls.tls_state = tls_results.get(tls_id, {}).get(tc.TL_RED_YELLOW_GREEN_STATE)
+        
+        # Read every controlled lane through the flat lane index, then derive all lights' metrics at once
+        raw = self.all_lane_raw
+        for row, (tls, i) in enumerate(self.lane_owner):
+            if tls.lane_valid[i]:
+                values = tls._lane_values(self.all_lanes[row])
+                raw[row] = [values[var] for var in LANE_VARS]
+        derive_lane_metrics(raw, self.all_lane_has_length, self.all_lane_occupancy_length, self.all_lane_density_km, self.all_lane_metrics)
+    
     def _execute_action(self, tls: TrafficLightManager, action: int) -> float:
         """Execute action for a specific traffic light"""
         old_phase = tls.current_phase
@@ -451,6 +670,8 @@ class AddisTrafficEnvironment(gym.Env):
             if tls.can_switch_phase(self.simulation_step):
                 self._switch_to_phase(tls, emergency_phase)
                 reward += 10  # Bonus for preventing starvation
+                self.emergency_log.append((self.simulation_step, tls.tls_id, emergency_phase))
+                logger.debug("Emergency switch for %s to phase %s", tls.tls_id, emergency_phase)
         elif action == 1 and tls.can_switch_phase(self.simulation_step):
             # Regular phase switch
             next_phase = self._get_next_optimal_phase(tls)
@@ -466,6 +687,7 @@ class AddisTrafficEnvironment(gym.Env):
         """Switch traffic light to target phase"""
         try:
             traci.trafficlight.setPhase(tls.tls_id, target_phase)
+            tls.tls_state = None  # The new state only shows in subscriptions after the next step
             tls.current_phase = target_phase
             tls.phase_start_time = self.simulation_step
             tls.time_since_last_switch = 0
@@ -475,65 +697,35 @@ class AddisTrafficEnvironment(gym.Env):
     
     def _get_next_optimal_phase(self, tls: TrafficLightManager) -> int:
         """Get the optimal next phase based on traffic demand"""
-        lane_metrics = tls.get_lane_metrics()
-        
         best_phase = tls.current_phase
-        best_score = -float('inf')
         
-        for phase_idx in tls.green_phases:
-            if phase_idx == tls.current_phase:
-                continue
-                
-            score = self._evaluate_phase_score(tls, phase_idx, lane_metrics)
-            
-            if score > best_score:
-                best_score = score
-                best_phase = phase_idx
+        # Score every other green phase in one kernel call; the first best score wins
+        candidates = tls.green_phase_ids[tls.green_phase_ids != tls.current_phase]
+        if len(candidates):
+            scores = phase_scores(tls.phase_signal_green, candidates, tls.link_signal, tls.link_lane,
+                                  tls.metrics, tls.lane_last_green, self.simulation_step, tls.max_red_time)
+            best_phase = int(candidates[scores.argmax()])
         
         return best_phase
     
-    def _evaluate_phase_score(self, tls: TrafficLightManager, phase_idx: int, 
-                             lane_metrics: Dict) -> float:
+    def _evaluate_phase_score(self, tls: TrafficLightManager, phase_idx: int) -> float:
         """Evaluate the desirability of a phase based on current traffic"""
-        score = 0
-        
-        try:
-            phase_state = tls.phases[phase_idx].state
-            controlled_links = traci.trafficlight.getControlledLinks(tls.tls_id)
-            
-            for i, (state_char, link_list) in enumerate(zip(phase_state, controlled_links)):
-                if state_char in ['G', 'g']:
-                    for link in link_list:
-                        lane = link[0]
-                        if lane in lane_metrics:
-                            metrics = lane_metrics[lane]
-                            # Score based on demand and fairness
-                            demand_score = (metrics['queue_length'] * 2 + 
-                                          metrics['waiting_time'] * 0.1 +
-                                          metrics['vehicle_count'])
-                            
-                            # Fairness bonus for lanes that haven't been green recently
-                            time_since_green = self.simulation_step - tls.lane_last_green[lane]
-                            fairness_bonus = min(time_since_green / tls.max_red_time * 10, 20)
-                            
-                            score += demand_score + fairness_bonus
-        except Exception as e:
-            print(f"Error evaluating phase score: {e}")
-        
-        return score
+        return phase_score(tls.phase_signal_green[phase_idx],
+                           tls.link_signal, tls.link_lane, tls.metrics,
+                           tls.lane_last_green, self.simulation_step, tls.max_red_time)
     
     def _calculate_reward(self, tls: TrafficLightManager) -> float:
         """Calculate reward for a traffic light's current state"""
-        lane_metrics = tls.get_lane_metrics()
-        
-        if not lane_metrics:
+        if not len(tls.metrics):
             return 0
         
+        vehicle_count, queue_length, waiting_time, mean_speed, occupancy, density, flow_rate = tls.metrics.T
+        
         # Efficiency metrics
-        total_waiting_time = sum(m['waiting_time'] for m in lane_metrics.values())
-        total_queue_length = sum(m['queue_length'] for m in lane_metrics.values())
-        total_throughput = sum(m['flow_rate'] for m in lane_metrics.values())
-        avg_speed = np.mean([m['mean_speed'] for m in lane_metrics.values()])
+        total_waiting_time = waiting_time.sum()
+        total_queue_length = queue_length.sum()
+        total_throughput = flow_rate.sum()
+        avg_speed = mean_speed.mean()
         
         # Base reward: minimize waiting and queues, maximize throughput
         efficiency_reward = (
@@ -544,20 +736,14 @@ class AddisTrafficEnvironment(gym.Env):
         )
         
         # Fairness penalty: penalize high variance in waiting times
-        waiting_times = [m['waiting_time'] for m in lane_metrics.values()]
-        if len(waiting_times) > 1:
-            fairness_penalty = -np.var(waiting_times) * 0.001
+        if len(waiting_time) > 1:
+            fairness_penalty = -np.var(waiting_time) * 0.001
         else:
             fairness_penalty = 0
         
         # Starvation penalty
-        starvation_penalty = 0
-        current_green_lanes = tls._get_current_green_lanes()
-        for lane in tls.controlled_lanes:
-            if lane not in current_green_lanes:
-                time_since_green = self.simulation_step - tls.lane_last_green[lane]
-                if time_since_green > tls.max_red_time * 0.8:  # 80% of max red time
-                    starvation_penalty -= 5
+        starvation = tls.starvation_times(self.simulation_step)
+        starvation_penalty = -5 * int(np.count_nonzero(starvation > tls.max_red_time * 0.8))  # 80% of max red time
         
         # Phase switching penalty (to avoid excessive switching)
         switch_penalty = -0.1 if tls.time_since_last_switch < tls.min_green_time else 0
@@ -569,18 +755,10 @@ class AddisTrafficEnvironment(gym.Env):
     
     def _update_all_metrics(self):
         """Update metrics for all traffic lights"""
-        for tls in self.traffic_lights.values():
+        for tls in self._tls_objs:
             tls.update_fairness_metrics(self.simulation_step)
             tls.time_since_last_switch += self.delta_time
     
-    def _check_emergency_switches(self):
-        """Check for and handle emergency switches due to starvation"""
-        for tls in self.traffic_lights.values():
-            needs_emergency, emergency_phase = tls.needs_emergency_switch(self.simulation_step)
-            if needs_emergency and emergency_phase is not None:
-                print(f"Emergency switch for {tls.tls_id} to phase {emergency_phase}")
-                self._switch_to_phase(tls, emergency_phase)
-    
     def _get_observation(self) -> np.ndarray:
         """Get current observation state"""
         # Handle case when environment hasn't been properly reset yet
@@ -588,58 +766,43 @@ class AddisTrafficEnvironment(gym.Env):
             # Return zero observation matching the current observation space
             return np.zeros(self.observation_space.shape, dtype=np.float32)
         
-        obs = []
+        raw = self._obs_raw
+        raw.fill(0)  # Unused trailing features stay zero (fallback space padding)
+        idx = 0
         
-        for tls_id, tls in self.traffic_lights.items():
+        for tls in self._tls_objs:
             # Traffic light state
-            obs.extend([
-                tls.current_phase / len(tls.phases) if tls.phases else 0,
-                min(tls.time_since_last_switch / 100, 1.0)  # Normalized time since switch
-            ])
+            raw[idx] = tls.current_phase if tls.phases else 0
+            raw[idx + 1] = tls.time_since_last_switch
+            idx += 2
             
             # Lane metrics
-            lane_metrics = tls.get_lane_metrics()
-            for lane in tls.controlled_lanes:
-                if lane in lane_metrics:
-                    metrics = lane_metrics[lane]
-                    obs.extend([
-                        min(metrics['vehicle_count'] / 20, 1.0),  # Normalized
-                        min(metrics['queue_length'] / 10, 1.0),
-                        min(metrics['waiting_time'] / 300, 1.0),
-                        min(metrics['mean_speed'] / 15, 1.0),
-                        min(metrics['occupancy'], 1.0),
-                        min(metrics['density'] / 100, 1.0),
-                        min(metrics['flow_rate'] / 50, 1.0)
-                    ])
-                else:
-                    obs.extend([0.0] * 7)
+            raw[idx:idx + tls.metrics.size] = tls.metrics.ravel()
+            idx += tls.metrics.size
         
         # Global metrics
-        try:
-            total_vehicles = traci.simulation.getDepartedNumber()
-            total_arrived = traci.simulation.getArrivedNumber()
-            avg_travel_time = traci.simulation.getCollisions()  # Placeholder
-            
-            obs.extend([
-                min(total_vehicles / 1000, 1.0),
-                min(total_arrived / 1000, 1.0),
-                min(self.simulation_step / self.num_seconds, 1.0),
-                min(len(self.traffic_lights) / 100, 1.0),
-                0.0  # Placeholder for additional global metric
-            ])
-        except:
-            obs.extend([0.0] * 5)
-        
-        # Ensure observation matches expected dimension (fallback space)
-        expected_dim = self.observation_space.shape[0]
-        if len(obs) < expected_dim:
-            # Pad with zeros
-            obs.extend([0.0] * (expected_dim - len(obs)))
-        elif len(obs) > expected_dim:
-            # Truncate (should not happen with our generous fallback)
-            obs = obs[:expected_dim]
-        
-        return np.array(obs, dtype=np.float32)
+        total_vehicles = traci.simulation.getDepartedNumber()
+        total_arrived = traci.simulation.getArrivedNumber()
+        avg_travel_time = traci.simulation.getCollisions()  # Placeholder
+        
+        raw[idx:idx + 5] = [
+            total_vehicles,
+            total_arrived,
+            self.simulation_step,
+            len(self.traffic_lights),
+            0.0  # Placeholder for additional global metric
+        ]
+        
+        # Scale and cap every feature in one vectorized pass
+        np.divide(raw, self._obs_scale, out=raw)
+        np.minimum(raw, 1.0, out=raw)
+        obs = self._obs_buf
+        obs[:] = raw
+        
+        # Ensure observation matches expected dimension (fallback space); truncation
+        # should not happen with our generous fallback. Copied out of the reused buffer
+        # so callers (e.g. SB3's terminal_observation) can keep it
+        return obs[:self.observation_space.shape[0]].copy()
     
     def _get_info(self) -> Dict:
         """Get info dictionary for logging and analysis"""
@@ -657,19 +820,9 @@ class AddisTrafficEnvironment(gym.Env):
             info['total_arrived'] = traci.simulation.getArrivedNumber()
             
             # Calculate aggregated metrics
-            total_waiting = 0
-            total_speed = 0
-            lane_count = 0
-            
-            for tls in self.traffic_lights.values():
-                lane_metrics = tls.get_lane_metrics()
-                for metrics in lane_metrics.values():
-                    total_waiting += metrics['waiting_time']
-                    total_speed += metrics['mean_speed']
-                    lane_count += 1
-            
-            info['total_waiting_time'] = total_waiting
-            info['avg_speed'] = total_speed / lane_count if lane_count > 0 else 0
+            lane_metrics = self.all_lane_metrics
+            info['total_waiting_time'] = float(lane_metrics[:, LANE_METRICS.index('waiting_time')].sum())
+            info['avg_speed'] = float(lane_metrics[:, LANE_METRICS.index('mean_speed')].mean()) if len(lane_metrics) else 0
             
         except Exception as e:
             print(f"Error calculating info metrics: {e}")
@@ -678,17 +831,46 @@ class AddisTrafficEnvironment(gym.Env):
     
     def close(self):
         """Close the environment"""
-        try:
-            if traci.isLoaded():
-                traci.close()
-        except:
-            pass
+        if traci.isLoaded():
+            traci.close()
     
     def render(self, mode='human'):
         """Render the environment (SUMO GUI handles this)"""
         pass
 
 
+def make_parallel_env(env_kwargs: Dict[str, Any], n_envs: Optional[int] = None,
+                      normalize: bool = False, stats_path: Optional[str] = None,
+                      env_cls: Optional[type] = None):
+    """Vectorized copies of env_cls (this module's environment by default) for SB3
+    training, one SUMO process per copy.
+    Each SubprocVecEnv worker imports traci (or libsumo) on its own and traci.start
+    picks a free port, so copies never share a connection; the VecEnv resets only the
+    copies that finished an episode.
+    
+    With normalize, the returned env is a single VecNormalize keeping the running
+    observation statistics of the whole batch. Save them next to the model after
+    training with vec_env.save("vec_normalize.pkl"), and evaluate with the same
+    statistics by passing stats_path="vec_normalize.pkl": they are loaded with
+    VecNormalize.load and frozen (training=False) so evaluation doesn't update them."""
+    from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv, VecNormalize
+    
+    if stats_path is not None and not normalize:
+        raise ValueError("stats_path holds VecNormalize statistics and requires normalize=True")
+    
+    n_envs = max(1, n_envs or os.cpu_count() or 1)
+    if n_envs > 1:
+        env_kwargs = dict(env_kwargs, use_gui=False)  # One GUI per worker is never wanted
+    env_fns = [partial(env_cls or AddisTrafficEnvironment, **env_kwargs)] * n_envs
+    vec_env = SubprocVecEnv(env_fns) if n_envs > 1 else DummyVecEnv(env_fns)
+    if stats_path is not None:
+        vec_env = VecNormalize.load(stats_path, vec_env)
+        vec_env.training = False
+    elif normalize:
+        vec_env = VecNormalize(vec_env, norm_obs=True, norm_reward=False)
+    return vec_env
+
+
 if __name__ == "__main__":
     # Test the environment
     env = AddisTrafficEnvironment(
@@ -258,12 +258,8 @@ class ModelEvaluator:
                     fairness_data['lane_waiting_times'][lane].append(metrics['waiting_time'])
                 
                 # Check for starvation
-                current_green_lanes = tls._get_current_green_lanes()
-                for lane in tls.controlled_lanes:
-                    if lane not in current_green_lanes:
-                        time_since_green = self.env.simulation_step - tls.lane_last_green[lane]
-                        if time_since_green > tls.max_red_time * 0.9:  # 90% of max red time
-                            fairness_data['starvation_events'] += 1
+                starvation = tls.starvation_times(self.env.simulation_step)
+                fairness_data['starvation_events'] += int(np.count_nonzero(starvation > tls.max_red_time * 0.9))  # 90% of max red time
             
             step_count += 1
             if done:
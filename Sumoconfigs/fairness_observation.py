@@ -15,6 +15,35 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'sumo-rl'))
 from sumo_rl.environment.observations import ObservationFunction
 
 
+def cache_per_step(ts, *names):
+    """
+    Make the named TrafficSignal queries hit SUMO at most once per simulation step.
+    
+    The fairness reward and SUMO-RL's per-agent info both read the queue and waiting
+    times of every signal each step; with the cache the second reader gets the first
+    reader's result instead of repeating the per-lane TraCI calls.
+    
+    Args:
+        ts: TrafficSignal instance from SUMO-RL
+        *names: Names of argument-free query methods of ts
+    """
+    for name in names:
+        setattr(ts, name, _once_per_step(ts, getattr(ts, name)))
+
+
+def _once_per_step(ts, query):
+    """Wrap query so it reruns only when the simulation time of ts has advanced"""
+    cache = {'time': None, 'value': None}
+    
+    def cached():
+        time = ts.env.sim_step
+        if time != cache['time']:
+            cache['time'], cache['value'] = time, query()
+        return cache['value']
+    
+    return cached
+
+
 class FairnessObservationFunction(ObservationFunction):
     """
     Custom observation function that extends default SUMO-RL observations with fairness metrics.
@@ -31,24 +60,45 @@ class FairnessObservationFunction(ObservationFunction):
             ts: TrafficSignal instance from SUMO-RL
         """
         super().__init__(ts)
+        cache_per_step(ts, 'get_total_queued', 'get_accumulated_waiting_time_per_lane')
         
-        # Initialize per-agent tracking dictionaries
-        # Handle case where num_green_phases might not be available yet
-        try:
-            num_phases = getattr(ts, 'num_green_phases', 4)  # Default to 4 if not available
-            self.phase_usage = {i: 0 for i in range(num_phases)}
-        except (AttributeError, TypeError):
-            # Fallback if num_green_phases is not accessible
-            self.phase_usage = {i: 0 for i in range(4)}  # Default to 4 phases
+        # SUMO-RL builds the observation function before the signal's phases and lanes;
+        # the counts and everything sized by them are resolved in _build on first use
+        self._obs_buf = None
+        self.phase_usage = None
+        self.total_usage = 0
         
         self.last_action = None
         self.same_phase_count = 0
         self.step_count = 0
     
+    def _build(self):
+        """Resolve the phase and lane counts and allocate the arrays sized by them"""
+        self._num_phases = self.ts.num_green_phases
+        self._num_lanes = len(self.ts.lanes)
+        # Row i is the one-hot encoding of green phase i
+        self._eye = np.eye(self._num_phases, dtype=np.float32)
+        
+        # Observation buffer filled in place every call, and the slice of each component:
+        # phase_id + min_green + density + queue + phase_usage + stagnation
+        n, lanes = self._num_phases, self._num_lanes
+        self._obs_buf = np.zeros(n + 1 + 2 * lanes + n + 1, dtype=np.float32)
+        self._sl_phase = slice(0, n)
+        self._sl_min_green = slice(n, n + 1)
+        self._sl_density = slice(n + 1, n + 1 + lanes)
+        self._sl_queue = slice(n + 1 + lanes, n + 1 + 2 * lanes)
+        self._sl_usage = slice(n + 1 + 2 * lanes, 2 * n + 1 + 2 * lanes)
+        self._sl_stagnation = slice(2 * n + 1 + 2 * lanes, 2 * n + 2 + 2 * lanes)
+        
+        # Steps spent in each green phase
+        self.phase_usage = np.zeros(self._num_phases, dtype=np.int64)
+    
     def __call__(self):
         """
         Compute observation vector with fairness components.
         
+        The returned array is a buffer reused across calls; copy it to keep an observation.
+        
         Returns:
             np.ndarray: Observation vector containing:
                 - Phase one-hot encoding
@@ -58,13 +108,15 @@ class FairnessObservationFunction(ObservationFunction):
                 - Phase usage distribution (normalized)
                 - Stagnation indicator
         """
+        if self._obs_buf is None:
+            self._build()
+        
         # Track phase usage and stagnation mirroring single TLS env counters
         current_phase = self.ts.green_phase
 
-        # Ensure key exists and increment usage for the active phase every step
-        if current_phase not in self.phase_usage:
-            self.phase_usage[current_phase] = 0
+        # Increment usage for the active phase every step
         self.phase_usage[current_phase] += 1
+        self.total_usage += 1
 
         # Update consecutive same phase counter
         if self.last_action is None:
@@ -78,40 +130,19 @@ class FairnessObservationFunction(ObservationFunction):
 
         self.step_count += 1
         
-        # Get the actual number of green phases, with fallback
-        try:
-            num_phases = getattr(self.ts, 'num_green_phases', len(self.phase_usage))
-        except (AttributeError, TypeError):
-            num_phases = len(self.phase_usage)
+        observation = self._obs_buf
         
-        # Get default observation components
-        # Create phase one-hot encoding manually
-        phase_id = [1 if self.ts.green_phase == i else 0 for i in range(num_phases)]
-        min_green = [self.ts.time_since_last_phase_change >= self.ts.min_green]
-        density = self.ts.get_lanes_density()
-        queue = self.ts.get_lanes_queue()
+        # Default observation components: phase one-hot encoding, min green flag, lane density and queue
+        observation[self._sl_phase] = self._eye[current_phase]
+        observation[self._sl_min_green] = self.ts.time_since_last_phase_change >= self.ts.min_green
+        observation[self._sl_density] = self.ts.get_lanes_density()
+        observation[self._sl_queue] = self.ts.get_lanes_queue()
         
-        # Compute fairness features
-        
-        total_usage = sum(self.phase_usage.values())
-        if total_usage > 0:
-            phase_usage_normalized = [self.phase_usage.get(i, 0) / total_usage 
-                                    for i in range(num_phases)]
-        else:
-            phase_usage_normalized = [0.0] * num_phases
+        # Compute fairness features (the total includes this step, so it is never zero)
+        np.divide(self.phase_usage, self.total_usage, out=observation[self._sl_usage])
         
         # Stagnation indicator (normalized, capped at 1.0)
-        stagnation_indicator = [min(1.0, self.same_phase_count / 100.0)]
-        
-        # Concatenate all components
-        observation = np.concatenate([
-            phase_id,
-            min_green,
-            density,
-            queue,
-            phase_usage_normalized,
-            stagnation_indicator
-        ]).astype(np.float32)
+        observation[self._sl_stagnation] = min(1.0, self.same_phase_count / 100.0)
         
         return observation
     
@@ -122,32 +153,24 @@ class FairnessObservationFunction(ObservationFunction):
         Returns:
             spaces.Box: Observation space with appropriate bounds
         """
-        # Get the actual number of green phases, with fallback
-        try:
-            num_phases = getattr(self.ts, 'num_green_phases', len(self.phase_usage))
-        except (AttributeError, TypeError):
-            num_phases = len(self.phase_usage)
+        # SUMO-RL asks for the space once the signal's phases and lanes exist
+        if self._obs_buf is None:
+            self._build()
         
         # Total size: phase_id + min_green + density + queue + phase_usage + stagnation
-        total_size = (num_phases + 1 + 2 * len(self.ts.lanes) + 
-                     num_phases + 1)
-        
         return spaces.Box(
             low=0.0,
             high=1.0,
-            shape=(total_size,),
+            shape=self._obs_buf.shape,
             dtype=np.float32
         )
     
     def reset(self):
         """Reset tracking between episodes."""
-        # Get the actual number of green phases, with fallback
-        try:
-            num_phases = getattr(self.ts, 'num_green_phases', len(self.phase_usage))
-        except (AttributeError, TypeError):
-            num_phases = len(self.phase_usage)
-        
-        self.phase_usage = {i: 0 for i in range(num_phases)}
+        # Sized from ts.num_green_phases in _build; before that there is nothing to clear
+        if self.phase_usage is not None:
+            self.phase_usage.fill(0)
+        self.total_usage = 0
         self.last_action = None
         self.same_phase_count = 0
         self.step_count = 0
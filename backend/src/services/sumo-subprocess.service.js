@@ -1,6 +1,8 @@
 const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
+const net = require('net');
+const os = require('os');
 const logger = require('../utils/logger');
 
 /**
@@ -15,6 +17,9 @@ class SumoSubprocessService {
     this.lastStepLog = 0;
     this.processRef = null; // Reference to shared process object
     this.io = null; // Socket.IO instance
+    this.lastTls = new Map(); // Last full TLS object by id (for --tls-diff frames)
+    this.ipcServer = null; // Unix socket server for --ipc-socket frames
+    this.ipcPath = null;
   }
 
   /**
@@ -77,6 +82,94 @@ class SumoSubprocessService {
       : (process.platform === 'win32' ? 'sumo.exe' : 'sumo');
   }
 
+  /**
+   * Expand a column-oriented vehicles payload ({ id: [...], x: [...], ... },
+   * emitted by the bridge with --vehicle-layout columns) into the list of
+   * per-vehicle objects consumers expect
+   * @param {Object} columns - Field name to array of values
+   * @returns {Array<Object>}
+   */
+  expandVehicleColumns(columns) {
+    const ids = Array.isArray(columns.id) ? columns.id : [];
+    const fields = Object.keys(columns).filter((k) => k !== 'id' && Array.isArray(columns[k]));
+    const vehicles = new Array(ids.length);
+    for (let i = 0; i < ids.length; i++) {
+      const v = { id: ids[i] };
+      for (const f of fields) v[f] = columns[f][i];
+      vehicles[i] = v;
+    }
+    return vehicles;
+  }
+
+  /**
+   * Restore full TLS objects from a --tls-diff frame: entries marked
+   * `unchanged` are replaced by the last full object with fresh timing
+   * @param {Array<Object>} tls - TLS entries from a viz payload
+   * @returns {Array<Object>}
+   */
+  mergeTlsDiff(tls) {
+    return tls.map((t) => {
+      if (!t || !t.id) return t;
+      if (t.unchanged) {
+        const prev = this.lastTls.get(t.id);
+        return prev ? { ...prev, timing: t.timing || prev.timing } : t;
+      }
+      this.lastTls.set(t.id, t);
+      return t;
+    });
+  }
+
+  /**
+   * Listen on a Unix socket for length-prefixed JSON frames from the bridge
+   * (u32 little-endian byte length followed by the JSON document)
+   * @param {string} ipcPath - Socket path passed to the bridge as --ipc-socket
+   * @param {Function} onPayload - Called with each decoded payload
+   */
+  openIpcServer(ipcPath, onPayload) {
+    this.closeIpcServer();
+    try {
+      fs.unlinkSync(ipcPath); // Stale socket from a previous run
+    } catch (e) {
+      // Not present
+    }
+    this.ipcPath = ipcPath;
+    this.ipcServer = net.createServer((socket) => {
+      let pending = Buffer.alloc(0);
+      socket.on('data', (chunk) => {
+        pending = pending.length ? Buffer.concat([pending, chunk]) : chunk;
+        while (pending.length >= 4) {
+          const size = pending.readUInt32LE(0);
+          if (pending.length < 4 + size) break;
+          const frame = pending.subarray(4, 4 + size);
+          pending = pending.subarray(4 + size);
+          try {
+            onPayload(JSON.parse(frame.toString('utf8')));
+          } catch (e) {
+            logger.warn(`Failed to parse SUMO IPC frame (${size} bytes): ${e.message}`);
+          }
+        }
+      });
+      socket.on('error', (err) => logger.warn(`SUMO IPC socket error: ${err.message}`));
+    });
+    this.ipcServer.on('error', (err) => logger.error(`SUMO IPC server error: ${err.message}`));
+    this.ipcServer.listen(ipcPath);
+  }
+
+  /**
+   * Stop the IPC socket server and remove its socket file
+   */
+  closeIpcServer() {
+    if (!this.ipcServer) return;
+    this.ipcServer.close();
+    this.ipcServer = null;
+    try {
+      fs.unlinkSync(this.ipcPath);
+    } catch (e) {
+      // Already removed
+    }
+    this.ipcPath = null;
+  }
+
   /**
    * Spawn the SUMO Python bridge process
    * @param {Object} options - Spawn options
@@ -150,6 +243,28 @@ class SumoSubprocessService {
         '--step-length', String(stepLength)
       ];
 
+      // Column-oriented vehicle frames are smaller to encode and transfer
+      if (process.env.SUMO_VEHICLE_LAYOUT === 'columns') {
+        args.push('--vehicle-layout', 'columns');
+      }
+      // Only send TLS objects whose state/program/phase changed since the last step
+      if (process.env.SUMO_TLS_DIFF === 'true') {
+        args.push('--tls-diff');
+      }
+      // Cap the viz frame rate so a slow consumer doesn't stall the simulation
+      if (process.env.SUMO_VIZ_HZ) {
+        args.push('--viz-hz', String(process.env.SUMO_VIZ_HZ));
+      }
+      this.lastTls.clear();
+      // Receive frames over a Unix socket instead of the stdout pipe
+      if (process.env.SUMO_IPC_SOCKET && process.platform !== 'win32') {
+        const ipcPath = process.env.SUMO_IPC_SOCKET === 'true'
+          ? path.join(os.tmpdir(), `sumo-bridge-${process.pid}.sock`)
+          : process.env.SUMO_IPC_SOCKET;
+        this.openIpcServer(ipcPath, (payload) => handlePayload(payload));
+        args.push('--ipc-socket', ipcPath);
+      }
+
       // Add RL options if requested
       if (rlOptions) {
         const ROOT_DIR = path.join(__dirname, '../../../');
@@ -207,6 +322,25 @@ class SumoSubprocessService {
         onError(err);
       });
 
+      const handlePayload = (payload) => {
+        if (payload.type === 'viz' && payload.vehicles && !Array.isArray(payload.vehicles)) {
+          payload.vehicles = this.expandVehicleColumns(payload.vehicles);
+        }
+        if (payload.type === 'viz' && Array.isArray(payload.tls)) {
+          payload.tls = this.mergeTlsDiff(payload.tls);
+        }
+        onData(payload);
+
+        // Log step progress periodically
+        if (payload.type === 'viz' && payload.step) {
+          const now = Date.now();
+          if (now - this.lastStepLog > 5000) { // Log every 5 seconds
+            logger.info(`SUMO simulation step: ${payload.step}`);
+            this.lastStepLog = now;
+          }
+        }
+      };
+
       // Handle stdout (JSON lines)
       this.process.stdout.on('data', (chunk) => {
         this.buffer += chunk.toString();
@@ -217,17 +351,7 @@ class SumoSubprocessService {
           if (!line) continue;
 
           try {
-            const payload = JSON.parse(line);
-            onData(payload);
-            
-            // Log step progress periodically
-            if (payload.type === 'viz' && payload.step) {
-              const now = Date.now();
-              if (now - this.lastStepLog > 5000) { // Log every 5 seconds
-                logger.info(`SUMO simulation step: ${payload.step}`);
-                this.lastStepLog = now;
-              }
-            }
+            handlePayload(JSON.parse(line));
           } catch (e) {
             logger.warn(`Failed to parse SUMO output: ${line}`);
           }
@@ -274,6 +398,7 @@ class SumoSubprocessService {
 
         this.isRunning = false;
         this.process = null;
+        this.closeIpcServer();
         
         // Clear shared reference if available
         if (this.processRef) {
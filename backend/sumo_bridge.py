@@ -5,9 +5,11 @@ import json
 import time
 import argparse
 import xml.etree.ElementTree as ET
-from math import cos, sin, radians, atan2, degrees, ceil
+from math import cos, sin, radians, atan2, degrees, ceil, isnan
 import threading
 import queue
+import socket
+import struct
 import numpy as np
 import traceback
 
@@ -17,8 +19,16 @@ if 'SUMO_HOME' in os.environ:
     if tools not in sys.path:
         sys.path.append(tools)
 
+# libsumo runs SUMO in-process (no socket round-trip per call) but cannot drive the
+# GUI; RL mode always uses traci because the env owns its own traci connection.
+USE_LIBSUMO = '--use-libsumo' in sys.argv and '--rl-model' not in sys.argv
+
 try:
-    import traci
+    import traci.constants as tc
+    if USE_LIBSUMO:
+        import libsumo as traci
+    else:
+        import traci
     from sumolib import checkBinary
     from sumolib.net import readNet
 except Exception as e:
@@ -27,11 +37,79 @@ except Exception as e:
     sys.exit(1)
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        # numba is optional: without it the decorated functions run as plain Python
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fn: fn
+
+
+# Optional AF_UNIX stream to the Node server (see --ipc-socket)
+_ipc_sock = None
+
+
+def connect_ipc_socket(path, timeout=5.0):
+    """
+    Connect to the Unix socket the Node server listens on. Retries briefly
+    since the server may still be binding when the bridge starts.
+    """
+    global _ipc_sock
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            _ipc_sock = sock
+            return True
+        except OSError:
+            sock.close()
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+
+def emit(obj):
+    """
+    Write one newline-delimited JSON message for the Node server. orjson never
+    emits raw newlines, so the line framing the server relies on stays intact.
+    With an IPC socket connected, send a little-endian u32 length prefix and
+    the JSON bytes over it instead.
+    """
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        data = json.dumps(obj).encode('utf-8')
+    if _ipc_sock is not None:
+        _ipc_sock.sendall(struct.pack('<I', len(data)) + data)
+        return
+    # Push out pending print() text first so lines never interleave
+    sys.stdout.flush()
+    sys.stdout.buffer.write(data + b'\n')
+    sys.stdout.buffer.flush()
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--sumo-bin', required=False, default='sumo')
     parser.add_argument('--sumo-cfg', required=True)
     parser.add_argument('--step-length', required=False, default='1.0')
+    parser.add_argument('--use-libsumo', action='store_true', help='Run SUMO in-process via libsumo (no GUI, ignored in RL mode)')
+    parser.add_argument('--tls-diff', action='store_true',
+                        help='Send unchanged TLS as {id, unchanged, timing} instead of the full object')
+    parser.add_argument('--vehicle-layout', choices=['rows', 'columns'], default='rows',
+                        help="'rows': vehicles as a list of objects; 'columns': one array per field")
+    parser.add_argument('--viz-hz', required=False, type=float, default=0.0,
+                        help='Max viz frames per second (0 = one per step); skipped steps build no payload')
+    parser.add_argument('--ipc-socket', required=False, default=None,
+                        help='Unix socket path to send length-prefixed JSON frames to instead of stdout')
     # Optional RL control
     parser.add_argument('--rl-model', required=False, default=None, help='Path to SB3 PPO model (.zip) for targeted env')
     parser.add_argument('--rl-delta', required=False, type=int, default=15, help='Decision interval (seconds) for RL env')
@@ -64,10 +142,48 @@ def resolve_net_path_from_cfg(cfg_path):
         return None
 
 
+def junction_id_from_via(tl_attr, via_attr):
+    """Junction ID of a TLS-controlled connection, taken from its internal via lane."""
+    if tl_attr and via_attr:
+        # Extract junction ID from via (e.g. ":cluster_283262872_444451567_0_0" -> "cluster_283262872_444451567")
+        if via_attr.startswith(':'):
+            junction_parts = via_attr[1:].split('_')
+            # Reconstruct junction ID by removing the last connection-specific parts
+            if len(junction_parts) >= 3:
+                # For cluster junctions like "cluster_283262872_444451567_0_0"
+                # We want "cluster_283262872_444451567"
+                return '_'.join(junction_parts[:-2])
+    return None
+
+
+def tls_mapping_from_net(net):
+    """
+    Same mapping as build_tls_mapping, read from the connections of an already
+    loaded sumolib net instead of scanning the XML a second time. readNet leaves
+    out pedestrian-crossing connections, but those carry no via lane, so the
+    XML scan never mapped them either.
+    """
+    tllogic_to_junction = {}
+    junction_to_tllogic = {}
+    for edge in net.getEdges():
+        for conns in edge.getOutgoing().values():
+            for conn in conns:
+                tl_attr = conn.getTLSID()
+                junction_id = junction_id_from_via(tl_attr, conn.getViaLaneID())
+                if junction_id:
+                    tllogic_to_junction[tl_attr] = junction_id
+                    junction_to_tllogic[junction_id] = tl_attr
+    print(json.dumps({"type": "log", "level": "info", "message": f"Built TLS mapping: {len(tllogic_to_junction)} traffic lights mapped"}))
+    sys.stdout.flush()
+    return tllogic_to_junction, junction_to_tllogic
+
+
 def build_tls_mapping(net_path):
     """
     Create a mapping from junction IDs (used by traci) to tlLogic IDs (user-friendly names).
     Also create reverse mapping from tlLogic IDs to junction IDs.
+    Only used when sumolib can't load the net; load_network otherwise takes the
+    mapping from the loaded net with tls_mapping_from_net.
     """
     try:
         tree = ET.parse(net_path)
@@ -79,19 +195,10 @@ def build_tls_mapping(net_path):
         
         # Find all connections with tl attribute to map tlLogic IDs to junction IDs
         for connection in root.findall('connection'):
-            tl_attr = connection.get('tl')
-            via_attr = connection.get('via')
-            if tl_attr and via_attr:
-                # Extract junction ID from via (e.g. ":cluster_283262872_444451567_0_0" -> "cluster_283262872_444451567")
-                if via_attr.startswith(':'):
-                    junction_parts = via_attr[1:].split('_')
-                    # Reconstruct junction ID by removing the last connection-specific parts
-                    if len(junction_parts) >= 3:
-                        # For cluster junctions like "cluster_283262872_444451567_0_0"
-                        # We want "cluster_283262872_444451567"
-                        junction_id = '_'.join(junction_parts[:-2])
-                        tllogic_to_junction[tl_attr] = junction_id
-                        junction_to_tllogic[junction_id] = tl_attr
+            junction_id = junction_id_from_via(connection.get('tl'), connection.get('via'))
+            if junction_id:
+                tllogic_to_junction[connection.get('tl')] = junction_id
+                junction_to_tllogic[junction_id] = connection.get('tl')
         
         print(json.dumps({"type": "log", "level": "info", "message": f"Built TLS mapping: {len(tllogic_to_junction)} traffic lights mapped"}))
         sys.stdout.flush()
@@ -103,9 +210,8 @@ def build_tls_mapping(net_path):
         return {}, {}
 
 
-def build_network_payload(net_path):
+def build_network_payload(net):
     try:
-        net = readNet(net_path)
         xmin, ymin, xmax, ymax = net.getBoundary()
         lanes = []
         for edge in net.getEdges():
@@ -127,15 +233,647 @@ def build_network_payload(net_path):
         return { 'type': 'error', 'message': f'Failed to load net: {e}' }
 
 
+def make_geo_converter(net):
+    """
+    Vectorized equivalent of net.convertXY2LonLat: returns xy2lonlat(xs, ys)
+    projecting whole coordinate arrays in one pyproj call, or None when the
+    net has no usable geo projection.
+    """
+    try:
+        proj = net.getGeoProj()
+        off_x, off_y = net.getLocationOffset()
+    except Exception:
+        return None
+    if proj is None:
+        return None
+    def xy2lonlat(xs, ys):
+        return proj(np.asarray(xs, dtype=np.float64) - off_x,
+                    np.asarray(ys, dtype=np.float64) - off_y, inverse=True)
+    return xy2lonlat
+
+
+def load_network(net_path):
+    """
+    Read the net once and return (net_payload, geo_ref, tls_mapping). With a
+    geo projection the payload also carries lon/lat lane previews for Leaflet
+    and geo_ref is the converter from make_geo_converter; otherwise geo_ref is
+    None. tls_mapping is (tllogic_to_junction, junction_to_tllogic), taken from
+    the loaded net or, if sumolib can't load it, from build_tls_mapping.
+    """
+    try:
+        net = readNet(net_path)
+    except Exception as e:
+        return { 'type': 'error', 'message': f'Failed to load net: {e}' }, None, build_tls_mapping(net_path)
+    try:
+        tls_mapping = tls_mapping_from_net(net)
+    except Exception:
+        tls_mapping = build_tls_mapping(net_path)
+    net_payload = build_network_payload(net)
+    geo_ref = make_geo_converter(net)
+    if geo_ref is None or net_payload.get('type') != 'net':
+        return net_payload, geo_ref, tls_mapping
+    try:
+        lanes = net_payload['lanes']
+        b = net_payload['bounds']
+        xs = [pt['x'] for lane in lanes for pt in lane['points']] + [b['minX'], b['maxX']]
+        ys = [pt['y'] for lane in lanes for pt in lane['points']] + [b['minY'], b['maxY']]
+        lons, lats = geo_ref(xs, ys)
+        lons = lons.tolist(); lats = lats.tolist()
+        k = 0
+        for lane in lanes:
+            n = len(lane['points'])
+            lane['lonlat'] = [{'lon': lon, 'lat': lat} for lon, lat in zip(lons[k:k + n], lats[k:k + n])]
+            k += n
+        net_payload['geoBounds'] = {
+            'minLon': lons[k], 'minLat': lats[k],
+            'maxLon': lons[k + 1], 'maxLat': lats[k + 1]
+        }
+    except Exception:
+        geo_ref = None
+    return net_payload, geo_ref, tls_mapping
+
+
+# Per-vehicle variables fetched through one subscription instead of one RPC per getter
+VEHICLE_VARS = [
+    tc.VAR_POSITION, tc.VAR_SPEED, tc.VAR_ANGLE,
+    tc.VAR_LENGTH, tc.VAR_WIDTH, tc.VAR_TYPE,
+    tc.VAR_WAITING_TIME, tc.VAR_DISTANCE,
+]
+# Per-TLS dynamic variables refreshed by SUMO on every simulation step
+TLS_VARS = [
+    tc.TL_RED_YELLOW_GREEN_STATE, tc.TL_CURRENT_PHASE,
+    tc.TL_CURRENT_PROGRAM, tc.TL_NEXT_SWITCH,
+]
+# Simulation-wide counters backing the per-step stats, read in one round-trip
+SIM_VARS = [
+    tc.VAR_TIME,
+    tc.VAR_COLLIDING_VEHICLES_NUMBER, tc.VAR_EMERGENCYSTOPPING_VEHICLES_NUMBER,
+    tc.VAR_TELEPORT_STARTING_VEHICLES_NUMBER, tc.VAR_TELEPORT_ENDING_VEHICLES_NUMBER,
+    tc.VAR_ARRIVED_VEHICLES_NUMBER, tc.VAR_DEPARTED_VEHICLES_NUMBER,
+]
+
+
+# Lane geometry and TLS link wiring are static for the whole simulation, so they
+# are fetched once and served from these caches afterwards.
+_lane_shape_cache = {}
+_tls_controlled_lanes_cache = {}
+_tls_controlled_links_cache = {}
+
+
+def lane_shape(lane_id):
+    shape = _lane_shape_cache.get(lane_id)
+    if shape is None:
+        shape = _lane_shape_cache[lane_id] = tuple(traci.lane.getShape(lane_id))
+    return shape
+
+
+def tls_controlled_lanes(tls_id):
+    lanes = _tls_controlled_lanes_cache.get(tls_id)
+    if lanes is None:
+        lanes = _tls_controlled_lanes_cache[tls_id] = tuple(traci.trafficlight.getControlledLanes(tls_id))
+    return lanes
+
+
+def tls_controlled_links(tls_id):
+    links = _tls_controlled_links_cache.get(tls_id)
+    if links is None:
+        links = _tls_controlled_links_cache[tls_id] = tuple(traci.trafficlight.getControlledLinks(tls_id))
+    return links
+
+
+def fetch_subscription_results(domain, var_ids):
+    """
+    Return {object_id: {var: value}} for every object of a TraCI domain.
+    Objects without a subscription yet (new departures, vehicles inserted during
+    command-forced steps, or a fresh connection after an env reset) are
+    subscribed on the fly, so steady state costs one ID-list call per step.
+    Objects the RL env subscribed with fewer variables are resubscribed with
+    both lists, since subscribing replaces the variable list.
+    """
+    results = domain.getAllSubscriptionResults()
+    wanted = set(var_ids)
+    missing = [oid for oid in domain.getIDList() if not wanted <= results.get(oid, {}).keys()]
+    if missing:
+        for oid in missing:
+            domain.subscribe(oid, sorted(wanted | results.get(oid, {}).keys()))
+        results = domain.getAllSubscriptionResults()
+    return results
+
+
+def fetch_simulation_results():
+    """Return {var: value} for SIM_VARS, subscribing first on a fresh connection."""
+    results = traci.simulation.getAllSubscriptionResults().get('')
+    if not results or any(var not in results for var in SIM_VARS):
+        # Subscribing replaces the variable list; keep what the RL env subscribed
+        # on the shared connection
+        traci.simulation.subscribe(sorted(set(results or ()) | set(SIM_VARS)))
+        results = traci.simulation.getAllSubscriptionResults().get('', {})
+    return results
+
+
+def sum_vehicle_var(veh_results, var_id):
+    """Sum one subscribed float variable over all vehicles in C."""
+    return float(np.fromiter(
+        (r[var_id] for r in veh_results.values()), dtype=np.float64, count=len(veh_results)
+    ).sum())
+
+
+def collect_stats(sim_results, veh_results):
+    try:
+        return {
+            'collisions': sim_results[tc.VAR_COLLIDING_VEHICLES_NUMBER],
+            'emergencyStops': sim_results[tc.VAR_EMERGENCYSTOPPING_VEHICLES_NUMBER],
+            'teleportStarts': sim_results[tc.VAR_TELEPORT_STARTING_VEHICLES_NUMBER],
+            'teleportEnds': sim_results[tc.VAR_TELEPORT_ENDING_VEHICLES_NUMBER],
+            'arrivals': sim_results[tc.VAR_ARRIVED_VEHICLES_NUMBER],
+            'departures': sim_results[tc.VAR_DEPARTED_VEHICLES_NUMBER],
+            'waitingTime': sum_vehicle_var(veh_results, tc.VAR_WAITING_TIME),
+            'totalDistanceTraveled': sum_vehicle_var(veh_results, tc.VAR_DISTANCE)
+        }
+    except Exception:
+        return {
+            'collisions': 0,
+            'emergencyStops': 0,
+            'teleportStarts': 0,
+            'teleportEnds': 0,
+            'arrivals': 0,
+            'departures': 0,
+            'waitingTime': 0,
+            'totalDistanceTraveled': 0
+        }
+
+
+def collect_vehicles(veh_results, geo_ref):
+    vehicles = []
+    for vid, res in veh_results.items():
+        x, y = res[tc.VAR_POSITION]
+        item = {
+            'id': vid,
+            'x': x,
+            'y': y,
+            'speed': res[tc.VAR_SPEED],
+            'angle': res[tc.VAR_ANGLE],  # degrees
+            'length': res[tc.VAR_LENGTH],
+            'width': res[tc.VAR_WIDTH],
+            'type': res[tc.VAR_TYPE]
+        }
+        vehicles.append(item)
+    if geo_ref is not None and vehicles:
+        # One projection call for all vehicles of the step
+        try:
+            lons, lats = geo_ref([v['x'] for v in vehicles], [v['y'] for v in vehicles])
+            for item, lon, lat in zip(vehicles, lons.tolist(), lats.tolist()):
+                item['lon'] = lon
+                item['lat'] = lat
+        except Exception:
+            pass
+    return vehicles
+
+
+def collect_vehicle_columns(veh_results, geo_ref):
+    """
+    Column-oriented variant of collect_vehicles: {'id': [...], 'x': [...], ...}
+    with one list per field, built straight from the subscription results.
+    """
+    ids = list(veh_results)
+    res = list(veh_results.values())
+    n = len(ids)
+    pos = np.array([r[tc.VAR_POSITION] for r in res], dtype=np.float64).reshape(n, 2)
+    xs = pos[:, 0]
+    ys = pos[:, 1]
+    cols = {
+        'id': ids,
+        'x': xs.tolist(),
+        'y': ys.tolist(),
+        'speed': [r[tc.VAR_SPEED] for r in res],
+        'angle': [r[tc.VAR_ANGLE] for r in res],
+        'length': [r[tc.VAR_LENGTH] for r in res],
+        'width': [r[tc.VAR_WIDTH] for r in res],
+        'type': [r[tc.VAR_TYPE] for r in res]
+    }
+    if geo_ref is not None and n:
+        try:
+            lons, lats = geo_ref(xs, ys)
+            cols['lon'] = lons.tolist()
+            cols['lat'] = lats.tolist()
+        except Exception:
+            pass
+    return cols
+
+
+# Per-TLS derived data that only changes when a program is switched (see
+# invalidate_tls_cache) or never at all (centers and link geometry).
+_tls_program_cache = {}
+_tls_center_cache = {}
+_tls_link_geom_cache = {}
+_tls_base_cache = {}
+_tls_last_detail = {}
+
+
+def invalidate_tls_cache(tls_id):
+    for key in [k for k in _tls_program_cache if k[0] == tls_id]:
+        del _tls_program_cache[key]
+    _tls_last_detail.pop(tls_id, None)
+
+
+def tls_program(tls_id, prog_id):
+    """Program id and phase list of the active program, cached per (tls, program)."""
+    key = (tls_id, prog_id)
+    program = _tls_program_cache.get(key)
+    if program is not None:
+        return program
+    phases_info = []
+    try:
+        defs = traci.trafficlight.getCompleteRedYellowGreenDefinition(tls_id)
+        chosen = None
+        for lg in defs:
+            pid = getattr(lg, 'programID', getattr(lg, 'programID', None))
+            if pid == prog_id or chosen is None:
+                chosen = lg
+        if chosen is not None:
+            for idx, ph in enumerate(getattr(chosen, 'phases', [])):
+                try:
+                    phases_info.append({
+                        'index': idx,
+                        'state': getattr(ph, 'state', ''),
+                        'duration': float(getattr(ph, 'duration', 0) or 0),
+                        'minDur': float(getattr(ph, 'minDur', 0) or 0),
+                        'maxDur': float(getattr(ph, 'maxDur', 0) or 0)
+                    })
+                except Exception:
+                    phases_info.append({'index': idx})
+    except Exception:
+        pass
+    program = _tls_program_cache[key] = { 'id': prog_id, 'phases': phases_info }
+    return program
+
+
+def tls_center(tls_id, geo_ref):
+    """
+    Approximate TLS center from controlled lanes as (x, y, lon, lat).
+    Any component may be None when it cannot be derived.
+    """
+    if tls_id in _tls_center_cache:
+        return _tls_center_cache[tls_id]
+    x_c = None; y_c = None; lon = None; lat = None
+    try:
+        xs, ys, count = 0.0, 0.0, 0
+        for ln in tls_controlled_lanes(tls_id):
+            try:
+                shape = lane_shape(ln)
+                if shape:
+                    xs += float(shape[0][0])
+                    ys += float(shape[0][1])
+                    count += 1
+            except Exception:
+                continue
+        if count > 0:
+            x_c = xs / count
+            y_c = ys / count
+            if geo_ref is not None:
+                try:
+                    lon, lat = geo_ref(x_c, y_c)
+                    lon = float(lon); lat = float(lat)
+                except Exception:
+                    lon = None; lat = None
+    except Exception:
+        pass
+    center = _tls_center_cache[tls_id] = (x_c, y_c, lon, lat)
+    return center
+
+
+SIDES = ('N', 'E', 'S', 'W')
+TURNS = ('L', 'S', 'R', 'U')
+PRIO_CHARS = 'ryg'
+# Signal byte -> priority (0=r, 1=y, 2=g); everything else counts as red
+STATE_PRIO = bytes(2 if c in b'gG' else 1 if c in b'yY' else 0 for c in range(256))
+
+
+@njit(cache=True)
+def classify_links(in_end_xy, out_start_xy, x_c, y_c):
+    """
+    Classify links from their approach geometry relative to the TLS center.
+    in_end_xy / out_start_xy are (n, 2) arrays with the last point of each
+    incoming lane and the first point of each outgoing lane (NaN rows where
+    the outgoing shape is unknown). Returns side ids over SIDES, turn ids over
+    TURNS (-1 if unclassified) and approach angles in degrees.
+    """
+    n = in_end_xy.shape[0]
+    side_ids = np.empty(n, dtype=np.int8)
+    turn_ids = np.empty(n, dtype=np.int8)
+    angles = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        a_in = degrees(atan2(in_end_xy[i, 1] - y_c, in_end_xy[i, 0] - x_c))
+        angles[i] = a_in
+        if -45 <= a_in < 45:
+            side_ids[i] = 1  # E
+        elif 45 <= a_in < 135:
+            side_ids[i] = 0  # N
+        elif -135 <= a_in < -45:
+            side_ids[i] = 2  # S
+        else:
+            side_ids[i] = 3  # W
+        if isnan(out_start_xy[i, 0]):
+            turn_ids[i] = -1
+            continue
+        a_out = degrees(atan2(out_start_xy[i, 1] - y_c, out_start_xy[i, 0] - x_c))
+        d = (a_out - a_in + 180.0) % 360.0 - 180.0
+        if abs(d) > 150:
+            turn_ids[i] = 3  # U
+        elif -30 <= d <= 30:
+            turn_ids[i] = 1  # S
+        elif d > 30:
+            turn_ids[i] = 0  # L
+        else:
+            turn_ids[i] = 2  # R
+    return side_ids, turn_ids, angles
+
+
+def tls_link_geometry(tls_id, x_c, y_c):
+    """
+    Static per-link geometry of a TLS: for every link its state index, side id
+    (0..3 over SIDES), lane id (into 'lanes') and, for links whose turn could
+    be classified, a side*4+turn key over TURNS (-1 otherwise).
+    """
+    geom = _tls_link_geom_cache.get(tls_id)
+    if geom is not None:
+        return geom
+    has_center = x_c is not None and y_c is not None
+    state_idx, in_lanes, in_end_xy, out_start_xy = [], [], [], []
+    for idx, link_group in enumerate(tls_controlled_links(tls_id)):
+        if not link_group:
+            continue
+        inLane = link_group[0][0]
+        outLane = link_group[0][1]
+        try:
+            in_shape = lane_shape(inLane)
+        except Exception:
+            continue
+        if not in_shape:
+            continue
+        out_start = (np.nan, np.nan)
+        if has_center:
+            try:
+                out_shape = lane_shape(outLane)
+                if out_shape:
+                    out_start = out_shape[0][:2]
+            except Exception:
+                pass
+        state_idx.append(idx)
+        in_lanes.append(inLane)
+        in_end_xy.append(in_shape[-1][:2])
+        out_start_xy.append(out_start)
+    n = len(state_idx)
+    # Without a center, approach angles are measured from the network origin
+    side_ids, turn_ids, angles = classify_links(
+        np.array(in_end_xy, dtype=np.float64).reshape(n, 2),
+        np.array(out_start_xy, dtype=np.float64).reshape(n, 2),
+        float(x_c) if has_center else 0.0, float(y_c) if has_center else 0.0)
+    lanes, lane_angles, lane_ids = [], [], []
+    lane_pos = {}
+    for inLane, angle in zip(in_lanes, angles.tolist()):
+        pos = lane_pos.get(inLane)
+        if pos is None:
+            pos = lane_pos[inLane] = len(lanes)
+            lanes.append(inLane)
+            lane_angles.append(angle)
+        lane_angles[pos] = angle
+        lane_ids.append(pos)
+    turn_keys = (side_ids.astype(np.intp) * 4 + turn_ids).tolist()
+    links = [
+        (idx, side, pos, key if turn >= 0 else -1)
+        for idx, side, pos, key, turn in zip(state_idx, side_ids.tolist(), lane_ids, turn_keys, turn_ids.tolist())
+    ]
+    geom = {
+        # (state index, side id, lane id, side*4+turn key or -1) per link
+        'links': links,
+        'lanes': lanes,
+        'lane_angles': lane_angles,
+        'aggregate': compile_link_aggregator(links, len(lanes)),
+        'min_state_len': max(state_idx) + 1 if state_idx else 0
+    }
+    _tls_link_geom_cache[tls_id] = geom
+    return geom
+
+
+def compile_link_aggregator(links, n_lanes):
+    """
+    Specialize aggregate_link_states for one fixed link table: generate
+    straight-line code that reads each link's priority once and returns the
+    per-side, per-turn and per-lane maxima without a loop. Only integer
+    indices from the table end up in the generated source.
+    """
+    groups = {}
+    for i, (idx, side, lane, key) in enumerate(links):
+        for name in (f's{side}', f'l{lane}') + ((f't{key}',) if key >= 0 else ()):
+            groups.setdefault(name, []).append(i)
+    body = [f'    p{i} = prio[s[{idx}]]' for i, (idx, _, _, _) in enumerate(links)]
+    for name, members in groups.items():
+        body.append(f'    {name} = p{members[0]}')
+        body.extend(f'    if p{i} > {name}: {name} = p{i}' for i in members[1:])
+    def ref(name, empty):
+        return name if name in groups else empty
+    body.append('    return ([{}], [{}], [{}])'.format(
+        ', '.join(ref(f's{k}', '0') for k in range(4)),
+        ', '.join(ref(f't{k}', '-1') for k in range(16)),
+        ', '.join(ref(f'l{k}', '-1') for k in range(n_lanes))))
+    src = 'def aggregate(s, prio):\n' + '\n'.join(body) + '\n'
+    namespace = {}
+    exec(compile(src, '<tls-aggregate>', 'exec'), namespace)
+    return namespace['aggregate']
+
+
+def aggregate_link_states(geom, state):
+    """
+    Reduce a TLS state string to per-side, per-(side, turn) and per-lane
+    priorities (0=r, 1=y, 2=g; -1 where no link contributes) with one byte
+    lookup and integer compares per link, using the junction's compiled
+    aggregator whenever the state covers every link.
+    """
+    state_b = state.encode('ascii')
+    n_state = len(state_b)
+    if n_state >= geom['min_state_len']:
+        return geom['aggregate'](state_b, STATE_PRIO)
+    # State shorter than the link table: walk the links up to its end
+    prio = STATE_PRIO
+    side_prio = [0, 0, 0, 0]
+    turn_prio = [-1] * 16
+    lane_prio = [-1] * len(geom['lanes'])
+    for idx, side, lane, key in geom['links']:
+        if idx >= n_state:
+            break
+        p = prio[state_b[idx]]
+        if p > side_prio[side]:
+            side_prio[side] = p
+        if p > lane_prio[lane]:
+            lane_prio[lane] = p
+        if key >= 0 and p > turn_prio[key]:
+            turn_prio[key] = p
+    return side_prio, turn_prio, lane_prio
+
+
+def build_tls_detail(junction_id, state, program, geo_ref):
+    """The part of a TLS payload that only changes with its state or program."""
+    detail = {'state': state, 'program': program}
+    x_c, y_c, lon, lat = tls_center(junction_id, geo_ref)
+    if x_c is not None:
+        detail['cx'] = x_c; detail['cy'] = y_c
+    if lon is not None:
+        detail['lon'] = lon; detail['lat'] = lat
+    # Per-side summary and per-side turn states (L,S,R,U)
+    try:
+        geom = tls_link_geometry(junction_id, x_c, y_c)
+        side_prio, turn_prio, lane_prio = aggregate_link_states(geom, state)
+        detail['sides'] = {side: PRIO_CHARS[p] for side, p in zip(SIDES, side_prio)}
+        # Lane geometry is static and already sent once in the net payload
+        # (lanes[].points keyed by lane id), so only state and angle go per step
+        lanes = geom['lanes']
+        lane_angles = geom['lane_angles']
+        detail['lanes'] = [
+            { 'id': lanes[pos], 'state': PRIO_CHARS[p], 'angle': lane_angles[pos] }
+            for pos, p in enumerate(lane_prio) if p >= 0
+        ]
+        turns = {'N': {}, 'E': {}, 'S': {}, 'W': {}}
+        for key, p in enumerate(turn_prio):
+            if p >= 0:
+                turns[SIDES[key // 4]][TURNS[key % 4]] = PRIO_CHARS[p]
+        detail['turns'] = turns
+    except Exception:
+        pass
+    return detail
+
+
+def collect_tls_states(tls_results, sim_t, junction_to_tllogic, geo_ref, diff=False):
+    """
+    Traffic light states with approximate geometry and per-side summary.
+    The derived detail is rebuilt only when a TLS's (state, program, phase)
+    changes; with diff=True such unchanged TLS are sent as
+    {'id', 'unchanged': True, 'timing'} for the consumer to merge.
+    """
+    tls_states = []
+    for junction_id, res in tls_results.items():
+        state = res[tc.TL_RED_YELLOW_GREEN_STATE]
+        base = _tls_base_cache.get(junction_id)
+        if base is None:
+            # Use friendly tlLogic ID if available, otherwise use junction ID,
+            # and store the junction_id for internal use if they differ
+            display_id = junction_to_tllogic.get(junction_id, junction_id)
+            base = {'id': display_id}
+            if display_id != junction_id:
+                base['junction_id'] = junction_id
+            _tls_base_cache[junction_id] = base
+        program = tls_program(junction_id, res[tc.TL_CURRENT_PROGRAM])
+        # Timing info
+        timing = None
+        try:
+            cur_idx = int(res[tc.TL_CURRENT_PHASE])
+            num_phases = len(program['phases']) or int(traci.trafficlight.getPhaseNumber(junction_id))
+            next_sw = float(res[tc.TL_NEXT_SWITCH])
+            remaining = max(0.0, next_sw - sim_t)
+            nxt_idx = (cur_idx + 1) % max(1, num_phases)
+            timing = {
+                'currentIndex': cur_idx,
+                'numPhases': num_phases,
+                'remaining': remaining,
+                'nextIndex': nxt_idx,
+                'nextSwitch': next_sw,
+                'simTime': sim_t
+            }
+        except Exception:
+            pass
+        key = (state, program['id'], res[tc.TL_CURRENT_PHASE])
+        last = _tls_last_detail.get(junction_id)
+        if last is not None and last[0] == key:
+            if diff:
+                tls_obj = {'id': base['id'], 'unchanged': True}
+                if timing is not None:
+                    tls_obj['timing'] = timing
+                tls_states.append(tls_obj)
+                continue
+            detail = last[1]
+        else:
+            detail = build_tls_detail(junction_id, state, program, geo_ref)
+            _tls_last_detail[junction_id] = (key, detail)
+        tls_obj = base.copy()
+        tls_obj.update(detail)
+        if timing is not None:
+            tls_obj['timing'] = timing
+        tls_states.append(tls_obj)
+    return tls_states
+
+
+def drain_queue(q):
+    """
+    Take every pending item from a queue.Queue in one locked bulk move, so the
+    common empty case costs no queue.Empty exception.
+    """
+    with q.mutex:
+        items = list(q.queue)
+        q.queue.clear()
+    return items
+
+
+def emit_tls_update(junction_id, junction_to_tllogic):
+    """Emit an immediate small viz payload for a single TLS (best-effort)."""
+    try:
+        display_id = junction_to_tllogic.get(junction_id, junction_id)
+        state = traci.trafficlight.getRedYellowGreenState(junction_id)
+        tls_obj = { 'id': display_id, 'state': state }
+        try:
+            sim_t = float(traci.simulation.getTime())
+            cur_idx = int(traci.trafficlight.getPhase(junction_id))
+            num_phases = int(traci.trafficlight.getPhaseNumber(junction_id))
+            next_sw = float(traci.trafficlight.getNextSwitch(junction_id))
+            remaining = max(0.0, next_sw - sim_t)
+            nxt_idx = (cur_idx + 1) % max(1, num_phases)
+            tls_obj['timing'] = {
+                'currentIndex': cur_idx,
+                'numPhases': num_phases,
+                'remaining': remaining,
+                'nextIndex': nxt_idx,
+                'nextSwitch': next_sw,
+                'simTime': sim_t
+            }
+        except Exception:
+            pass
+        # Print a minimal viz payload so the server will forward it
+        payload = {
+            'type': 'viz',
+            'step': -1,
+            'ts': int(time.time() * 1000),
+            'vehicles': [],
+            'tls': [tls_obj]
+        }
+        emit(payload)
+    except Exception:
+        # best-effort only
+        pass
+
+
 def main():
     args = parse_args()
+    collect_vehicle_payload = collect_vehicle_columns if args.vehicle_layout == 'columns' else collect_vehicles
+    if args.ipc_socket and not connect_ipc_socket(args.ipc_socket):
+        print(json.dumps({"type": "log", "level": "warn", "message": f"Could not connect to IPC socket {args.ipc_socket}; using stdout"}))
+        sys.stdout.flush()
+
+    # Decouple the SUMO step rate from the visualization frame rate
+    emit_interval = 1.0 / args.viz_hz if args.viz_hz > 0 else 0.0
+    next_emit_ts = 0.0
+
+    def frame_due():
+        nonlocal next_emit_ts
+        if emit_interval <= 0.0:
+            return True
+        now = time.monotonic()
+        if now < next_emit_ts:
+            return False
+        next_emit_ts = now + emit_interval
+        return True
     
-    # Build TLS ID mapping from network file
-    net_path = resolve_net_path_from_cfg(args.sumo_cfg)
+    # TLS ID mapping, filled from the network file by load_network
     tllogic_to_junction = {}
     junction_to_tllogic = {}
-    if net_path:
-        tllogic_to_junction, junction_to_tllogic = build_tls_mapping(net_path)
 
     # Set up stdin command queue (non-blocking via thread)
     cmd_queue = queue.Queue()
@@ -164,43 +902,6 @@ def main():
         if tllogic_to_junction_map:
             tllogic_to_junction = tllogic_to_junction_map
         try:
-            # Helper to emit an immediate small viz payload for a single TLS
-            def emit_tls_update(junction_id):
-                try:
-                    display_id = junction_to_tllogic.get(junction_id, junction_id)
-                    state = traci.trafficlight.getRedYellowGreenState(junction_id)
-                    tls_obj = { 'id': display_id, 'state': state }
-                    try:
-                        sim_t = float(traci.simulation.getTime())
-                        cur_idx = int(traci.trafficlight.getPhase(junction_id))
-                        num_phases = int(traci.trafficlight.getPhaseNumber(junction_id))
-                        next_sw = float(traci.trafficlight.getNextSwitch(junction_id))
-                        remaining = max(0.0, next_sw - sim_t)
-                        nxt_idx = (cur_idx + 1) % max(1, num_phases)
-                        tls_obj['timing'] = {
-                            'currentIndex': cur_idx,
-                            'numPhases': num_phases,
-                            'remaining': remaining,
-                            'nextIndex': nxt_idx,
-                            'nextSwitch': next_sw,
-                            'simTime': sim_t
-                        }
-                    except Exception:
-                        pass
-                    # Print a minimal viz payload so the server will forward it
-                    payload = {
-                        'type': 'viz',
-                        'step': -1,
-                        'ts': int(time.time() * 1000),
-                        'vehicles': [],
-                        'tls': [tls_obj]
-                    }
-                    print(json.dumps(payload))
-                    sys.stdout.flush()
-                except Exception:
-                    # best-effort only
-                    pass
-
             print(json.dumps({"type": "log", "level": "info", "message": f"🚦 RECEIVED TLS COMMAND: {cmd}"}))
             sys.stdout.flush()
             
@@ -272,7 +973,7 @@ def main():
                             best_d2 = float('inf')
                             for lid in candidates:
                                 try:
-                                    shp = traci.lane.getShape(lid)
+                                    shp = lane_shape(lid)
                                     for i, (sx, sy) in enumerate(shp):
                                         dx = float(sx) - float(px)
                                         dy = float(sy) - float(py)
@@ -324,7 +1025,7 @@ def main():
                             lane_id = None
                         try:
                             if lane_id:
-                                shp = traci.lane.getShape(lane_id)
+                                shp = lane_shape(lane_id)
                                 for sx, sy in shp:
                                     if coords and coords[-1][0] == float(sx) and coords[-1][1] == float(sy):
                                         continue
@@ -344,7 +1045,7 @@ def main():
                         try:
                             lane_id = traci.vehicle.getLaneID(vid)
                             if lane_id:
-                                shp = traci.lane.getShape(lane_id)
+                                shp = lane_shape(lane_id)
                                 for sx, sy in shp:
                                     coords.append([float(sx), float(sy)])
                         except Exception:
@@ -378,7 +1079,7 @@ def main():
                         'destination': dest,
                         'ts': int(time.time()*1000)
                     }
-                    print(json.dumps(payload)); sys.stdout.flush()
+                    emit(payload)
                 except Exception as e:
                     print(json.dumps({"type":"log","level":"error","message":f"get_route failed: {e}"})); sys.stdout.flush();
                 return
@@ -417,6 +1118,9 @@ def main():
                 print(json.dumps({"type": "log", "level": "error", "message": f"💥 FAILED TO CHECK TLS: {e}"}))
                 sys.stdout.flush()
                 return
+
+            # Commands below may switch programs or install an ad-hoc state program
+            invalidate_tls_cache(tls_id)
             
             # Handle direct state setting - FORCE IMMEDIATE EXECUTION
             if cmd_type == 'tls_state':
@@ -447,7 +1151,7 @@ def main():
                     sys.stdout.flush()
                     # Emit an immediate TLS update so clients see the change without waiting for next loop
                     try:
-                        emit_tls_update(tls_id)
+                        emit_tls_update(tls_id, junction_to_tllogic)
                     except Exception:
                         pass
                     return
@@ -483,7 +1187,7 @@ def main():
                     sys.stdout.flush()
                     # Emit immediate TLS update
                     try:
-                        emit_tls_update(tls_id)
+                        emit_tls_update(tls_id, junction_to_tllogic)
                     except Exception:
                         pass
                 except Exception as e:
@@ -515,7 +1219,7 @@ def main():
                     sys.stdout.flush()
                     # Emit immediate TLS update
                     try:
-                        emit_tls_update(tls_id)
+                        emit_tls_update(tls_id, junction_to_tllogic)
                     except Exception:
                         pass
                 except Exception as e:
@@ -550,7 +1254,7 @@ def main():
                         sys.stdout.flush()
                         # Emit immediate TLS update
                         try:
-                            emit_tls_update(tls_id)
+                            emit_tls_update(tls_id, junction_to_tllogic)
                         except Exception:
                             pass
                     else:
@@ -617,7 +1321,7 @@ def main():
 
                     # Emit immediate TLS update
                     try:
-                        emit_tls_update(tls_id)
+                        emit_tls_update(tls_id, junction_to_tllogic)
                     except Exception:
                         pass
                 except Exception as e:
@@ -646,7 +1350,7 @@ def main():
                             traci.trafficlight.setRedYellowGreenState(tls_id, all_yellow)
                             traci.simulationStep()
                             try:
-                                emit_tls_update(tls_id)
+                                emit_tls_update(tls_id, junction_to_tllogic)
                             except Exception:
                                 pass
                     except Exception:
@@ -679,7 +1383,7 @@ def main():
                     traci.trafficlight.setPhaseDuration(tls_id, max(1.0, float(nominal)))
                     traci.simulationStep()
                     try:
-                        emit_tls_update(tls_id)
+                        emit_tls_update(tls_id, junction_to_tllogic)
                     except Exception:
                         pass
                 except Exception as e:
@@ -703,6 +1407,9 @@ def main():
             sumo_confs = os.path.join(project_root, 'Sumoconfigs')
             if os.path.isdir(sumo_confs) and sumo_confs not in sys.path:
                 sys.path.append(sumo_confs)
+            # The bridge reads the env's connection through traci, so keep the
+            # env off libsumo here
+            os.environ.pop('LIBSUMO_AS_TRACI', None)
             from addis_targeted_env import AddisTargetedEnvironment
         except Exception as e:
             print(json.dumps({"type": "error", "message": f"Failed to import RL env/model: {e}"}))
@@ -713,28 +1420,8 @@ def main():
         net_path = resolve_net_path_from_cfg(args.sumo_cfg)
         geo_ref = None
         if net_path:
-            net_payload = build_network_payload(net_path)
-            try:
-                net = readNet(net_path)
-                if hasattr(net, 'convertXY2LonLat'):
-                    geo_ref = net
-                    for lane in net_payload.get('lanes', []):
-                        lonlat = []
-                        for pt in lane['points']:
-                            lon, lat = net.convertXY2LonLat(pt['x'], pt['y'])
-                            lonlat.append({'lon': float(lon), 'lat': float(lat)})
-                        lane['lonlat'] = lonlat
-                    b = net_payload['bounds']
-                    minLon, minLat = net.convertXY2LonLat(b['minX'], b['minY'])
-                    maxLon, maxLat = net.convertXY2LonLat(b['maxX'], b['maxY'])
-                    net_payload['geoBounds'] = {
-                        'minLon': float(minLon), 'minLat': float(minLat),
-                        'maxLon': float(maxLon), 'maxLat': float(maxLat)
-                    }
-            except Exception:
-                pass
-            print(json.dumps(net_payload))
-            sys.stdout.flush()
+            net_payload, geo_ref, (tllogic_to_junction, junction_to_tllogic) = load_network(net_path)
+            emit(net_payload)
 
         # Initialize env and model
         env = AddisTargetedEnvironment(
@@ -792,263 +1479,52 @@ def main():
                 obs = adapt_observation(obs, expected_dim)
                 step = info.get('simulation_step', step + int(args.rl_delta))
 
-                # Collect vehicles
-                vehicles = []
-                try:
-                    ids = traci.vehicle.getIDList()
-                    vehicle_ids = ids
-                    for vid in ids:
-                        x, y = traci.vehicle.getPosition(vid)
-                        speed = traci.vehicle.getSpeed(vid)
-                        ang = traci.vehicle.getAngle(vid)
-                        item = {'id': vid, 'x': x, 'y': y, 'speed': speed, 'angle': ang}
-                        if geo_ref is not None:
-                            try:
-                                lon, lat = geo_ref.convertXY2LonLat(x, y)
-                                item['lon'] = float(lon); item['lat'] = float(lat)
-                            except Exception:
-                                pass
-                        vehicles.append(item)
-                except Exception:
-                    pass
+                if frame_due():
+                    sim_results = {}
+                    try:
+                        sim_results = fetch_simulation_results()
+                    except Exception:
+                        pass
 
-                # Collect TLS states
-                tls_states = []
-                try:
-                    for junction_id in traci.trafficlight.getIDList():
-                        state = traci.trafficlight.getRedYellowGreenState(junction_id)
-                        # Use friendly tlLogic ID if available, otherwise use junction ID
-                        display_id = junction_to_tllogic.get(junction_id, junction_id)
-                        tls_obj = {'id': display_id, 'state': state}
-                        
-                        # Store the junction_id for internal use if needed
-                        if display_id != junction_id:
-                            tls_obj['junction_id'] = junction_id
-                        # Timing info
-                        try:
-                            sim_t = float(traci.simulation.getTime())
-                            cur_idx = int(traci.trafficlight.getPhase(junction_id))
-                            num_phases = int(traci.trafficlight.getPhaseNumber(junction_id))
-                            next_sw = float(traci.trafficlight.getNextSwitch(junction_id))
-                            remaining = max(0.0, next_sw - sim_t)
-                            nxt_idx = (cur_idx + 1) % max(1, num_phases)
-                            tls_obj['timing'] = {
-                                'currentIndex': cur_idx,
-                                'numPhases': num_phases,
-                                'remaining': remaining,
-                                'nextIndex': nxt_idx,
-                                'nextSwitch': next_sw,
-                                'simTime': sim_t
-                            }
-                        except Exception:
-                            pass
-                        # Program definition
-                        try:
-                            prog_id = traci.trafficlight.getProgram(junction_id)
-                            phases_info = []
-                            try:
-                                defs = traci.trafficlight.getCompleteRedYellowGreenDefinition(junction_id)
-                                chosen = None
-                                for lg in defs:
-                                    pid = getattr(lg, 'programID', getattr(lg, 'programID', None))
-                                    if pid == prog_id or chosen is None:
-                                        chosen = lg
-                                if chosen is not None:
-                                    for idx, ph in enumerate(getattr(chosen, 'phases', [])):
-                                        try:
-                                            phases_info.append({
-                                                'index': idx,
-                                                'state': getattr(ph, 'state', ''),
-                                                'duration': float(getattr(ph, 'duration', 0) or 0),
-                                                'minDur': float(getattr(ph, 'minDur', 0) or 0),
-                                                'maxDur': float(getattr(ph, 'maxDur', 0) or 0)
-                                            })
-                                        except Exception:
-                                            phases_info.append({'index': idx})
-                            except Exception:
-                                pass
-                            tls_obj['program'] = { 'id': prog_id, 'phases': phases_info }
-                        except Exception:
-                            pass
-                        # Approximate TLS center from controlled lanes
-                        x_c = None; y_c = None
-                        try:
-                            controlled_lanes = traci.trafficlight.getControlledLanes(junction_id)
-                            xs, ys, count = 0.0, 0.0, 0
-                            for ln in controlled_lanes:
-                                try:
-                                    shape = traci.lane.getShape(ln)
-                                    if shape:
-                                        xs += float(shape[0][0]); ys += float(shape[0][1]); count += 1
-                                except Exception:
-                                    continue
-                            if count > 0:
-                                x_c = xs / count; y_c = ys / count
-                                try:
-                                    tls_obj['cx'] = float(x_c); tls_obj['cy'] = float(y_c)
-                                except Exception:
-                                    pass
-                                if geo_ref is not None:
-                                    try:
-                                        lon, lat = geo_ref.convertXY2LonLat(x_c, y_c)
-                                        tls_obj['lon'] = float(lon); tls_obj['lat'] = float(lat)
-                                    except Exception:
-                                        pass
-                        except Exception:
-                            pass
-                        # Derive per-side (N,E,S,W) summary from controlled links ordering and current state
-                        try:
-                            links = traci.trafficlight.getControlledLinks(junction_id)
-                            # links is list aligned with state entries
-                            sides = {'N': 'r', 'E': 'r', 'S': 'r', 'W': 'r'}
-                            lane_states = {}
-                            lane_angles = {}
-                            def side_bucket(dx, dy):
-                                ang = degrees(atan2(dy, dx))
-                                if -45 <= ang < 45:
-                                    return 'E'
-                                if 45 <= ang < 135:
-                                    return 'N'
-                                if -135 <= ang < -45:
-                                    return 'S'
-                                return 'W'
-                            def choose(prev, val):
-                                if prev is None:
-                                    return val
-                                if prev == 'g' or val == 'g':
-                                    return 'g'
-                                if prev == 'y' or val == 'y':
-                                    return 'y'
-                                return 'r'
-                            for idx, link_group in enumerate(links):
-                                if idx >= len(state):
-                                    break
-                                if not link_group:
-                                    continue
-                                inLane = link_group[0][0]
-                                try:
-                                    shape = traci.lane.getShape(inLane)
-                                    if shape:
-                                        px, py = shape[-1][0], shape[-1][1]
-                                        if x_c is not None and y_c is not None:
-                                            dx, dy = px - x_c, py - y_c
-                                        else:
-                                            dx, dy = px, py
-                                        side = side_bucket(dx, dy)
-                                        ch = state[idx].lower()
-                                        val = 'g' if ch == 'g' else ('y' if ch == 'y' else 'r')
-                                        cur = sides.get(side, 'r')
-                                        if cur == 'r' or (cur == 'y' and val == 'g'):
-                                            sides[side] = val
-                                        lane_states[inLane] = choose(lane_states.get(inLane), val)
-                                        lane_angles[inLane] = float(degrees(atan2(dy, dx)))
-                                except Exception:
-                                    continue
-                            tls_obj['sides'] = sides
-                            # lanes array for detailed popup rendering (include small shape near center)
-                            lanes_arr = []
-                            for ln in lane_states.keys():
-                                try:
-                                    shp = traci.lane.getShape(ln)
-                                except Exception:
-                                    shp = []
-                                pts = []
-                                try:
-                                    if shp:
-                                        seg = shp[-min(10, len(shp)):]  # last points approaching center
-                                        for px, py in seg:
-                                            pts.append({'x': float(px), 'y': float(py)})
-                                except Exception:
-                                    pass
-                                lanes_arr.append({ 'id': ln, 'state': lane_states.get(ln, 'r'), 'angle': lane_angles.get(ln, 0.0), 'shape': pts })
-                            tls_obj['lanes'] = lanes_arr
-                            # Per-side turn states (L,S,R,U)
-                            turns = {'N': {}, 'E': {}, 'S': {}, 'W': {}}
-                            def classify_turn(a_in, a_out):
-                                # normalize to [-180,180]
-                                d = (a_out - a_in + 180.0) % 360.0 - 180.0
-                                if abs(d) > 150:
-                                    return 'U'
-                                if -30 <= d <= 30:
-                                    return 'S'
-                                if d > 30:
-                                    return 'L'
-                                return 'R'
-                            for idx, link_group in enumerate(links):
-                                if idx >= len(state):
-                                    break
-                                if not link_group:
-                                    continue
-                                inLane = link_group[0][0]
-                                outLane = link_group[0][1]
-                                try:
-                                    in_shape = traci.lane.getShape(inLane)
-                                    out_shape = traci.lane.getShape(outLane)
-                                except Exception:
-                                    in_shape, out_shape = [], []
-                                if not in_shape or not out_shape:
-                                    continue
-                                try:
-                                    in_end = in_shape[-1]
-                                    out_start = out_shape[0]
-                                    a_in = degrees(atan2(in_end[1]-y_c, in_end[0]-x_c))
-                                    a_out = degrees(atan2(out_start[1]-y_c, out_start[0]-x_c))
-                                    side = side_bucket(in_end[0]-x_c, in_end[1]-y_c)
-                                    turn = classify_turn(a_in, a_out)
-                                    ch = state[idx].lower()
-                                    val = 'g' if ch == 'g' else ('y' if ch == 'y' else 'r')
-                                    prev = turns[side].get(turn)
-                                    turns[side][turn] = choose(prev, val)
-                                except Exception:
-                                    continue
-                            tls_obj['turns'] = turns
-                        except Exception:
-                            pass
-                        tls_states.append(tls_obj)
-                except Exception:
-                    pass
+                    # Collect vehicles
+                    vehicles = []
+                    veh_results = {}
+                    try:
+                        veh_results = fetch_subscription_results(traci.vehicle, VEHICLE_VARS)
+                        vehicles = collect_vehicle_payload(veh_results, geo_ref)
+                    except Exception:
+                        pass
 
-                # Get simulation statistics
-                try:
-                    stats = {
-                        'collisions': traci.simulation.getCollidingVehiclesNumber(),
-                        'emergencyStops': traci.simulation.getEmergencyStoppingVehiclesNumber(),
-                        'teleportStarts': traci.simulation.getStartingTeleportNumber(),
-                        'teleportEnds': traci.simulation.getEndingTeleportNumber(),
-                        'arrivals': traci.simulation.getArrivedNumber(),
-                        'departures': traci.simulation.getDepartedNumber(),
-                        'waitingTime': sum(traci.vehicle.getWaitingTime(vid) for vid in vehicle_ids),
-                        'totalDistanceTraveled': sum(traci.vehicle.getDistance(vid) for vid in vehicle_ids)
-                    }
-                except Exception:
-                    stats = {
-                        'collisions': 0,
-                        'emergencyStops': 0,
-                        'teleportStarts': 0,
-                        'teleportEnds': 0,
-                        'arrivals': 0,
-                        'departures': 0,
-                        'waitingTime': 0,
-                        'totalDistanceTraveled': 0
-                    }
+                    # Collect TLS states
+                    tls_states = []
+                    try:
+                        tls_results = fetch_subscription_results(traci.trafficlight, TLS_VARS)
+                        sim_t = float(sim_results[tc.VAR_TIME] if tc.VAR_TIME in sim_results else traci.simulation.getTime())
+                        tls_states = collect_tls_states(tls_results, sim_t, junction_to_tllogic, geo_ref, args.tls_diff)
+                    except Exception:
+                        pass
 
-                payload = {
-                    'type': 'viz',
-                    'step': step,
-                    'ts': int(time.time() * 1000),
-                    'vehicles': vehicles,
-                    'tls': tls_states,
-                    'stats': stats
-                }
-                print(json.dumps(payload)); sys.stdout.flush()
+                    # Get simulation statistics
+                    stats = collect_stats(sim_results, veh_results)
+
+                    payload = {
+                        'type': 'viz',
+                        'step': step,
+                        'ts': int(time.time() * 1000),
+                        # Monotonic ms for frame ordering; ts stays wall-clock for "last seen" ages
+                        'mono': time.monotonic_ns() // 1_000_000,
+                        'vehicles': vehicles,
+                        'tls': tls_states,
+                        'stats': stats
+                    }
+                    emit(payload)
 
                 # Drain and handle any pending commands from stdin
-                try:
-                    while True:
-                        cmd = cmd_queue.get_nowait()
+                for cmd in drain_queue(cmd_queue):
+                    try:
                         handle_command(cmd, tllogic_to_junction)
-                except Exception:
-                    pass
+                    except Exception:
+                        pass
 
                 if done or truncated:
                     break
@@ -1084,321 +1560,59 @@ def main():
     # Prepare network geometry
     net_path = resolve_net_path_from_cfg(args.sumo_cfg)
 
+    if USE_LIBSUMO and 'gui' in os.path.basename(sumoBinary).lower():
+        print(json.dumps({"type": "log", "level": "warn", "message": "libsumo cannot run the SUMO GUI; simulating headless"}))
+        sys.stdout.flush()
+
     traci.start(sumoCmd)
     # Emit network geometry once
     geo_ref = None
     if net_path:
-        net_payload = build_network_payload(net_path)
-        # Try to extract geo projection information, if available
-        try:
-            from sumolib.net import readNet
-            net = readNet(net_path)
-            # SUMO stores optional geo projection; if present, we can convert to lon/lat
-            # Use net.convertXY2LonLat if available
-            if hasattr(net, 'convertXY2LonLat'):
-                geo_ref = net
-                # Also include a simplified geo lanes preview (lon/lat) for Leaflet
-                for lane in net_payload.get('lanes', []):
-                    lonlat = []
-                    for pt in lane['points']:
-                        lon, lat = net.convertXY2LonLat(pt['x'], pt['y'])
-                        lonlat.append({'lon': float(lon), 'lat': float(lat)})
-                    lane['lonlat'] = lonlat
-                b = net_payload['bounds']
-                minLon, minLat = net.convertXY2LonLat(b['minX'], b['minY'])
-                maxLon, maxLat = net.convertXY2LonLat(b['maxX'], b['maxY'])
-                net_payload['geoBounds'] = {
-                    'minLon': float(minLon),
-                    'minLat': float(minLat),
-                    'maxLon': float(maxLon),
-                    'maxLat': float(maxLat)
-                }
-        except Exception:
-            pass
-        print(json.dumps(net_payload))
-        sys.stdout.flush()
+        net_payload, geo_ref, (tllogic_to_junction, junction_to_tllogic) = load_network(net_path)
+        emit(net_payload)
 
     step = 0
     try:
         while True:
             traci.simulationStep()
             step += 1
-            vehicle_ids = traci.vehicle.getIDList()
-            vehicles = []
-            for vid in vehicle_ids:
-                x, y = traci.vehicle.getPosition(vid)
-                speed = traci.vehicle.getSpeed(vid)
-                ang = traci.vehicle.getAngle(vid)  # degrees
-                length = traci.vehicle.getLength(vid)
-                width = traci.vehicle.getWidth(vid)
-                vtype = traci.vehicle.getTypeID(vid)
-                item = {
-                    'id': vid,
-                    'x': x,
-                    'y': y,
-                    'speed': speed,
-                    'angle': ang,
-                    'length': length,
-                    'width': width,
-                    'type': vtype
-                }
-                if geo_ref is not None:
-                    try:
-                        lon, lat = geo_ref.convertXY2LonLat(x, y)
-                        item['lon'] = float(lon)
-                        item['lat'] = float(lat)
-                    except Exception:
-                        pass
-                vehicles.append(item)
+            if frame_due():
+                sim_results = fetch_simulation_results()
+                veh_results = fetch_subscription_results(traci.vehicle, VEHICLE_VARS)
+                vehicles = collect_vehicle_payload(veh_results, geo_ref)
 
-            # Traffic light states with approximate geometry and per-side summary
-            tls_states = []
-            try:
-                for junction_id in traci.trafficlight.getIDList():
-                    state = traci.trafficlight.getRedYellowGreenState(junction_id)
-                    # Use friendly tlLogic ID if available, otherwise use junction ID
-                    display_id = junction_to_tllogic.get(junction_id, junction_id)
-                    tls_obj = {'id': display_id, 'state': state}
-                    
-                    # Store the junction_id for internal use if needed
-                    if display_id != junction_id:
-                        tls_obj['junction_id'] = junction_id
-                    # Timing info
-                    try:
-                        sim_t = float(traci.simulation.getTime())
-                        cur_idx = int(traci.trafficlight.getPhase(junction_id))
-                        num_phases = int(traci.trafficlight.getPhaseNumber(junction_id))
-                        next_sw = float(traci.trafficlight.getNextSwitch(junction_id))
-                        remaining = max(0.0, next_sw - sim_t)
-                        nxt_idx = (cur_idx + 1) % max(1, num_phases)
-                        tls_obj['timing'] = {
-                            'currentIndex': cur_idx,
-                            'numPhases': num_phases,
-                            'remaining': remaining,
-                            'nextIndex': nxt_idx,
-                            'nextSwitch': next_sw,
-                            'simTime': sim_t
-                        }
-                    except Exception:
-                        pass
-                    # Program definition
-                    try:
-                        prog_id = traci.trafficlight.getProgram(junction_id)
-                        phases_info = []
-                        try:
-                            defs = traci.trafficlight.getCompleteRedYellowGreenDefinition(junction_id)
-                            chosen = None
-                            for lg in defs:
-                                pid = getattr(lg, 'programID', getattr(lg, 'programID', None))
-                                if pid == prog_id or chosen is None:
-                                    chosen = lg
-                            if chosen is not None:
-                                for idx, ph in enumerate(getattr(chosen, 'phases', [])):
-                                    try:
-                                        phases_info.append({
-                                            'index': idx,
-                                            'state': getattr(ph, 'state', ''),
-                                            'duration': float(getattr(ph, 'duration', 0) or 0),
-                                            'minDur': float(getattr(ph, 'minDur', 0) or 0),
-                                            'maxDur': float(getattr(ph, 'maxDur', 0) or 0)
-                                        })
-                                    except Exception:
-                                        phases_info.append({'index': idx})
-                        except Exception:
-                            pass
-                        tls_obj['program'] = { 'id': prog_id, 'phases': phases_info }
-                    except Exception:
-                        pass
-                    # Approximate TLS center from controlled lanes
-                    x_c = None; y_c = None
-                    try:
-                        controlled_lanes = traci.trafficlight.getControlledLanes(junction_id)
-                        xs, ys, count = 0.0, 0.0, 0
-                        for ln in controlled_lanes:
-                            try:
-                                shape = traci.lane.getShape(ln)
-                                if shape:
-                                    xs += float(shape[0][0])
-                                    ys += float(shape[0][1])
-                                    count += 1
-                            except Exception:
-                                continue
-                        if count > 0:
-                            x_c = xs / count
-                            y_c = ys / count
-                            try:
-                                tls_obj['cx'] = float(x_c); tls_obj['cy'] = float(y_c)
-                            except Exception:
-                                pass
-                            if geo_ref is not None:
-                                try:
-                                    lon, lat = geo_ref.convertXY2LonLat(x_c, y_c)
-                                    tls_obj['lon'] = float(lon)
-                                    tls_obj['lat'] = float(lat)
-                                except Exception:
-                                    pass
-                    except Exception:
-                        pass
-                    # Per-side summary
-                    try:
-                        links = traci.trafficlight.getControlledLinks(junction_id)
-                        sides = {'N': 'r', 'E': 'r', 'S': 'r', 'W': 'r'}
-                        lane_states = {}
-                        lane_angles = {}
-                        def side_bucket(dx, dy):
-                            ang = degrees(atan2(dy, dx))
-                            if -45 <= ang < 45:
-                                return 'E'
-                            if 45 <= ang < 135:
-                                return 'N'
-                            if -135 <= ang < -45:
-                                return 'S'
-                            return 'W'
-                        def choose(prev, val):
-                            if prev is None:
-                                return val
-                            if prev == 'g' or val == 'g':
-                                return 'g'
-                            if prev == 'y' or val == 'y':
-                                return 'y'
-                            return 'r'
-                        for idx, link_group in enumerate(links):
-                            if idx >= len(state):
-                                break
-                            if not link_group:
-                                continue
-                            inLane = link_group[0][0]
-                            try:
-                                shape = traci.lane.getShape(inLane)
-                                if shape:
-                                    px, py = shape[-1][0], shape[-1][1]
-                                    if x_c is not None and y_c is not None:
-                                        dx, dy = px - x_c, py - y_c
-                                    else:
-                                        dx, dy = px, py
-                                    side = side_bucket(dx, dy)
-                                    ch = state[idx].lower()
-                                    val = 'g' if ch == 'g' else ('y' if ch == 'y' else 'r')
-                                    cur = sides.get(side, 'r')
-                                    if cur == 'r' or (cur == 'y' and val == 'g'):
-                                        sides[side] = val
-                                    lane_states[inLane] = choose(lane_states.get(inLane), val)
-                                    lane_angles[inLane] = float(degrees(atan2(dy, dx)))
-                            except Exception:
-                                continue
-                        tls_obj['sides'] = sides
-                        lanes_arr = []
-                        for ln in lane_states.keys():
-                            try:
-                                shp = traci.lane.getShape(ln)
-                            except Exception:
-                                shp = []
-                            pts = []
-                            try:
-                                if shp:
-                                    seg = shp[-min(10, len(shp)):]  # last points approaching center
-                                    for px, py in seg:
-                                        pts.append({'x': float(px), 'y': float(py)})
-                            except Exception:
-                                pass
-                            lanes_arr.append({ 'id': ln, 'state': lane_states.get(ln, 'r'), 'angle': lane_angles.get(ln, 0.0), 'shape': pts })
-                        tls_obj['lanes'] = lanes_arr
-                        # Per-side turn states (L,S,R,U)
-                        turns = {'N': {}, 'E': {}, 'S': {}, 'W': {}}
-                        def classify_turn(a_in, a_out):
-                            d = (a_out - a_in + 180.0) % 360.0 - 180.0
-                            if abs(d) > 150:
-                                return 'U'
-                            if -30 <= d <= 30:
-                                return 'S'
-                            if d > 30:
-                                return 'L'
-                            return 'R'
-                        for idx, link_group in enumerate(links):
-                            if idx >= len(state):
-                                break
-                            if not link_group:
-                                continue
-                            inLane = link_group[0][0]
-                            outLane = link_group[0][1]
-                            try:
-                                in_shape = traci.lane.getShape(inLane)
-                                out_shape = traci.lane.getShape(outLane)
-                            except Exception:
-                                in_shape, out_shape = [], []
-                            if not in_shape or not out_shape:
-                                continue
-                            try:
-                                in_end = in_shape[-1]
-                                out_start = out_shape[0]
-                                a_in = degrees(atan2(in_end[1]-y_c, in_end[0]-x_c))
-                                a_out = degrees(atan2(out_start[1]-y_c, out_start[0]-x_c))
-                                side = side_bucket(in_end[0]-x_c, in_end[1]-y_c)
-                                turn = classify_turn(a_in, a_out)
-                                ch = state[idx].lower()
-                                val = 'g' if ch == 'g' else ('y' if ch == 'y' else 'r')
-                                prev = turns[side].get(turn)
-                                if 'choose' in globals():
-                                    turns[side][turn] = choose(prev, val)
-                                else:
-                                    turns[side][turn] = val
-                            except Exception:
-                                continue
-                        tls_obj['turns'] = turns
-                    except Exception:
-                        pass
-                    tls_states.append(tls_obj)
-            except Exception:
-                pass
+                tls_states = []
+                try:
+                    tls_results = fetch_subscription_results(traci.trafficlight, TLS_VARS)
+                    sim_t = float(sim_results[tc.VAR_TIME] if tc.VAR_TIME in sim_results else traci.simulation.getTime())
+                    tls_states = collect_tls_states(tls_results, sim_t, junction_to_tllogic, geo_ref, args.tls_diff)
+                except Exception:
+                    pass
 
-            # Get simulation statistics
-            try:
-                stats = {
-                    'collisions': traci.simulation.getCollidingVehiclesNumber(),
-                    'emergencyStops': traci.simulation.getEmergencyStoppingVehiclesNumber(),
-                    'teleportStarts': traci.simulation.getStartingTeleportNumber(),
-                    'teleportEnds': traci.simulation.getEndingTeleportNumber(),
-                    'arrivals': traci.simulation.getArrivedNumber(),
-                    'departures': traci.simulation.getDepartedNumber(),
-                    'waitingTime': sum(traci.vehicle.getWaitingTime(vid) for vid in vehicle_ids),
-                    'totalDistanceTraveled': sum(traci.vehicle.getDistance(vid) for vid in vehicle_ids)
-                }
-            except Exception:
-                stats = {
-                    'collisions': 0,
-                    'emergencyStops': 0,
-                    'teleportStarts': 0,
-                    'teleportEnds': 0,
-                    'arrivals': 0,
-                    'departures': 0,
-                    'waitingTime': 0,
-                    'totalDistanceTraveled': 0
-                }
+                # Get simulation statistics
+                stats = collect_stats(sim_results, veh_results)
 
-            payload = {
-                'type': 'viz',
-                'step': step,
-                'ts': int(time.time() * 1000),
-                'vehicles': vehicles,
-                'tls': tls_states,
-                'stats': stats
-            }
-            print(json.dumps(payload))
-            sys.stdout.flush()
+                payload = {
+                    'type': 'viz',
+                    'step': step,
+                    'ts': int(time.time() * 1000),
+                    # Monotonic ms for frame ordering; ts stays wall-clock for "last seen" ages
+                    'mono': time.monotonic_ns() // 1_000_000,
+                    'vehicles': vehicles,
+                    'tls': tls_states,
+                    'stats': stats
+                }
+                emit(payload)
 
             # Drain and handle any pending commands from stdin
-            try:
-                while True:
-                    cmd = cmd_queue.get_nowait()
+            for cmd in drain_queue(cmd_queue):
+                try:
                     print(json.dumps({"type": "log", "level": "info", "message": f"Processing command: {cmd}"}))
                     sys.stdout.flush()
                     handle_command(cmd, tllogic_to_junction)
-            except queue.Empty:
-                # No more commands to process, this is normal
-                pass
-            except Exception as e:
-                print(json.dumps({"type": "log", "level": "error", "message": f"Command processing error: {e}"}))
-                sys.stdout.flush()
+                except Exception as e:
+                    print(json.dumps({"type": "log", "level": "error", "message": f"Command processing error: {e}"}))
+                    sys.stdout.flush()
 
     except KeyboardInterrupt:
         pass
@@ -1410,10 +1624,6 @@ def main():
             traci.close(False)
         except Exception:
             pass
-        try:
-            traci.close(False)
-        except Exception:
-            pass
 
 
 if __name__ == '__main__':
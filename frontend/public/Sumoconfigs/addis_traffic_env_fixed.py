@@ -20,10 +20,14 @@ import sys
 import numpy as np
 import pandas as pd
 from collections import defaultdict, deque
-from typing import Dict, List, Tuple, Optional, Any
+from functools import partial
+from typing import Dict, List, Set, Tuple, Optional, Any
 import gymnasium as gym
 from gymnasium import spaces
 import warnings
+import logging
+
+from numba_compat import njit
 
 # SUMO imports
 if 'SUMO_HOME' in os.environ:
@@ -32,9 +36,92 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("Please declare environment variable 'SUMO_HOME'")
 
-import traci
+# libsumo embeds SUMO in this process (same API, no socket round-trips) but has
+# no GUI; set LIBSUMO_AS_TRACI to use it for headless runs
+USE_LIBSUMO = bool(os.environ.get('LIBSUMO_AS_TRACI'))
+if USE_LIBSUMO:
+    try:
+        import libsumo as traci
+    except ImportError:
+        USE_LIBSUMO = False
+if not USE_LIBSUMO:
+    import traci
+import traci.constants as tc
 import sumolib
 
+logger = logging.getLogger(__name__)
+
+# Lane variables subscribed once per controlled lane, so each step's values
+# arrive with the simulationStep response rather than as separate getter calls
+LANE_VARS = [
+    tc.LAST_STEP_VEHICLE_NUMBER,
+    tc.LAST_STEP_VEHICLE_HALTING_NUMBER,
+    tc.LAST_STEP_MEAN_SPEED,
+    tc.VAR_WAITING_TIME,
+]
+
+# Per-lane metrics (columns of TrafficLightManager.metrics, get_lane_metrics keys)
+# and the scale each one is divided by to land in [0,1] in the observation
+LANE_METRICS = ('vehicle_count', 'queue_length', 'waiting_time', 'mean_speed',
+                'occupancy', 'density', 'flow_rate')
+LANE_OBS_SCALE = np.array([50, 30, 300, 50, 1, 100, 500], dtype=np.float64)
+
+@njit(cache=True)
+def phase_score(signal_green, link_signal, link_lane, metrics, last_green, sim_step, max_red_time):
+    """
+    Demand plus fairness score of one phase: sum over links whose signal is green
+    in signal_green and whose incoming lane has a metrics row (link_lane >= 0).
+    """
+    score = 0.0
+    for k in range(link_signal.shape[0]):
+        lane = link_lane[k]
+        if lane < 0 or not signal_green[link_signal[k]]:
+            continue
+        # Score based on demand and fairness
+        demand_score = metrics[lane, 1] * 3 + metrics[lane, 2] * 0.01 + metrics[lane, 0] * 0.5
+        # Fairness bonus for lanes that haven't been green recently
+        fairness_bonus = min((sim_step - last_green[lane]) / max_red_time * 5, 10)
+        score += demand_score + fairness_bonus
+    return score
+
+@njit(cache=True)
+def phase_scores(phase_signal_green, phase_ids, link_signal, link_lane, metrics, last_green, sim_step, max_red_time):
+    """phase_score of every phase in phase_ids, in one compiled call"""
+    scores = np.empty(phase_ids.shape[0])
+    for p in range(phase_ids.shape[0]):
+        scores[p] = phase_score(phase_signal_green[phase_ids[p]], link_signal, link_lane,
+                                metrics, last_green, sim_step, max_red_time)
+    return scores
+
+@njit(cache=True)
+def most_starved_lane(last_green, current_time, green_mask):
+    """Index and red time of the non-green lane waiting longest for green; (-1, 0) if none is red"""
+    lane = -1
+    max_starvation_time = 0
+    for i in range(last_green.shape[0]):
+        if not green_mask[i]:
+            time_since_green = current_time - last_green[i]
+            if time_since_green > max_starvation_time:
+                max_starvation_time = time_since_green
+                lane = i
+    return lane, max_starvation_time
+
+def derive_lane_metrics(raw, occupancy_length, density_km, out):
+    """Fill out (n_lanes, 7) with the LANE_METRICS derived from raw (n_lanes, len(LANE_VARS)) lane values"""
+    vehicle_count, queue_length, mean_speed, waiting_time = raw.T
+    
+    # Calculate occupancy and density, capped for normalization
+    occupancy = np.minimum(vehicle_count * 5.0 / occupancy_length, 1.0)
+    density = np.minimum(vehicle_count / density_km, 100)
+    flow_rate = np.where(mean_speed > 0, np.minimum(vehicle_count * mean_speed, 500), 0)
+    
+    out[:] = np.column_stack((
+        np.minimum(vehicle_count, 50),  # Cap at 50 for normalization
+        np.minimum(queue_length, 30),   # Cap at 30
+        np.minimum(waiting_time, 300),  # Cap at 5 minutes
+        mean_speed, occupancy, density, flow_rate,
+    ))
+
 class TrafficLightManager:
     """Manages individual traffic lights with improved fairness constraints"""
     
@@ -52,33 +139,72 @@ class TrafficLightManager:
         self.phase_start_time = 0
         self.last_action_time = 0
         
-        # Fairness tracking - with longer patience
-        self.lane_last_green = defaultdict(lambda: -max_red_time)
-        self.lane_total_waiting_time = defaultdict(float)
-        self.lane_max_waiting_time = defaultdict(float)
-        
         # Performance metrics
         self.total_throughput = 0
         self.total_waiting_time = 0
         self.phase_switches = 0
         
+        # Static link topology: controlled links and the incoming lane of each link per signal index
+        self.controlled_links = self._get_controlled_links()
+        self.signal_lanes = [[link[0] for link in link_list] for link_list in self.controlled_links]
+        
         # Get controlled lanes
         self.controlled_lanes = self._get_controlled_lanes()
         self.green_phases = self._identify_green_phases()
+        self.lane_best_phase = self._build_lane_best_phase()
+        
+        # Fairness tracking - parallel arrays indexed like controlled_lanes
+        self.lane_index = {lane: i for i, lane in enumerate(self.controlled_lanes)}
+        n_lanes = len(self.controlled_lanes)
+        
+        # Every controlled link flattened: its signal index and its incoming lane's row (-1 if not controlled)
+        links = [(signal, self.lane_index.get(lane, -1))
+                 for signal, signal_lanes in enumerate(self.signal_lanes) for lane in signal_lanes]
+        self.link_signal = np.array([signal for signal, _ in links], dtype=np.int64)
+        self.link_lane = np.array([lane_idx for _, lane_idx in links], dtype=np.int64)
+        
+        # Phase programs are static: green signal indices of every phase, computed once
+        self.phase_signal_green = np.zeros((len(self.phases), len(self.controlled_links)), dtype=bool)
+        for phase_idx, phase in enumerate(self.phases):
+            self.phase_signal_green[phase_idx] = self.signal_green(phase.state)
+        self.green_phase_ids = np.array([p for p in self.green_phases if p < len(self.phases)], dtype=np.int64)
+        
+        self.lane_last_green = np.full(n_lanes, -max_red_time, dtype=np.int32)
+        self.lane_total_waiting_time = np.zeros(n_lanes, dtype=np.float64)
+        self.lane_max_waiting_time = np.zeros(n_lanes, dtype=np.float64)
+        
+        # Subscription results for the current step, handed in by the environment;
+        # tls_state is None until the next step after a phase was set
+        self.lane_lengths = {}
+        self.lane_results = {}
+        self.tls_state = None
+        self._subscribe()
+        
+        # This step's raw LANE_VARS values and derived LANE_METRICS, one row per controlled lane;
+        # filled once per step by refresh_metrics() and shared by every consumer
+        self.lane_raw = np.zeros((n_lanes, len(LANE_VARS)))
+        self.metrics = np.zeros((n_lanes, len(LANE_METRICS)))
         
         # Emergency switch cooldown to prevent rapid switching
         self.last_emergency_switch = -120
         self.emergency_cooldown = 30  # Minimum time between emergency switches
         
+    def _get_controlled_links(self) -> List:
+        """Fetch the controlled links once; they don't change during a simulation"""
+        try:
+            return traci.trafficlight.getControlledLinks(self.tls_id)
+        except Exception as e:
+            print(f"Warning: Could not get controlled links for {self.tls_id}: {e}")
+            return []
+    
     def _get_controlled_lanes(self) -> List[str]:
         """Get all lanes controlled by this traffic light"""
         try:
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
             lanes = []
-            for link_list in controlled_links:
-                for link in link_list:
-                    if link[0] and link[0] not in lanes:  # incoming lane
-                        lanes.append(link[0])
+            for signal_lanes in self.signal_lanes:
+                for lane in signal_lanes:
+                    if lane and lane not in lanes:  # incoming lane
+                        lanes.append(lane)
             
             # If no lanes found through links, try alternative approach
             if not lanes:
@@ -98,6 +224,38 @@ class TrafficLightManager:
             print(f"Warning: Could not get controlled lanes for {self.tls_id}: {e}")
             return []
     
+    def _subscribe(self):
+        """Subscribe to this light's signal state and its lanes' metrics; cache lane lengths"""
+        try:
+            traci.trafficlight.subscribe(self.tls_id, [tc.TL_RED_YELLOW_GREEN_STATE])
+        except Exception as e:
+            print(f"Warning: Could not subscribe to traffic light {self.tls_id}: {e}")
+        for lane in self.controlled_lanes:
+            try:
+                traci.lane.subscribe(lane, LANE_VARS)
+                self.lane_lengths[lane] = traci.lane.getLength(lane)
+            except Exception as e:
+                print(f"Warning: Could not subscribe to lane {lane}: {e}")
+        self.lane_length_array = np.array([self.lane_lengths.get(lane, 0.0) for lane in self.controlled_lanes])
+        # Lane lengths are static, so the occupancy and density divisors are derived once here
+        self.lane_occupancy_length = np.maximum(self.lane_length_array, 1)
+        self.lane_density_km = np.maximum(self.lane_length_array / 1000, 0.1)
+        # Lanes that failed here are never read on the step path; their metric rows stay zero
+        self.lane_valid = np.array([lane in self.lane_lengths for lane in self.controlled_lanes], dtype=bool)
+    
+    def _lane_values(self, lane: str) -> Dict[int, float]:
+        """LANE_VARS values of a lane for the current step"""
+        values = self.lane_results.get(lane)
+        if not values:
+            # No subscription results yet (observation right after reset)
+            values = {
+                tc.LAST_STEP_VEHICLE_NUMBER: traci.lane.getLastStepVehicleNumber(lane),
+                tc.LAST_STEP_VEHICLE_HALTING_NUMBER: traci.lane.getLastStepHaltingNumber(lane),
+                tc.LAST_STEP_MEAN_SPEED: traci.lane.getLastStepMeanSpeed(lane),
+                tc.VAR_WAITING_TIME: traci.lane.getWaitingTime(lane),
+            }
+        return values
+    
     def _identify_green_phases(self) -> List[int]:
         """Identify which phases are green (non-yellow, non-red)"""
         green_phases = []
@@ -118,111 +276,94 @@ class TrafficLightManager:
         if current_time - self.last_emergency_switch < self.emergency_cooldown:
             return False, None
             
-        current_green_lanes = self._get_current_green_lanes()
-        
         # Only trigger emergency if SEVERELY starved (90% of max red time)
         emergency_threshold = self.max_red_time * 0.9
         
-        most_starved_lane = None
-        max_starvation_time = 0
-        
-        for lane in self.controlled_lanes:
-            if lane not in current_green_lanes:
-                time_since_green = current_time - self.lane_last_green[lane]
-                if time_since_green > emergency_threshold and time_since_green > max_starvation_time:
-                    max_starvation_time = time_since_green
-                    most_starved_lane = lane
+        most_starved, max_starvation_time = most_starved_lane(
+            self.lane_last_green, current_time, self._current_green_mask())
         
-        if most_starved_lane:
+        if most_starved >= 0 and max_starvation_time > emergency_threshold:
             # Find best phase for the most starved lane
-            best_phase = self._find_best_phase_for_lane(most_starved_lane)
+            best_phase = self._find_best_phase_for_lane(self.controlled_lanes[most_starved])
             if best_phase is not None and best_phase != self.current_phase:
                 self.last_emergency_switch = current_time
                 return True, best_phase
         
         return False, None
     
-    def _get_current_green_lanes(self) -> List[str]:
+    def _current_state(self) -> str:
+        """Current signal state string, from this step's subscription when available"""
+        if self.tls_state is not None:
+            return self.tls_state
+        return traci.trafficlight.getRedYellowGreenState(self.tls_id)
+    
+    def _get_current_green_lanes(self) -> Set[str]:
         """Get lanes that are currently green"""
-        try:
-            current_state = traci.trafficlight.getRedYellowGreenState(self.tls_id)
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            
-            green_lanes = []
-            for i, (state_char, link_list) in enumerate(zip(current_state, controlled_links)):
-                if state_char in ['G', 'g']:
-                    for link in link_list:
-                        if link[0] and link[0] not in green_lanes:
-                            green_lanes.append(link[0])
-            return green_lanes
-        except:
-            return []
+        current_state = self._current_state()
+        
+        green_lanes = set()
+        for state_char, signal_lanes in zip(current_state, self.signal_lanes):
+            if state_char in ['G', 'g']:
+                green_lanes.update(lane for lane in signal_lanes if lane)
+        return green_lanes
+    
+    def signal_green(self, state: str) -> np.ndarray:
+        """Boolean per signal index (controlled link list) that is green in a signal state string"""
+        green = np.zeros(len(self.controlled_links), dtype=bool)
+        chars = np.frombuffer(state[:len(green)].encode('ascii'), dtype=np.uint8)
+        green[:len(chars)] = (chars == ord('G')) | (chars == ord('g'))
+        return green
+    
+    def _current_green_mask(self) -> np.ndarray:
+        """Boolean mask over controlled_lanes of the lanes that are currently green"""
+        green_mask = np.zeros(len(self.controlled_lanes), dtype=bool)
+        signal_green = self.signal_green(self._current_state())
+        green_links = (self.link_lane >= 0) & signal_green[self.link_signal]
+        green_mask[self.link_lane[green_links]] = True
+        return green_mask
+    
+    def starvation_times(self, current_time: int) -> np.ndarray:
+        """Time since each controlled lane was last green; 0 for lanes that are green now"""
+        return np.where(self._current_green_mask(), 0, current_time - self.lane_last_green)
+    
+    def _build_lane_best_phase(self) -> Dict[str, int]:
+        """Map each lane to the first green phase that gives it green"""
+        lane_best_phase = {}
+        for phase_idx in self.green_phases:
+            if phase_idx < len(self.phases):
+                phase_state = self.phases[phase_idx].state
+                for state_char, signal_lanes in zip(phase_state, self.signal_lanes):
+                    if state_char in ['G', 'g']:
+                        for lane in signal_lanes:
+                            lane_best_phase.setdefault(lane, phase_idx)
+        return lane_best_phase
     
     def _find_best_phase_for_lane(self, lane: str) -> Optional[int]:
         """Find the best green phase for a specific lane"""
-        try:
-            controlled_links = traci.trafficlight.getControlledLinks(self.tls_id)
-            
-            for phase_idx in self.green_phases:
-                if phase_idx < len(self.phases):
-                    phase_state = self.phases[phase_idx].state
-                    for i, (state_char, link_list) in enumerate(zip(phase_state, controlled_links)):
-                        if state_char in ['G', 'g']:
-                            for link in link_list:
-                                if link[0] == lane:
-                                    return phase_idx
-            return None
-        except:
-            return None
+        return self.lane_best_phase.get(lane)
+    
+    def refresh_metrics(self):
+        """Read this step's lane values once and derive the per-lane metrics array"""
+        raw = self.lane_raw  # Filled in place: may be a view into the environment's stacked array
+        for i, lane in enumerate(self.controlled_lanes):
+            if self.lane_valid[i]:
+                values = self._lane_values(lane)
+                raw[i] = [values[var] for var in LANE_VARS]
+        derive_lane_metrics(raw, self.lane_occupancy_length, self.lane_density_km, self.metrics)
     
     def get_lane_metrics(self) -> Dict[str, Dict[str, float]]:
         """Get comprehensive metrics for each controlled lane"""
-        metrics = {}
-        
-        for lane in self.controlled_lanes:
-            try:
-                # Basic traffic metrics
-                vehicle_count = traci.lane.getLastStepVehicleNumber(lane)
-                queue_length = traci.lane.getLastStepHaltingNumber(lane)
-                mean_speed = traci.lane.getLastStepMeanSpeed(lane)
-                waiting_time = traci.lane.getWaitingTime(lane)
-                
-                # Calculate occupancy and density
-                lane_length = traci.lane.getLength(lane)
-                occupancy = min(vehicle_count * 5.0 / max(lane_length, 1), 1.0)  # Normalized
-                
-                metrics[lane] = {
-                    'vehicle_count': min(vehicle_count, 50),  # Cap at 50 for normalization
-                    'queue_length': min(queue_length, 30),   # Cap at 30
-                    'waiting_time': min(waiting_time, 300),  # Cap at 5 minutes
-                    'mean_speed': mean_speed,
-                    'occupancy': occupancy,
-                    'density': min(vehicle_count / max(lane_length / 1000, 0.1), 100),  # Cap density
-                    'flow_rate': min(vehicle_count * mean_speed, 500) if mean_speed > 0 else 0  # Cap flow
-                }
-            except:
-                metrics[lane] = {
-                    'vehicle_count': 0, 'queue_length': 0, 'waiting_time': 0,
-                    'mean_speed': 0, 'occupancy': 0, 'density': 0, 'flow_rate': 0
-                }
-        
-        return metrics
+        return {lane: dict(zip(LANE_METRICS, row))
+                for lane, row in zip(self.controlled_lanes, self.metrics.tolist())}
     
     def update_fairness_metrics(self, current_time: int):
         """Update fairness tracking metrics"""
-        current_green_lanes = self._get_current_green_lanes()
+        self.lane_last_green[self._current_green_mask()] = current_time
         
-        for lane in self.controlled_lanes:
-            if lane in current_green_lanes:
-                self.lane_last_green[lane] = current_time
-            
-            # Update waiting time metrics
-            try:
-                waiting_time = traci.lane.getWaitingTime(lane)
-                self.lane_total_waiting_time[lane] += waiting_time
-                self.lane_max_waiting_time[lane] = max(self.lane_max_waiting_time[lane], waiting_time)
-            except:
-                pass
+        # Update waiting time metrics
+        waiting_times = self.lane_raw[:, LANE_VARS.index(tc.VAR_WAITING_TIME)]
+        self.lane_total_waiting_time += waiting_times
+        np.maximum(self.lane_max_waiting_time, waiting_times, out=self.lane_max_waiting_time)
 
 
 class AddisTrafficEnvironment(gym.Env):
@@ -260,8 +401,17 @@ class AddisTrafficEnvironment(gym.Env):
         # Environment state
         self.simulation_step = 0
         self.traffic_lights = {}
-        self.metrics_history = []
-        self.episode_metrics = defaultdict(list)
+        # Light ids and managers in control order, cached by _detect_traffic_lights for the episode
+        self._tls_list: Tuple[str, ...] = ()
+        self._tls_objs: Tuple[TrafficLightManager, ...] = ()
+        # Per-step history is bounded to one episode of agent steps so long runs don't grow it
+        self.history_length = max(1, num_seconds // delta_time)
+        self.metrics_history = deque(maxlen=self.history_length)
+        self.episode_metrics = defaultdict(partial(deque, maxlen=self.history_length))
+        
+        # Lane arrays of all traffic lights stacked; each manager's lane_raw/metrics are views into these
+        self.all_lane_raw = np.zeros((0, len(LANE_VARS)))
+        self.all_lane_metrics = np.zeros((0, len(LANE_METRICS)))
         
         # Performance tracking
         self.baseline_metrics = None
@@ -269,8 +419,9 @@ class AddisTrafficEnvironment(gym.Env):
         self.total_throughput = 0
         self.total_waiting_time = 0
         
-        # Emergency switch tracking
+        # Emergency switch tracking: count plus the most recent (step, tls_id, phase) events
         self.emergency_switches_count = 0
+        self.emergency_log = deque(maxlen=1000)
         
         # Initialize RL interface with reasonable fixed spaces
         self._setup_fixed_spaces()
@@ -288,11 +439,45 @@ class AddisTrafficEnvironment(gym.Env):
             low=0.0, high=1.0, shape=(obs_dim,), dtype=np.float32
         )
         
+        # Observation buffers reused by every _get_observation call: the output vector, and the
+        # float64 staging vector of raw features with its per-TLS blocks of 2 state features +
+        # 10 lane slots * 7 metrics as a view
+        max_tls = self.max_traffic_lights
+        self._obs_buf = np.zeros(obs_dim, dtype=np.float32)
+        self._obs_raw = np.zeros(obs_dim)
+        self._tls_obs_raw = self._obs_raw[:max_tls * 72].reshape(max_tls, 72)
+        self._global_obs_raw = self._obs_raw[max_tls * 72:]
+        
+        # Scale of every feature, so the raw vector is normalized in one pass: phase index
+        # (scaled by each light's phase count, see _set_phase_scales), time since switch, lane
+        # metrics and global metrics
+        self._obs_scale = np.ones(obs_dim)
+        tls_scale = self._obs_scale[:max_tls * 72].reshape(max_tls, 72)
+        tls_scale[:, 1] = 100
+        tls_scale[:, 2:] = np.tile(LANE_OBS_SCALE, 10)
+        self._obs_scale[max_tls * 72:max_tls * 72 + 6] = [
+            1000,               # Total vehicles
+            10000,              # Total waiting
+            50,                 # Avg speed
+            self.num_seconds,   # Progress
+            max_tls,            # TLS utilization
+            100,                # Emergency switches
+        ]
+    
+    def _set_phase_scales(self):
+        """Scale each light's phase index feature by its phase count"""
+        phase_scale = self._obs_scale[:self.max_traffic_lights * 72:72]
+        phase_scale[:] = 1
+        for i, tls in enumerate(self._tls_objs[:self.max_traffic_lights]):
+            phase_scale[i] = max(len(tls.phases), 1)
+        
     def _start_sumo(self):
         """Start SUMO simulation"""
         sumo_cmd = []
         
-        if self.use_gui:
+        if self.use_gui and USE_LIBSUMO:
+            print("libsumo cannot run the SUMO GUI; simulating headless")
+        if self.use_gui and not USE_LIBSUMO:
             sumo_cmd = ["sumo-gui"]
         else:
             sumo_cmd = ["sumo"]
@@ -377,16 +562,40 @@ class AddisTrafficEnvironment(gym.Env):
         except Exception as e:
             print(f"Error detecting traffic lights: {e}")
             self.traffic_lights = {}
+        
+        self._tls_list = tuple(self.traffic_lights.keys())
+        self._tls_objs = tuple(self.traffic_lights.values())
+        self._stack_lane_arrays()
+        self._set_phase_scales()
+    
+    def _stack_lane_arrays(self):
+        """Back every light's lane arrays with one env-wide array so global reductions need no concatenation"""
+        lights = self._tls_objs
+        lane_counts = [len(tls.controlled_lanes) for tls in lights]
+        self.all_lane_raw = np.zeros((sum(lane_counts), len(LANE_VARS)))
+        self.all_lane_metrics = np.zeros((sum(lane_counts), len(LANE_METRICS)))
+        
+        start = 0
+        for tls, n_lanes in zip(lights, lane_counts):
+            tls.lane_raw = self.all_lane_raw[start:start + n_lanes]
+            tls.metrics = self.all_lane_metrics[start:start + n_lanes]
+            start += n_lanes
+        
+        # Flat lane index over the stacked rows: lane id and (owning light, local index) of each row,
+        # plus the static length divisors in the same order, so metrics are refreshed in one pass
+        self.all_lanes = [lane for tls in lights for lane in tls.controlled_lanes]
+        self.lane_owner = [(tls, i) for tls in lights for i in range(len(tls.controlled_lanes))]
+        self.all_lane_occupancy_length = np.concatenate(
+            [np.zeros(0, dtype=np.float64)] + [tls.lane_occupancy_length for tls in lights])
+        self.all_lane_density_km = np.concatenate(
+            [np.zeros(0, dtype=np.float64)] + [tls.lane_density_km for tls in lights])
     
     def reset(self, seed=None, options=None):
         """Reset the environment"""
         super().reset(seed=seed)
         
-        try:
-            if traci.isLoaded():
-                traci.close()
-        except:
-            pass
+        if traci.isLoaded():
+            traci.close()
         
         self._start_sumo()
         
@@ -400,8 +609,9 @@ class AddisTrafficEnvironment(gym.Env):
         self.episode_reward = 0
         self.total_throughput = 0
         self.total_waiting_time = 0
-        self.metrics_history = []
+        self.metrics_history = deque(maxlen=self.history_length)
         self.emergency_switches_count = 0
+        self.emergency_log.clear()
         
         # Initialize traffic light states
         for tls in self.traffic_lights.values():
@@ -409,6 +619,7 @@ class AddisTrafficEnvironment(gym.Env):
             tls.time_since_last_switch = 0
             tls.last_emergency_switch = -120
         
+        self._refresh_subscriptions()
         observation = self._get_observation()
         info = self._get_info()
         
@@ -424,13 +635,7 @@ class AddisTrafficEnvironment(gym.Env):
         
         # Execute actions for each traffic light
         rewards = []
-        tls_list = list(self.traffic_lights.keys())
-        
-        for i, (tls_id, action) in enumerate(zip(tls_list, actions)):
-            if tls_id not in self.traffic_lights:
-                continue
-                
-            tls = self.traffic_lights[tls_id]
+        for tls, action in zip(self._tls_objs, actions):
             reward = self._execute_action(tls, action)
             rewards.append(reward)
         
@@ -438,10 +643,10 @@ class AddisTrafficEnvironment(gym.Env):
         for _ in range(self.delta_time):
             traci.simulationStep()
             self.simulation_step += 1
+        self._refresh_subscriptions()
         
-        # Update metrics and check for emergency switches
+        # Update metrics; starvation is handled by the emergency check in _execute_action
         self._update_all_metrics()
-        self._check_emergency_switches()
         
         observation = self._get_observation()
         total_reward = np.mean(rewards) if rewards else 0
@@ -456,6 +661,22 @@ class AddisTrafficEnvironment(gym.Env):
         
         return observation, total_reward, done, False, info
     
+    def _refresh_subscriptions(self):
+        """Hand this step's lane and signal subscription results to every traffic light"""
+        lane_results = traci.lane.getAllSubscriptionResults()
+        tls_results = traci.trafficlight.getAllSubscriptionResults()
+        for tls_id, tls in zip(self._tls_list, self._tls_objs):
+            tls.lane_results = lane_results
+            tls.tls_state = tls_results.get(tls_id, {}).get(tc.TL_RED_YELLOW_GREEN_STATE)
+        
+        # Read every controlled lane through the flat lane index, then derive all lights' metrics at once
+        raw = self.all_lane_raw
+        for row, (tls, i) in enumerate(self.lane_owner):
+            if tls.lane_valid[i]:
+                values = tls._lane_values(self.all_lanes[row])
+                raw[row] = [values[var] for var in LANE_VARS]
+        derive_lane_metrics(raw, self.all_lane_occupancy_length, self.all_lane_density_km, self.all_lane_metrics)
+    
     def _execute_action(self, tls: TrafficLightManager, action: int) -> float:
         """Execute action for a specific traffic light"""
         reward = 0
@@ -468,7 +689,9 @@ class AddisTrafficEnvironment(gym.Env):
             if tls.can_switch_phase(self.simulation_step):
                 self._switch_to_phase(tls, emergency_phase)
                 reward += 5  # Smaller bonus to discourage reliance on emergency switches
-                print(f"Emergency switch for {tls.tls_id} to phase {emergency_phase}")
+                self.emergency_switches_count += 1
+                self.emergency_log.append((self.simulation_step, tls.tls_id, emergency_phase))
+                logger.debug("Emergency switch for %s to phase %s", tls.tls_id, emergency_phase)
         elif action == 1 and tls.can_switch_phase(self.simulation_step):
             # Regular RL-controlled phase switch
             next_phase = self._get_next_optimal_phase(tls)
@@ -489,6 +712,7 @@ class AddisTrafficEnvironment(gym.Env):
                 target_phase = target_phase % len(tls.phases)
                 
             traci.trafficlight.setPhase(tls.tls_id, target_phase)
+            tls.tls_state = None  # The new state only shows in subscriptions after the next step
             tls.current_phase = target_phase
             tls.phase_start_time = self.simulation_step
             tls.time_since_last_switch = 0
@@ -498,69 +722,38 @@ class AddisTrafficEnvironment(gym.Env):
     
     def _get_next_optimal_phase(self, tls: TrafficLightManager) -> int:
         """Get the optimal next phase based on traffic demand"""
-        lane_metrics = tls.get_lane_metrics()
-        
         best_phase = (tls.current_phase + 1) % len(tls.green_phases) if tls.green_phases else tls.current_phase
-        best_score = -float('inf')
         
-        for phase_idx in tls.green_phases:
-            if phase_idx == tls.current_phase:
-                continue
-                
-            score = self._evaluate_phase_score(tls, phase_idx, lane_metrics)
-            
-            if score > best_score:
-                best_score = score
-                best_phase = phase_idx
+        # Score every other green phase in one kernel call; the first best score wins
+        candidates = tls.green_phase_ids[tls.green_phase_ids != tls.current_phase]
+        if len(candidates):
+            scores = phase_scores(tls.phase_signal_green, candidates, tls.link_signal, tls.link_lane,
+                                  tls.metrics, tls.lane_last_green, self.simulation_step, tls.max_red_time)
+            best_phase = int(candidates[scores.argmax()])
         
         return best_phase
     
-    def _evaluate_phase_score(self, tls: TrafficLightManager, phase_idx: int, 
-                             lane_metrics: Dict) -> float:
+    def _evaluate_phase_score(self, tls: TrafficLightManager, phase_idx: int) -> float:
         """Evaluate the desirability of a phase based on current traffic"""
-        score = 0
+        if phase_idx >= len(tls.phases):
+            return -float('inf')
         
-        try:
-            if phase_idx >= len(tls.phases):
-                return -float('inf')
-                
-            phase_state = tls.phases[phase_idx].state
-            controlled_links = traci.trafficlight.getControlledLinks(tls.tls_id)
-            
-            for i, (state_char, link_list) in enumerate(zip(phase_state, controlled_links)):
-                if state_char in ['G', 'g'] and i < len(controlled_links):
-                    for link in link_list:
-                        lane = link[0]
-                        if lane in lane_metrics:
-                            metrics = lane_metrics[lane]
-                            # Score based on demand and fairness
-                            demand_score = (metrics['queue_length'] * 3 + 
-                                          metrics['waiting_time'] * 0.01 +
-                                          metrics['vehicle_count'] * 0.5)
-                            
-                            # Fairness bonus for lanes that haven't been green recently
-                            time_since_green = self.simulation_step - tls.lane_last_green[lane]
-                            fairness_bonus = min(time_since_green / tls.max_red_time * 5, 10)
-                            
-                            score += demand_score + fairness_bonus
-        except Exception as e:
-            # Silently handle errors to reduce log noise
-            pass
-        
-        return score
+        return phase_score(tls.phase_signal_green[phase_idx],
+                           tls.link_signal, tls.link_lane, tls.metrics,
+                           tls.lane_last_green, self.simulation_step, tls.max_red_time)
     
     def _calculate_reward(self, tls: TrafficLightManager) -> float:
         """Calculate reward for a traffic light's current state"""
-        lane_metrics = tls.get_lane_metrics()
-        
-        if not lane_metrics:
+        if not len(tls.metrics):
             return 0
         
+        vehicle_count, queue_length, waiting_time, mean_speed, occupancy, density, flow_rate = tls.metrics.T
+        
         # Efficiency metrics (normalized)
-        total_waiting_time = sum(m['waiting_time'] for m in lane_metrics.values()) / max(len(lane_metrics), 1)
-        total_queue_length = sum(m['queue_length'] for m in lane_metrics.values()) / max(len(lane_metrics), 1)
-        total_throughput = sum(m['flow_rate'] for m in lane_metrics.values()) / max(len(lane_metrics), 1)
-        avg_speed = np.mean([m['mean_speed'] for m in lane_metrics.values()])
+        total_waiting_time = waiting_time.mean()
+        total_queue_length = queue_length.mean()
+        total_throughput = flow_rate.mean()
+        avg_speed = mean_speed.mean()
         
         # Normalize metrics to [0,1] range
         waiting_norm = min(total_waiting_time / 300, 1)  # Normalize by 5 minutes
@@ -577,20 +770,14 @@ class AddisTrafficEnvironment(gym.Env):
         )
         
         # Fairness penalty: penalize high variance in waiting times (reduced impact)
-        waiting_times = [m['waiting_time'] for m in lane_metrics.values()]
-        if len(waiting_times) > 1:
-            fairness_penalty = -min(np.var(waiting_times) / 10000, 1)  # Normalized variance penalty
+        if len(waiting_time) > 1:
+            fairness_penalty = -min(np.var(waiting_time) / 10000, 1)  # Normalized variance penalty
         else:
             fairness_penalty = 0
         
         # Reduced starvation penalty (let emergency switches handle severe cases)
-        starvation_penalty = 0
-        current_green_lanes = tls._get_current_green_lanes()
-        for lane in tls.controlled_lanes:
-            if lane not in current_green_lanes:
-                time_since_green = self.simulation_step - tls.lane_last_green[lane]
-                if time_since_green > tls.max_red_time * 0.7:  # 70% of max red time
-                    starvation_penalty -= 1  # Reduced penalty
+        starvation = tls.starvation_times(self.simulation_step)
+        starvation_penalty = -int(np.count_nonzero(starvation > tls.max_red_time * 0.7))  # 70% of max red time
         
         # Reduced phase switching penalty
         switch_penalty = -0.05 if tls.time_since_last_switch < tls.min_green_time else 0
@@ -602,89 +789,60 @@ class AddisTrafficEnvironment(gym.Env):
     
     def _update_all_metrics(self):
         """Update metrics for all traffic lights"""
-        for tls in self.traffic_lights.values():
+        for tls in self._tls_objs:
             tls.update_fairness_metrics(self.simulation_step)
             tls.time_since_last_switch += self.delta_time
     
-    def _check_emergency_switches(self):
-        """Check for and handle emergency switches due to starvation"""
-        for tls in self.traffic_lights.values():
-            needs_emergency, emergency_phase = tls.needs_emergency_switch(self.simulation_step)
-            if needs_emergency and emergency_phase is not None:
-                self._switch_to_phase(tls, emergency_phase)
-                self.emergency_switches_count += 1
-                # Reduced logging to prevent spam
-                if self.emergency_switches_count % 10 == 1:  # Log every 10th emergency switch
-                    print(f"Emergency switches so far: {self.emergency_switches_count}")
-    
     def _get_observation(self) -> np.ndarray:
         """Get current observation state with fixed dimensions"""
         # Always return observation matching the fixed observation space
-        full_obs = np.zeros(self.observation_space.shape[0], dtype=np.float32)
+        full_obs = self._obs_buf
+        full_obs.fill(0)
         
         if not self.traffic_lights:
-            return full_obs
-        
-        obs_idx = 0
-        tls_list = list(self.traffic_lights.keys())[:self.max_traffic_lights]
-        
-        for i in range(self.max_traffic_lights):
-            if i < len(tls_list):
-                tls_id = tls_list[i]
-                tls = self.traffic_lights[tls_id]
-                
-                # Traffic light state (2 features)
-                full_obs[obs_idx] = tls.current_phase / max(len(tls.phases), 1)
-                full_obs[obs_idx + 1] = min(tls.time_since_last_switch / 100, 1.0)
-                obs_idx += 2
-                
-                # Lane metrics (up to 10 lanes * 7 metrics = 70 features)
-                lane_metrics = tls.get_lane_metrics()
-                lane_list = list(lane_metrics.keys())[:10]  # Max 10 lanes
-                
-                for j in range(10):  # Always 10 lane slots
-                    if j < len(lane_list):
-                        lane = lane_list[j]
-                        metrics = lane_metrics[lane]
-                        # Normalize all metrics to [0,1]
-                        full_obs[obs_idx:obs_idx+7] = [
-                            metrics['vehicle_count'] / 50,      # Normalized by max 50
-                            metrics['queue_length'] / 30,       # Normalized by max 30
-                            metrics['waiting_time'] / 300,      # Normalized by 5 minutes
-                            metrics['mean_speed'] / 50,         # Normalized by 50 km/h
-                            metrics['occupancy'],               # Already [0,1]
-                            metrics['density'] / 100,           # Normalized by max 100
-                            metrics['flow_rate'] / 500          # Normalized by max 500
-                        ]
-                    obs_idx += 7
-            else:
-                # Fill empty TLS slots with zeros
-                obs_idx += 72  # 2 + 10*7
-        
-        # Global metrics (10 features)
-        try:
-            total_vehicles = traci.simulation.getMinExpectedNumber()
-            total_waiting = sum(traci.lane.getWaitingTime(lane) 
-                              for tls in self.traffic_lights.values() 
-                              for lane in tls.controlled_lanes)
-            avg_speed = np.mean([traci.lane.getLastStepMeanSpeed(lane) 
-                               for tls in self.traffic_lights.values() 
-                               for lane in tls.controlled_lanes])
+            return full_obs.copy()
+        
+        max_tls = self.max_traffic_lights
+        # Raw features of every slot, normalized together below; empty slots stay zero
+        raw = self._obs_raw
+        raw.fill(0)
+        tls_raw = self._tls_obs_raw
+        
+        for i, tls in enumerate(self._tls_objs[:max_tls]):
+            # Traffic light state (2 features)
+            tls_raw[i, 0] = tls.current_phase
+            tls_raw[i, 1] = tls.time_since_last_switch
             
-            full_obs[obs_idx:obs_idx+10] = [
-                min(total_vehicles / 1000, 1),           # Normalized total vehicles
-                min(total_waiting / 10000, 1),           # Normalized total waiting
-                min(avg_speed / 50, 1) if not np.isnan(avg_speed) else 0,  # Normalized avg speed
-                min(self.simulation_step / self.num_seconds, 1),  # Progress
-                min(len(self.traffic_lights) / self.max_traffic_lights, 1), # TLS utilization
-                min(self.emergency_switches_count / 100, 1),      # Emergency switches
-                0, 0, 0, 0  # Reserved for future metrics
-            ]
-        except:
-            # If error, fill with safe defaults
-            full_obs[obs_idx:obs_idx+10] = [0] * 10
-        
-        return full_obs
+            # Lane metrics (up to 10 lanes * 7 metrics = 70 features)
+            lane_metrics = tls.metrics[:10]  # Max 10 lanes
+            tls_raw[i, 2:2 + lane_metrics.size] = lane_metrics.ravel()
+        
+        # Global metrics (10 features); the mean speed is NaN while no lane is controlled
+        total_vehicles = traci.simulation.getMinExpectedNumber()
+        total_waiting = self.all_lane_raw[:, LANE_VARS.index(tc.VAR_WAITING_TIME)].sum()
+        avg_speed = self.all_lane_raw[:, LANE_VARS.index(tc.LAST_STEP_MEAN_SPEED)].mean()
+        
+        global_raw = self._global_obs_raw
+        global_raw[:] = [
+            total_vehicles,
+            total_waiting,
+            avg_speed,
+            self.simulation_step,
+            len(self.traffic_lights),
+            self.emergency_switches_count,
+            0, 0, 0, 0  # Reserved for future metrics
+        ]
+        
+        # Scale every feature in one vectorized pass; only the time since switch and the
+        # global metrics are capped, lane metrics keep values above 1
+        np.divide(raw, self._obs_scale, out=raw)
+        np.minimum(tls_raw[:, 1], 1.0, out=tls_raw[:, 1])
+        np.nan_to_num(global_raw, copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+        np.clip(global_raw, 0, 1, out=global_raw)
+        full_obs[:] = raw
+        
+        # Copied out of the reused buffer so callers (e.g. SB3's terminal_observation) can keep it
+        return full_obs.copy()
     
     def _get_info(self) -> dict:
         """Get environment info"""
@@ -699,28 +857,32 @@ class AddisTrafficEnvironment(gym.Env):
         
         try:
             info['total_vehicles'] = traci.simulation.getMinExpectedNumber()
+        except traci.TraCIException as e:
+            logger.debug("Could not read the expected vehicle number: %s", e)
+        
+        if len(self.all_lane_raw):
+            waiting_times = self.all_lane_raw[:, LANE_VARS.index(tc.VAR_WAITING_TIME)]
+            speeds = self.all_lane_raw[:, LANE_VARS.index(tc.LAST_STEP_MEAN_SPEED)]
             
-            if self.traffic_lights:
-                all_lanes = [lane for tls in self.traffic_lights.values() for lane in tls.controlled_lanes]
-                if all_lanes:
-                    waiting_times = [traci.lane.getWaitingTime(lane) for lane in all_lanes]
-                    speeds = [traci.lane.getLastStepMeanSpeed(lane) for lane in all_lanes]
-                    
-                    info['total_waiting_time'] = sum(waiting_times)
-                    info['avg_speed'] = np.mean([s for s in speeds if s > 0]) if speeds else 0
-        except:
-            pass
+            info['total_waiting_time'] = float(waiting_times.sum())
+            moving = speeds[speeds > 0]
+            info['avg_speed'] = float(moving.mean()) if len(moving) else 0.0
         
         return info
     
     def close(self):
         """Close the environment"""
-        try:
-            if traci.isLoaded():
-                traci.close()
-        except:
-            pass
+        if traci.isLoaded():
+            traci.close()
     
     def render(self):
         """Render the environment (handled by SUMO GUI if enabled)"""
-        pass
\ No newline at end of file
+        pass
+
+
+def make_parallel_env(env_kwargs: Dict[str, Any], n_envs: Optional[int] = None,
+                      normalize: bool = False, stats_path: Optional[str] = None):
+    """addis_traffic_env.make_parallel_env building copies of this module's environment"""
+    from addis_traffic_env import make_parallel_env as make_vec_env
+    
+    return make_vec_env(env_kwargs, n_envs, normalize, stats_path, env_cls=AddisTrafficEnvironment)
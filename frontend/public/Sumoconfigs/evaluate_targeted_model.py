@@ -24,7 +24,7 @@ import seaborn as sns
 from datetime import datetime
 from typing import Dict, List, Tuple
 from stable_baselines3 import PPO
-from addis_targeted_env import AddisTargetedEnvironment, FixedTimeController, SumoDefaultController
+from addis_targeted_env import AddisTargetedEnvironment, FixedTimeController, SumoDefaultController, run_episodes_parallel
 
 class ModelEvaluator:
     """Comprehensive evaluation of RL vs Fixed-Time control"""
@@ -47,9 +47,9 @@ class ModelEvaluator:
             print(f"❌ Error loading model: {e}")
             return False
     
-    def create_evaluation_env(self, use_gui: bool = False, episode_seconds: int = 1800, control_mode: str = 'rl', delta_time: int = 15):
-        """Create environment for evaluation"""
-        return AddisTargetedEnvironment(
+    def evaluation_env_kwargs(self, use_gui: bool = False, episode_seconds: int = 1800, control_mode: str = 'rl', delta_time: int = 15) -> Dict:
+        """Constructor arguments for an evaluation environment"""
+        return dict(
             sumocfg_file=self.sumocfg_file,
             use_gui=use_gui,
             num_seconds=episode_seconds,
@@ -58,6 +58,12 @@ class ModelEvaluator:
             control_mode=control_mode
         )
     
+    def create_evaluation_env(self, use_gui: bool = False, episode_seconds: int = 1800, control_mode: str = 'rl', delta_time: int = 15):
+        """Create environment for evaluation"""
+        return AddisTargetedEnvironment(
+            **self.evaluation_env_kwargs(use_gui, episode_seconds, control_mode, delta_time)
+        )
+    
     def run_rl_evaluation(self, episodes: int = 5, use_gui: bool = False, episode_seconds: int = 1800, delta_time: int = 15) -> List[Dict]:
         """Run evaluation with RL model"""
         if not self.rl_model:
@@ -118,18 +124,30 @@ class ModelEvaluator:
         return results
     
     def run_fixed_time_evaluation(self, episodes: int = 5, use_gui: bool = False, 
-                                 episode_seconds: int = 1800, green_time: int = 25, delta_time: int = 15) -> List[Dict]:
+                                 episode_seconds: int = 1800, green_time: int = 25, delta_time: int = 15,
+                                 workers: int = 1) -> List[Dict]:
         """Run evaluation with fixed-time control"""
         print(f"🚦 Running Fixed-Time evaluation ({episodes} episodes) using SUMO default TLS logic...")
         results = []
         
+        # Baseline episodes are independent, so run them in separate SUMO
+        # processes when asked (the GUI stays serial)
+        parallel_results = None
+        if workers > 1 and episodes > 1 and not use_gui:
+            print(f"  Running {episodes} episodes on {min(workers, episodes)} workers")
+            env_kwargs = self.evaluation_env_kwargs(use_gui=False, episode_seconds=episode_seconds,
+                                                    control_mode='sumo_default', delta_time=delta_time)
+            parallel_results = run_episodes_parallel(SumoDefaultController, env_kwargs, episodes, workers)
+        
         for episode in range(episodes):
             print(f"  Fixed-Time Episode {episode + 1}/{episodes}")
             
-            env = self.create_evaluation_env(use_gui=use_gui, episode_seconds=episode_seconds, control_mode='sumo_default', delta_time=delta_time)
-            controller = SumoDefaultController(env)
-            
-            result = controller.run_episode()
+            if parallel_results is not None:
+                result = parallel_results[episode]
+            else:
+                env = self.create_evaluation_env(use_gui=use_gui, episode_seconds=episode_seconds, control_mode='sumo_default', delta_time=delta_time)
+                controller = SumoDefaultController(env)
+                result = controller.run_episode()
             result['episode'] = episode + 1
             result['simulation_time_minutes'] = result['steps'] * delta_time / 60
             
@@ -405,6 +423,7 @@ def main():
     parser.add_argument('--fixed-green-time', type=int, default=25, help='Fixed-time green duration')
     parser.add_argument('--output-dir', help='Output directory for results')
     parser.add_argument('--sumocfg', default='AddisAbabaSimple.sumocfg', help='SUMO config file to use for this evaluation')
+    parser.add_argument('--workers', type=int, default=1, help='Parallel SUMO processes for baseline episodes')
     
     args = parser.parse_args()
     
@@ -448,7 +467,8 @@ def main():
             use_gui=args.gui,
             episode_seconds=args.episode_length,
             green_time=args.fixed_green_time,
-            delta_time=args.delta_time
+            delta_time=args.delta_time,
+            workers=args.workers
         )
         
         # Compare methods
@@ -7,63 +7,71 @@ throughput maximization, and fairness considerations for multi-agent traffic con
 
 import sys
 import os
+import numpy as np
+
+from numba_compat import njit
 
 # Add sumo-rl to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'sumo-rl'))
 from sumo_rl.environment.traffic_signal import TrafficSignal
 
+# Phase usage passed to the kernel while fairness is not tracked
+_NO_USAGE = np.zeros(1, dtype=np.int64)
 
-def fairness_combined_reward(ts: TrafficSignal) -> float:
+
+def _reward_norms(ts: TrafficSignal) -> tuple:
     """
-    Compute multi-objective reward balancing congestion, throughput, and fairness.
+    Normalizers of the reward terms, which depend only on the signal's lanes and phases.
     
-    Combines queue efficiency, wait time efficiency, throughput, fairness score,
-    stagnation penalty, and yellow phase penalty with configurable weights.
+    Computed on the first reward call and kept on the TrafficSignal.
+    """
+    norms = getattr(ts, '_fairness_reward_norms', None)
+    if norms is None:
+        total_lanes = len(ts.lanes)
+        max_possible_queue = total_lanes * 20  # Assume 20 vehicles per lane capacity
+        norms = (max_possible_queue,
+                 max(max_possible_queue, 1),
+                 max(total_lanes * 100, 1),
+                 max(total_lanes * 2, 1),
+                 1.0 / ts.num_green_phases)  # Expected uniform phase usage
+        ts._fairness_reward_norms = norms
+    return norms
+
+
+@njit(cache=True)
+def combined_reward(total_queue, max_possible_queue, queue_norm, wait_times, wait_norm,
+                    departed, throughput_norm, phase_usage, total_usage, expected_usage,
+                    same_phase_count, is_yellow):
+    """
+    Weighted reward terms from the signal's raw measurements.
     
-    Args:
-        ts: TrafficSignal instance from SUMO-RL
-        
-    Returns:
-        float: Combined reward value
+    A total_usage of 0 leaves the fairness score at 1.0 (fairness not yet tracked).
     """
     # Queue efficiency component
-    total_queue = ts.get_total_queued()
-    total_lanes = len(ts.lanes)
-    max_possible_queue = total_lanes * 20  # Assume 20 vehicles per lane capacity
-    queue_efficiency = max(0, (max_possible_queue - total_queue) / max(max_possible_queue, 1))
+    queue_efficiency = max(0.0, (max_possible_queue - total_queue) / queue_norm)
     
     # Wait time efficiency component
-    wait_times = ts.get_accumulated_waiting_time_per_lane()
-    total_wait = sum(wait_times)
-    wait_efficiency = max(0, 1.0 / (1.0 + total_wait / max(total_lanes * 100, 1)))
+    total_wait = wait_times.sum()
+    wait_efficiency = max(0.0, 1.0 / (1.0 + total_wait / wait_norm))
     
     # Throughput component
-    departed = ts.sumo.simulation.getDepartedNumber()
-    throughput_reward = min(1.0, departed / max(total_lanes * 2, 1))
+    throughput_reward = min(1.0, departed / throughput_norm)
     
-    # Fairness component (requires accessing observation function state)
+    # Fairness component: variance of the normalized phase usage around uniform usage
     fairness_score = 1.0
-    if hasattr(ts.observation_fn, 'phase_usage') and ts.observation_fn.step_count > 100:
-        phase_usage = ts.observation_fn.phase_usage
-        total_usage = sum(phase_usage.values())
-        
-        if total_usage > 0:
-            # Normalize usage
-            usage_values = [phase_usage.get(i, 0) / total_usage for i in range(ts.num_green_phases)]
-            # Compute expected uniform usage
-            expected_usage = 1.0 / ts.num_green_phases
-            # Compute variance
-            variance = sum((u - expected_usage)**2 for u in usage_values) / ts.num_green_phases
-            # Compute fairness score
-            fairness_score = max(0, 1.0 - variance * 10)
+    if total_usage > 0:
+        variance = 0.0
+        for usage in phase_usage:
+            deviation = usage / total_usage - expected_usage
+            variance += deviation * deviation
+        variance /= len(phase_usage)
+        fairness_score = max(0.0, 1.0 - variance * 10)
     
     # Stagnation penalty component
-    stagnation_penalty = 1.0
-    if hasattr(ts.observation_fn, 'same_phase_count'):
-        stagnation_penalty = max(0, 1.0 - (ts.observation_fn.same_phase_count / 100.0))
+    stagnation_penalty = max(0.0, 1.0 - (same_phase_count / 100.0))
     
     # Yellow phase penalty
-    yellow_penalty = -0.1 if ts.is_yellow else 0
+    yellow_penalty = -0.1 if is_yellow else 0.0
     
     # Combine with weights (matching traffic_env_single_tls.py)
     w_queue = 0.30
@@ -73,12 +81,44 @@ def fairness_combined_reward(ts: TrafficSignal) -> float:
     w_stagnation = 0.05
     w_yellow = 0.05
     
-    reward = (w_queue * queue_efficiency + 
-              w_wait * wait_efficiency + 
-              w_throughput * throughput_reward + 
-              w_fairness * fairness_score + 
-              w_stagnation * stagnation_penalty + 
-              w_yellow * yellow_penalty)
+    return (w_queue * queue_efficiency + 
+            w_wait * wait_efficiency + 
+            w_throughput * throughput_reward + 
+            w_fairness * fairness_score + 
+            w_stagnation * stagnation_penalty + 
+            w_yellow * yellow_penalty)
+
+
+def fairness_combined_reward(ts: TrafficSignal) -> float:
+    """
+    Compute multi-objective reward balancing congestion, throughput, and fairness.
+    
+    Combines queue efficiency, wait time efficiency, throughput, fairness score,
+    stagnation penalty, and yellow phase penalty with configurable weights.
+    
+    Args:
+        ts: TrafficSignal instance from SUMO-RL
+        
+    Returns:
+        float: Combined reward value
+    """
+    max_possible_queue, queue_norm, wait_norm, throughput_norm, expected_usage = _reward_norms(ts)
+    
+    # Fairness component (requires accessing observation function state)
+    phase_usage, total_usage = _NO_USAGE, 0
+    if hasattr(ts.observation_fn, 'phase_usage') and ts.observation_fn.step_count > 100:
+        phase_usage = ts.observation_fn.phase_usage
+        total_usage = ts.observation_fn.total_usage
+    
+    # Stagnation penalty component (none when not tracked)
+    same_phase_count = getattr(ts.observation_fn, 'same_phase_count', 0)
+    
+    reward = combined_reward(
+        ts.get_total_queued(), max_possible_queue, queue_norm,
+        np.asarray(ts.get_accumulated_waiting_time_per_lane(), dtype=np.float64), wait_norm,
+        ts.sumo.simulation.getDepartedNumber(), throughput_norm,
+        phase_usage, total_usage, expected_usage,
+        same_phase_count, bool(ts.is_yellow))
     
     return float(reward)
 
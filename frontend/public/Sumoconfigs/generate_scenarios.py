@@ -21,7 +21,9 @@ Outputs:
 
 import os
 import xml.etree.ElementTree as ET
-import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 BASE_SUMOCFG = "AddisAbabaSimple.sumocfg"
 BASE_ROUTES = "addisTrafficFullNetwork.rou.xml"
@@ -58,43 +60,51 @@ def write_routes(tree, path):
     tree.write(path, encoding="utf-8", xml_declaration=True)
 
 
+def _float_attr(flows, name):
+    """Values of a numeric flow attribute; NaN where it is missing or not a number"""
+    values = np.full(len(flows), np.nan)
+    for i, flow in enumerate(flows):
+        try:
+            values[i] = float(flow.attrib[name])
+        except (KeyError, ValueError):
+            pass
+    return values
+
+
 def modify_flows(root, scenario_key, cfg):
-    rng = random.Random(cfg["seed"])  # deterministic
-
-    for flow in root.findall("flow"):
-        # Adjust period (demand)
-        if "period" in flow.attrib:
-            try:
-                period = float(flow.attrib["period"])
-                period *= cfg["period_mul"]
-                if cfg.get("jitter"):
-                    period *= rng.uniform(0.9, 1.1)
-                flow.set("period", str(max(0.1, round(period, 2))))
-            except Exception:
-                pass
-
-        # Adjust begin time
-        if "begin" in flow.attrib:
-            try:
-                begin = float(flow.attrib["begin"])
-                begin += cfg["begin_shift"]
-                if cfg.get("jitter"):
-                    begin += rng.uniform(-120, 120)
-                begin = max(0.0, round(begin, 2))
-                flow.set("begin", str(begin))
-            except Exception:
-                pass
-
-        # Adjust end to remain >= begin
-        if "end" in flow.attrib and "begin" in flow.attrib:
-            try:
-                begin = float(flow.attrib["begin"])
-                end = float(flow.attrib["end"])
-                if end < begin + 60:  # ensure at least 1 minute window
-                    end = begin + 60
-                flow.set("end", str(round(end, 2)))
-            except Exception:
-                pass
+    rng = np.random.default_rng(cfg["seed"])  # deterministic
+
+    flows = root.findall("flow")
+    periods = _float_attr(flows, "period")
+    begins = _float_attr(flows, "begin")
+    ends = _float_attr(flows, "end")
+    has_period = ~np.isnan(periods)
+    has_begin = ~np.isnan(begins)
+    has_end = has_begin & ~np.isnan(ends)
+
+    # Adjust period (demand) and begin time
+    periods *= cfg["period_mul"]
+    begins += cfg["begin_shift"]
+    if cfg.get("jitter"):
+        periods *= rng.uniform(0.9, 1.1, size=len(flows))
+        begins += rng.uniform(-120, 120, size=len(flows))
+    periods = np.maximum(0.1, np.round(periods, 2))
+    begins = np.maximum(0.0, np.round(begins, 2))
+
+    # Adjust end to remain >= begin, ensuring at least a 1 minute window
+    ends = np.round(np.maximum(ends, begins + 60), 2)
+
+    # Format every value with two decimals in one call per attribute
+    for flow, period, begin, end, p_ok, b_ok, e_ok in zip(
+            flows, np.char.mod("%.2f", periods).tolist(), np.char.mod("%.2f", begins).tolist(),
+            np.char.mod("%.2f", ends).tolist(),
+            has_period.tolist(), has_begin.tolist(), has_end.tolist()):
+        if p_ok:
+            flow.set("period", period)
+        if b_ok:
+            flow.set("begin", begin)
+        if e_ok:
+            flow.set("end", end)
 
 
 def make_sumocfg_variant(in_sumocfg, out_sumocfg, routes_path, seed_value):
@@ -102,35 +112,44 @@ def make_sumocfg_variant(in_sumocfg, out_sumocfg, routes_path, seed_value):
     root = tree.getroot()
 
     # Update route-files value
-    for input_tag in root.findall("input"):
-        for rf in input_tag.findall("route-files"):
-            rf.set("value", routes_path)
+    for rf in root.iterfind("input/route-files"):
+        rf.set("value", routes_path)
 
     # Update seed
-    for rnd in root.findall("random_number"):
-        for seed in rnd.findall("seed"):
-            seed.set("value", str(seed_value))
+    for seed in root.iterfind("random_number/seed"):
+        seed.set("value", str(seed_value))
 
     tree.write(out_sumocfg, encoding="utf-8", xml_declaration=True)
 
 
+def build_scenario(name, cfg):
+    """Write the route file and sumocfg of one scenario; returns their paths"""
+    tree, root = read_routes(BASE_ROUTES)
+    modify_flows(root, name, cfg)
+
+    routes_out = f"addisTrafficFullNetwork_{name}.rou.xml"
+    write_routes(tree, routes_out)
+
+    sumocfg_out = f"AddisAbabaSimple_{name}.sumocfg"
+    make_sumocfg_variant(BASE_SUMOCFG, sumocfg_out, routes_out, cfg["seed"])
+    return routes_out, sumocfg_out
+
+
 def main():
     if not os.path.exists(BASE_SUMOCFG):
         raise FileNotFoundError(f"Missing {BASE_SUMOCFG}")
     if not os.path.exists(BASE_ROUTES):
         raise FileNotFoundError(f"Missing {BASE_ROUTES}")
 
-    for name, cfg in SCENARIOS.items():
-        print(f"Creating scenario: {name}")
-        tree, root = read_routes(BASE_ROUTES)
-        modify_flows(root, name, cfg)
+    # Scenarios are independent: build each in its own process, which parses its own base routes
+    print(f"Creating scenarios: {', '.join(SCENARIOS)}")
+    workers = min(len(SCENARIOS), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        outputs = list(executor.map(build_scenario, SCENARIOS.keys(), SCENARIOS.values()))
 
-        routes_out = f"addisTrafficFullNetwork_{name}.rou.xml"
-        write_routes(tree, routes_out)
+    for name, (routes_out, sumocfg_out) in zip(SCENARIOS, outputs):
+        print(f"Created scenario: {name}")
         print(f"  Wrote routes: {routes_out}")
-
-        sumocfg_out = f"AddisAbabaSimple_{name}.sumocfg"
-        make_sumocfg_variant(BASE_SUMOCFG, sumocfg_out, routes_out, cfg["seed"])
         print(f"  Wrote sumocfg: {sumocfg_out}")
 
     print("\n✅ Scenarios generated: offpeak, peak, jitter")
@@ -73,15 +73,15 @@ class FairnessInfoWrapper(BaseParallelWrapper):
                 if hasattr(ts, 'observation_fn') and hasattr(ts.observation_fn, 'phase_usage'):
                     # Calculate fairness score for this traffic signal
                     phase_usage = ts.observation_fn.phase_usage
-                    total_usage = sum(phase_usage.values())
+                    total_usage = ts.observation_fn.total_usage
                     
                     if total_usage > 0 and ts.observation_fn.step_count > 100:
                         # Normalize usage
-                        usage_values = [phase_usage.get(i, 0) / total_usage for i in range(ts.num_green_phases)]
+                        usage_values = phase_usage / total_usage
                         # Compute expected uniform usage
                         expected_usage = 1.0 / ts.num_green_phases
                         # Compute variance
-                        variance = sum((u - expected_usage)**2 for u in usage_values) / ts.num_green_phases
+                        variance = float(((usage_values - expected_usage) ** 2).mean())
                         # Compute fairness score
                         fairness_score = max(0, 1.0 - variance * 10)
                     else:
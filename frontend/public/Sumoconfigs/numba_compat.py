@@ -0,0 +1,15 @@
+"""
+Optional numba support shared by the environment and reward modules.
+
+`njit` is numba's decorator when numba is installed; otherwise it is a no-op so the
+decorated kernels run as plain Python with the same results.
+"""
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        # numba is optional: without it the decorated functions run as plain Python
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fn: fn